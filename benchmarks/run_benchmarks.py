@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Per-stage benchmarks
+--------------------
+
+Times each stage of a design run on synthetic data:
+
+- slices: VcfPrimerDesign.getseqslicedicts over every target
+- windows: design_primers.py GFF indexing and window extraction
+- primer3: run_P3_many over a subset of the windows
+- primer3_clustered: the same windows, nearby targets sharing a window
+- melt_local: the local melt model over random amplicons
+- melt_umelt: the uMelt client against a local stand-in server
+- tm: batched melting temperature extraction
+- output_<format>: writing result rows in each output format
+- multiplex: dimer prefilter, dG checks and pooling over random primer pairs
+- design_serial, design_pipeline: a whole design_primers.py run with uMelt
+  melting against the stand-in server, designing and melting in turn and
+  as overlapping --pipeline stages
+- startup_<entry point>: import time of each script and of the designer
+  module in a fresh interpreter, as reported by python -X importtime
+
+Results are written as JSON and can be compared with a stored baseline,
+e.g. from the same machine before a change:
+
+    python -m benchmarks.run_benchmarks --targets 50000 -o baseline.json
+    python -m benchmarks.run_benchmarks --targets 50000 --baseline baseline.json
+
+A stage slower than the baseline by more than --tolerance counts as a
+regression, and makes the exit status 1.
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import synthetic
+
+STAGES = ('slices', 'windows', 'primer3', 'primer3_clustered', 'melt_local', 'melt_umelt', 'tm', 'output', 'multiplex',
+          'design', 'startup')
+
+## modules timed by the startup stage, importable from the repository root
+ENTRY_POINTS = ('design_primers', 'shard_primers', 'multiplex_primers', 'pcr_marker_design.design')
+
+
+def timed(function, repeat=1):
+    """Best wall time of repeat calls of function, and its last result"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _stage(seconds, items):
+    return dict(seconds=seconds, items=items, per_second=items / seconds if seconds else None)
+
+
+def bench_slices(data, args):
+    from pybedtools import BedTool
+    from pcr_marker_design.design import VcfPrimerDesign
+    designer = VcfPrimerDesign(data.fasta, data.vcf, 'bench')
+    targets = list(BedTool(data.bed))
+    seconds, slices = timed(lambda: designer.getseqslicedicts(targets, args.max_size), args.repeat)
+    return {'slices': _stage(seconds, len(slices))}
+
+
+def _windows(data, max_size):
+    from design_primers import group_targets, index_gff_features, target_windows
+    with open(data.targets) as handle:
+        targets_by_seq = group_targets([X.rstrip() for X in handle], ':')
+    with open(data.gff) as gff, open(data.fasta) as fasta:
+        gff_index = index_gff_features(gff, targets_by_seq.keys())
+        return list(target_windows(fasta, targets_by_seq, gff_index, max_size))
+
+
+def bench_windows(data, args):
+    seconds, windows = timed(lambda: _windows(data, args.max_size), args.repeat)
+    return {'windows': _stage(seconds, len(windows))}
+
+
+def bench_primer3(data, args):
+    from pcr_marker_design import run_p3 as P3
+    windows = _windows(data, args.max_size)[:args.p3_targets]
+    session = P3.DesignSession(PRIMER_PRODUCT_SIZE_RANGE=[[100, args.max_size]])
+    seconds, results = timed(lambda: list(session.design_many((X.target_dict for X in windows), jobs=args.jobs)),
+                             args.repeat)
+    return {'primer3': _stage(seconds, len(results))}
+
+
+def bench_primer3_clustered(data, args):
+    """The primer3 stage's targets, nearby ones designed on shared windows"""
+    from design_primers import cluster_window
+    from pcr_marker_design import clusters
+    from pcr_marker_design import run_p3 as P3
+    windows = _windows(data, args.max_size)[:args.p3_targets]
+    shared = [cluster_window(X, 6) for X in clusters.group_nearby(
+        windows, lambda X: X.target_dict['SEQUENCE_ID'], lambda X: X.position, args.max_size)]
+    session = P3.DesignSession(PRIMER_PRODUCT_SIZE_RANGE=[[100, args.max_size]])
+    seconds, results = timed(lambda: list(session.design_many((X.target_dict for X in shared), jobs=args.jobs)),
+                             args.repeat)
+    return {'primer3_clustered': dict(_stage(seconds, len(windows)), designs=len(results))}
+
+
+def _amplicons(data, count, seed):
+    rng = np.random.default_rng(seed)
+    names = list(data.sequences)
+    amplicons = []
+    for _ in range(count):
+        seq = data.sequences[names[int(rng.integers(0, len(names)))]]
+        length = int(rng.integers(100, 300))
+        start = int(rng.integers(0, len(seq) - length))
+        amplicons.append(seq[start:start + length])
+    return amplicons
+
+
+def bench_melt_local(data, args):
+    from pcr_marker_design import umelt_service as um
+    service = um.melt_service('local')
+    sequences = [um.MeltSeq(X) for X in _amplicons(data, args.melt_amplicons, args.seed)]
+    seconds, results = timed(lambda: service.melt_many(sequences), args.repeat)
+    return {'melt_local': _stage(seconds, len(results))}
+
+
+def bench_melt_umelt(data, args):
+    from pcr_marker_design import umelt_service as um
+    from test.umelt_stub import UmeltStub
+    stub = UmeltStub(delay=args.umelt_delay).start()
+    try:
+        service = um.melt_service('umelt', url=stub.url, max_workers=args.melt_workers)
+        sequences = [um.MeltSeq(X) for X in _amplicons(data, args.umelt_amplicons, args.seed)]
+        seconds, results = timed(lambda: service.melt_many(sequences), args.repeat)
+    finally:
+        stub.stop()
+    return {'melt_umelt': _stage(seconds, len(results))}
+
+
+def bench_tm(data, args):
+    from pcr_marker_design import melt_model as mm
+    from pcr_marker_design import umelt_service as um
+    helicity = mm.predict_helicity(_amplicons(data, args.melt_amplicons, args.seed))
+    seconds, curves = timed(lambda: um.melting_temps(helicity), args.repeat)
+    return {'tm': _stage(seconds, len(curves.melting_temps))}
+
+
+def bench_output(data, args):
+    from pcr_marker_design import output
+    rng = np.random.default_rng(args.seed)
+    rows = [(synthetic.variant_id(X), X.start + 1, X.ref, X.alt, int(rng.integers(100, 300)),
+             'ACGTACGTACGTACGTACGT', 'TGCATGCATGCATGCATGCA', 85.5, 85.25, 0.25)
+            for X in data.target_variants for _ in range(5)]
+    stages = {}
+    for format in output.FORMATS:
+        if format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+            continue
+        path = os.path.join(args.workdir, 'rows.' + format)
+
+        def write():
+            with output.open_writer(path, format) as writer:
+                for row in rows:
+                    writer.write(row)
+        seconds, _ = timed(write, args.repeat)
+        stages['output_' + format] = _stage(seconds, len(rows))
+    return stages
+
+
+def bench_multiplex(data, args):
+    from pcr_marker_design import multiplex
+    primers = [X[:20] for X in _amplicons(data, 2 * args.multiplex_pairs, args.seed)]
+    pairs = [multiplex.Pair(str(i), str(i), 0, primers[2 * i], primers[2 * i + 1]) for i in range(args.multiplex_pairs)]
+
+    def pool():
+        return multiplex.assign_pools(pairs, multiplex.conflict_graph(pairs, jobs=args.jobs))
+    seconds, pools = timed(pool, args.repeat)
+    return {'multiplex': _stage(seconds, len(pairs))}
+
+
+def import_seconds(module):
+    """Import time of module in a fresh interpreter, and the number of
+    modules importing it loads
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=root,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    ## lines of "import time: self [us] | cumulative | module", indented by depth
+    rows = [X.split('|') for X in result.stderr.splitlines() if X.startswith('import time:')]
+    rows = [(int(X[1]), X[2].strip()) for X in rows if X[1].strip().isdigit()]
+    return next(us for us, name in reversed(rows) if name == module) / 1e6, len(rows)
+
+
+def bench_design(data, args):
+    """design_primers.py with melting over the primer3 stage's targets,
+    serially and as a pipeline
+    """
+    from design_primers import design_primer_rows, parse_args
+    from test.umelt_stub import UmeltStub
+    targets = os.path.join(args.workdir, 'design_targets')
+    with open(data.targets) as handle, open(targets, 'w') as subset:
+        subset.writelines(X for _, X in zip(range(args.p3_targets), handle))
+    stub = UmeltStub(delay=args.umelt_delay).start()
+    stages = {}
+    try:
+        for name, options in (('design_serial', []), ('design_pipeline', ['--pipeline'])):
+            arguments = ['-i', data.fasta, '-g', data.gff, '-T', targets, '-u', '--umelt-url', stub.url,
+                         '--melt-workers', str(args.melt_workers), '-P', str(args.max_size), '-j', str(args.jobs)]
+            seconds, rows = timed(lambda: list(design_primer_rows(parse_args(arguments + options))), args.repeat)
+            stages[name] = dict(_stage(seconds, args.p3_targets), rows=len(rows))
+    finally:
+        stub.stop()
+    return stages
+
+
+def bench_startup(data, args):
+    stages = {}
+    for module in ENTRY_POINTS:
+        timings = [import_seconds(module) for _ in range(args.repeat)]
+        seconds, modules = min(timings)
+        stages['startup_' + module.split('.')[-1]] = dict(_stage(seconds, 1), modules=modules)
+    return stages
+
+
+BENCHMARKS = dict(slices=bench_slices, windows=bench_windows, primer3=bench_primer3,
+                  primer3_clustered=bench_primer3_clustered,
+                  melt_local=bench_melt_local, melt_umelt=bench_melt_umelt, tm=bench_tm, output=bench_output,
+                  multiplex=bench_multiplex, design=bench_design, startup=bench_startup)
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Compare stage times with a baseline.
+
+    Returns a list of (stage, seconds, baseline seconds, ratio, status)
+    where status is 'regression' if the stage is slower than the
+    baseline by more than tolerance, 'improvement' if faster by as
+    much, 'ok' otherwise, or 'new' if the baseline lacks it. Stages
+    without items are compared by time; a baseline time of zero gives no
+    ratio.
+    """
+    rows = []
+    for stage, result in sorted(results['stages'].items()):
+        base = baseline.get('stages', {}).get(stage)
+        if base is None:
+            rows.append((stage, result['seconds'], None, None, 'new'))
+            continue
+        ## compare rates, in case the two runs timed different item counts, or times if either timed none
+        if result['items'] and base['items']:
+            now, then = result['seconds'] / result['items'], base['seconds'] / base['items']
+        else:
+            now, then = result['seconds'], base['seconds']
+        ratio = now / then if then else None
+        if ratio is None:
+            status = 'ok'
+        elif ratio > 1 + tolerance:
+            status = 'regression'
+        elif ratio < 1 / (1 + tolerance):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append((stage, result['seconds'], base['seconds'], ratio, status))
+    return rows
+
+
+def run(args):
+    """Generate data and run the chosen stages; returns the results dict"""
+    start = time.perf_counter()
+    data = synthetic.make_dataset(args.workdir, n_targets=args.targets, snp_density=args.snp_density,
+                                  seed=args.seed)
+    results = dict(meta=dict(python=platform.python_version(), platform=platform.platform(),
+                             processor=platform.processor(), cpus=os.cpu_count(),
+                             time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                             parameters=dict((X, getattr(args, X)) for X in
+                                             ('targets', 'snp_density', 'seed', 'max_size', 'p3_targets', 'jobs',
+                                              'melt_amplicons', 'umelt_amplicons', 'umelt_delay', 'melt_workers',
+                                              'multiplex_pairs', 'repeat'))),
+                   stages={})
+    results['meta']['generate_seconds'] = time.perf_counter() - start
+    for stage in args.stages:
+        results['stages'].update(BENCHMARKS[stage](data, args))
+    return results
+
+
+def parse_args(arguments):
+    parser = argparse.ArgumentParser(description='Per-stage benchmarks on synthetic data')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), help="stages to run, default all")
+    parser.add_argument('--targets', type=int, default=5000, help="number of SNP targets, default=5000")
+    parser.add_argument('--snp-density', type=float, default=0.002, dest='snp_density', help="variants per base, default=0.002")
+    parser.add_argument('--seed', type=int, default=0, help="random seed, default=0")
+    parser.add_argument('--max-size', type=int, default=300, dest='max_size', help="maximum product size, default=300")
+    parser.add_argument('--p3-targets', type=int, default=200, dest='p3_targets', help="targets designed by the primer3 stage, default=200")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="primer3 worker processes, default=1")
+    parser.add_argument('--melt-amplicons', type=int, default=2000, dest='melt_amplicons', help="amplicons for the local melt and Tm stages, default=2000")
+    parser.add_argument('--umelt-amplicons', type=int, default=500, dest='umelt_amplicons', help="amplicons for the uMelt client stage, default=500")
+    parser.add_argument('--umelt-delay', type=float, default=0.02, dest='umelt_delay', help="stand-in server latency in seconds, default=0.02")
+    parser.add_argument('--melt-workers', type=int, default=8, dest='melt_workers', help="concurrent uMelt requests, default=8")
+    parser.add_argument('--multiplex-pairs', type=int, default=500, dest='multiplex_pairs', help="primer pairs for the multiplex stage, default=500")
+    parser.add_argument('--repeat', type=int, default=3, help="time each stage this many times and keep the best, default=3")
+    parser.add_argument('--workdir', default=None, help="directory for generated data, default a temporary one")
+    parser.add_argument('-o', '--output', default=None, help="write results as JSON to this file")
+    parser.add_argument('--baseline', default=None, help="compare with results JSON from an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="slowdown over the baseline counted as a regression, default=0.2")
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    args = parse_args(sys.argv[1:] if arguments is None else arguments)
+    keep = args.workdir is not None
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='pcr_bench_')
+    try:
+        results = run(args)
+    finally:
+        if not keep:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+    report = io.StringIO()
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        report.write('{0:<26}{1:>12}{2:>12}{3:>8}  {4}\n'.format('stage', 'seconds', 'baseline', 'ratio', 'status'))
+        for stage, seconds, base, ratio, verdict in compare(results, baseline, args.tolerance):
+            report.write('{0:<26}{1:>12.4f}{2:>12}{3:>8}  {4}\n'.format(
+                stage, seconds, '-' if base is None else '{0:.4f}'.format(base),
+                '-' if ratio is None else '{0:.2f}'.format(ratio), verdict))
+            if verdict == 'regression':
+                status = 1
+    else:
+        report.write('{0:<26}{1:>12}{2:>10}{3:>14}\n'.format('stage', 'seconds', 'items', 'items/s'))
+        for stage, result in sorted(results['stages'].items()):
+            report.write('{0:<26}{1:>12.4f}{2:>10}{3:>14.1f}\n'.format(stage, result['seconds'], result['items'],
+                                                                        result['per_second'] or 0))
+    sys.stdout.write(report.getvalue())
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Synthetic benchmark data
+------------------------
+
+Generators for a random reference (FASTA with .fai), variants at a chosen
+density written as a samtools-style GFF and as a bgzipped, tabix-indexed
+VCF, and target lists for design_primers.py (GFF IDs) and VcfPrimerDesign
+(BED). Everything is reproducible from a seed.
+"""
+
+import math
+import os
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+Variant = namedtuple('Variant', ['chrom', 'start', 'ref', 'alt', 'kind'])
+
+Dataset = namedtuple('Dataset', ['fasta', 'gff', 'vcf', 'targets', 'bed', 'sequences', 'variants', 'target_variants'])
+
+
+def random_sequence(rng, length):
+    """A uniformly random ACGT sequence"""
+    return BASES[rng.integers(0, 4, length)].tobytes().decode('ascii')
+
+
+def write_fasta(path, sequences, line_width=60):
+    """Write sequences (an ordered name to sequence mapping) as FASTA
+    with a samtools-style .fai index alongside.
+    """
+    with open(path, 'w') as fasta, open(path + '.fai', 'w') as fai:
+        offset = 0
+        for name, seq in sequences.items():
+            header = '>{0}\n'.format(name)
+            offset += len(header)
+            lines = [seq[i:i + line_width] for i in range(0, len(seq), line_width)]
+            body = '\n'.join(lines) + '\n'
+            fasta.write(header + body)
+            fai.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(name, len(seq), offset, line_width, line_width + 1))
+            offset += len(body)
+    return path
+
+
+def make_variants(rng, sequences, snp_density=0.002, indel_fraction=0.1):
+    """Variants at about snp_density per base, at least 3 bp apart,
+    indel_fraction of them short insertions or deletions.
+    """
+    variants = []
+    for name, seq in sequences.items():
+        count = int(len(seq) * snp_density)
+        ## keep clear of the sequence ends and of each other
+        positions = np.unique(rng.integers(10, len(seq) - 10, count) // 3 * 3)
+        kinds = rng.random(positions.size) < indel_fraction
+        for pos, indel in zip(positions.tolist(), kinds.tolist()):
+            ref = seq[pos]
+            if indel and rng.random() < 0.5:
+                variants.append(Variant(name, pos, ref, ref + random_sequence(rng, int(rng.integers(1, 4))), 'INDEL'))
+            elif indel:
+                variants.append(Variant(name, pos, seq[pos:pos + 2], ref, 'INDEL'))
+            else:
+                alt = 'ACGT'.replace(ref, '')[int(rng.integers(0, 3))]
+                variants.append(Variant(name, pos, ref, alt, 'SNP'))
+    return variants
+
+
+def variant_id(variant):
+    return '{0}:SYNTH:{1}:{2}'.format(variant.chrom, variant.kind, variant.start + 1)
+
+
+def write_gff(path, variants):
+    """Variants as samtools-style GFF features, spanning POS to POS+1"""
+    with open(path, 'w') as handle:
+        for X in variants:
+            handle.write('\t'.join((X.chrom, 'SYNTH', X.kind, str(X.start + 1), str(X.start + 2), '999', '.', '.',
+                                    'ID={0};Variant_seq={1};Reference_seq={2}'.format(variant_id(X), X.alt, X.ref))) + '\n')
+    return path
+
+
+def write_vcf(path, variants, sequences):
+    """Variants as a bgzipped, tabix-indexed VCF with one heterozygous
+    sample; returns its path
+    """
+    import pysam
+    with open(path, 'w') as handle:
+        handle.write('##fileformat=VCFv4.2\n')
+        for name, seq in sequences.items():
+            handle.write('##contig=<ID={0},length={1}>\n'.format(name, len(seq)))
+        handle.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        handle.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSYNTH\n')
+        for X in variants:
+            handle.write('\t'.join((X.chrom, str(X.start + 1), '.', X.ref, X.alt, '999', 'PASS', '.', 'GT', '0/1')) + '\n')
+    return pysam.tabix_index(path, preset='vcf', force=True)
+
+
+def write_targets(path, variants):
+    """Target IDs for design_primers.py -T"""
+    with open(path, 'w') as handle:
+        handle.write(''.join(variant_id(X) + '\n' for X in variants))
+    return path
+
+
+def write_bed(path, variants):
+    """Targets as BED intervals for VcfPrimerDesign"""
+    with open(path, 'w') as handle:
+        handle.write(''.join('{0}\t{1}\t{2}\n'.format(X.chrom, X.start, X.start + 1) for X in variants))
+    return path
+
+
+def make_dataset(directory, n_targets=1000, snp_density=0.002, seq_len=1000000, seed=0):
+    """Write a reference with enough variants for n_targets SNP targets
+    into directory, and return the file names as a Dataset.
+    """
+    rng = np.random.default_rng(seed)
+    ## about half the variants become targets
+    genome_len = max(int(2.2 * n_targets / snp_density), 10000)
+    n_seqs = int(math.ceil(genome_len / float(seq_len)))
+    sequences = OrderedDict(('chr{0}'.format(i + 1), random_sequence(rng, min(seq_len, genome_len)))
+                            for i in range(n_seqs))
+    variants = make_variants(rng, sequences, snp_density)
+    snps = [X for X in variants if X.kind == 'SNP']
+    chosen = np.sort(rng.choice(len(snps), min(n_targets, len(snps)), replace=False))
+    target_variants = [snps[i] for i in chosen]
+    return Dataset(fasta=write_fasta(os.path.join(directory, 'genome.fasta'), sequences),
+                   gff=write_gff(os.path.join(directory, 'variants.gff'), variants),
+                   vcf=write_vcf(os.path.join(directory, 'variants.vcf'), variants, sequences),
+                   targets=write_targets(os.path.join(directory, 'targets'), target_variants),
+                   bed=write_bed(os.path.join(directory, 'targets.bed'), target_variants),
+                   sequences=sequences, variants=variants, target_variants=target_variants)
@@ -26,12 +26,19 @@ import os
 import re
 import copy
 import sys
-from BCBio import GFF
-from BCBio.GFF import GFFExaminer
-from Bio import SeqIO
-from pcr_marker_design import run_p3 as P3
-from pcr_marker_design import umelt_service as um
+import time
+import bisect
+import itertools
+import multiprocessing
+from collections import OrderedDict, namedtuple
+from pcr_marker_design import output
+from pcr_marker_design import metrics
+from pcr_marker_design import shard
+from pcr_marker_design import clusters
+from pcr_marker_design.journal import Journal, read_journal, run_digest
 import argparse
+##Biopython, numpy and primer3, through the design and melt modules, and the variant and
+##specificity modules are imported where they are used, to keep startup short
 
 
 # parse arguments
@@ -48,8 +55,15 @@ def parse_args(arguments):
     parser = argparse.ArgumentParser(description='Primer set design and melt prediction parameters')
     parser.add_argument('-i', type=argparse.FileType('r'), help="input sequence file, required", dest='in_file', required=True)
     parser.add_argument('-g', type=argparse.FileType('r'), help="input gff file with SNP and indels, required", dest='gff_file', required=True)
-    parser.add_argument('-T', type=argparse.FileType('r'), help="input target SNP file, required", dest='target_file', required=True)
+    parser.add_argument('-T', type=argparse.FileType('r'), help="input target SNP file, required unless --shard-manifest is given", dest='target_file', default=None)
     parser.add_argument('-u',  help="do uMelt prediction, optional", dest='run_uMelt',action='store_true', default=False )
+    parser.add_argument('--melt-cache', type=str, help="melt cache database, reused across runs, optional", dest='melt_cache', default=None)
+    parser.add_argument('--melt-cache-size', type=float, help="melt cache size limit in MB, least recently used entries are evicted, optional", dest='melt_cache_size', default=None)
+    parser.add_argument('--umelt-url', type=str, help="uMelt service URL, default is the University of Utah service", dest='umelt_url', default=None)
+    parser.add_argument('--melt-workers', type=int, help="concurrent uMelt requests, default=8", dest='melt_workers', default=8)
+    ##umelt_service.MELT_BACKENDS, named here so that --help does not import numpy
+    parser.add_argument('--melt-backend', choices=('umelt', 'local'), help="melt prediction backend for -u: the uMelt web service or a local model, default=umelt", dest='melt_backend', default='umelt')
+    parser.add_argument('--hrm-top', type=int, help="keep the N primer pairs per target whose alleles HRM tells apart best, on Tm, normalised curve and melt peak width differences together; needs -u, optional", dest='hrm_top', default=None)
     parser.add_argument('-n', type=int, help="maximum number of primer pairs to return, default=5", dest='max_primers', default=5) ## PRIMER_NUM_RETURN
     parser.add_argument('-p', type=int, help="minimum product size", dest='prod_min_size', default=100)                             ## PRIMER_PRODUCT_SIZE_RANGE min
     parser.add_argument('-P', type=int, help="maximum product size", dest='prod_max_size', default=300)                            ## PRIMER_PRODUCT_SIZE_RANGE max
@@ -66,15 +80,304 @@ def parse_args(arguments):
     parser.add_argument('-mingc', type=float, help="Minimum allowable percentage of Gs and Cs in any primer.", dest='mingc', default=20.0)                     ## PRIMER_MIN_GC
 
 
-    parser.add_argument('-d', type=str, help="variant indentifier delimiter, used to separate sequence ID from rest ", dest='target_delim', default=':')
+    parser.add_argument('-d', type=str, help="variant indentifier delimiter, used to separate sequence ID from rest, default=':', or that of the --shard-manifest", dest='target_delim', default=None)
+    parser.add_argument('--p3-cache', type=str, help="primer3 design cache database, reused across runs, optional", dest='p3_cache', default=None)
+    parser.add_argument('-j', '--jobs', type=int, help="number of primer3 worker processes, 0 for all CPUs, default=1", dest='jobs', default=1)
+    parser.add_argument('-o', '--output', type=str, help="output file, default is standard output", dest='output', default=None)
+    parser.add_argument('--format', choices=output.FORMATS, help="output format, default is text, or as implied by the -o file extension", dest='format', default=None)
+    parser.add_argument('--journal', type=str, help="journal of completed targets and their results, for resuming, optional", dest='journal', default=None)
+    parser.add_argument('--metrics', type=str, help="write per-stage timings, counters and latency histograms as JSON to this file, optional", dest='metrics', default=None)
+    parser.add_argument('--progress', type=float, help="report progress and ETA on stderr every this many seconds, optional", dest='progress', default=None)
+    parser.add_argument('--resume', help="skip targets already completed in the --journal, replaying their results", dest='resume', action='store_true', default=False)
+    parser.add_argument('--shard-manifest', type=str, help="design one shard of a run split by shard_primers.py split, instead of -T; needs -o", dest='shard_manifest', default=None)
+    parser.add_argument('--specificity-index', type=str, help="reference k-mer index directory for off-target checks, built from -i on first use, optional", dest='specificity_index', default=None)
+    parser.add_argument('--specificity-k', type=int, help="3' end k-mer length of the specificity index, default=12", dest='specificity_k', default=12)
+    parser.add_argument('--off-target-size', type=int, help="longest off-target product to look for, default=1000", dest='off_target_size', default=1000)
+    parser.add_argument('--max-off-target', type=int, help="off-target products a primer pair may have, default=0", dest='max_off_target', default=0)
+    parser.add_argument('--pipeline', help="run primer3 and melting as concurrent stages, so primer3 on -j worker processes overlaps melt requests, optional", dest='pipeline', action='store_true', default=False)
+    parser.add_argument('--melt-targets', type=int, help="design windows melted at once with --pipeline, default=4", dest='melt_targets', default=4)
+    parser.add_argument('--pipeline-queue', type=int, help="design windows queued between --pipeline stages, default=4", dest='pipeline_queue', default=4)
+    parser.add_argument('--unordered', help="with --pipeline, write each target's rows as soon as they are ready, not in target order", dest='unordered', action='store_true', default=False)
+    parser.add_argument('--shard-index', type=int, help="index of the shard to design, from 0", dest='shard_index', default=None)
+    parser.add_argument('--cluster', type=int, help="design targets on one sequence within this many bp of each other on one shared window, at most -P, optional", dest='cluster_span', default=None)
+    parser.add_argument('--cluster-report', type=str, help="write the targets each primer pair of a cluster covers, as tab separated text, to this file, optional", dest='cluster_report', default=None)
     try:
             arguments = parser.parse_args(arguments)
     except SystemExit:
             print("\nOops, an argument is missing/invalid, exiting...\n")
             #sys.exit(0)
+    ##a new specificity index is built from the -i file, which standard input cannot give again
+    if getattr(arguments, 'specificity_index', None) and not os.path.isfile(getattr(arguments.in_file, 'name', None) or '') \
+            and not os.path.exists(os.path.join(arguments.specificity_index, 'meta.json')):
+        parser.error("--specificity-index {0} does not exist, and can only be built from an -i fasta file, "
+                     "not standard input".format(arguments.specificity_index))
     return arguments
 
 
+## options that change how a run goes, not the rows it gives, so may differ when it is resumed
+_RUN_OPTIONS = frozenset(['target_file', 'target_delim', 'jobs', 'output', 'format', 'journal', 'metrics',
+                          'progress', 'resume', 'shard_manifest', 'shard_index', 'pipeline', 'melt_targets',
+                          'pipeline_queue', 'unordered', 'melt_workers', 'melt_cache', 'melt_cache_size',
+                          'cluster_report'])
+
+
+def journal_digest(arguments, targets):
+    """
+    Digest of the inputs and settings that decide a run's rows, to tie its journal to it.
+
+    :param arguments: An :class:`argparse.ArgumentParser` object with arguments for primer design
+    :type arguments: :class:`argparse.ArgumentParser`
+    :param targets: The target IDs of the run
+    :type targets: list[str]
+
+    :return: A hex digest, as :func:`pcr_marker_design.journal.run_digest` gives
+    :rtype: str
+    """
+    settings = dict((X, Y) for X, Y in vars(arguments).items() if X not in _RUN_OPTIONS)
+    for name in ('in_file', 'gff_file'):
+        path = getattr(settings[name], 'name', None) or ''
+        ##a changed file is told by its size and modification time, a pipe only by its name
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            settings[name] = [os.path.abspath(path), stat.st_size, stat.st_mtime]
+        else:
+            settings[name] = [path]
+    settings['targets'] = list(targets)
+    return run_digest(settings)
+
+
+class FeatureIndex(object):
+    """
+    GFF features of a single sequence, indexed by ID and by start position.
+
+    :param features: The features annotated on the sequence, in GFF order
+    :type features: list[:class:`Bio.SeqFeature.SeqFeature`]
+    """
+
+    def __init__(self, features):
+        self.by_id = {}
+        for f in features:
+            self.by_id.setdefault(f.id, f)
+        ##keep GFF order as a tie-break so windows list features as a sliced SeqRecord would
+        order = sorted(range(len(features)), key=lambda i: (int(features[i].location.start), i))
+        self.features = [features[i] for i in order]
+        self.order = order
+        self.starts = [int(f.location.start) for f in self.features]
+
+    def get(self, feature_id):
+        """
+        Look up a feature by ID.
+
+        :param feature_id: The ID of the feature
+        :type feature_id: str
+
+        :return: The first feature with that ID, or None
+        :rtype: :class:`Bio.SeqFeature.SeqFeature`
+        """
+        return self.by_id.get(feature_id)
+
+    def features_in(self, start, end):
+        """
+        Features lying wholly within a window.
+
+        :param start: zero-based start of the window
+        :type start: int
+        :param end: zero-based, exclusive end of the window
+        :type end: int
+
+        :return: The features within the window, in GFF order
+        :rtype: list[:class:`Bio.SeqFeature.SeqFeature`]
+        """
+        first = bisect.bisect_left(self.starts, start)
+        last = bisect.bisect_left(self.starts, end)
+        hits = [i for i in range(first, last) if int(self.features[i].location.end) <= end]
+        hits.sort(key=lambda i: self.order[i])
+        return [self.features[i] for i in hits]
+
+
+def group_targets(targets, target_delim):
+    """
+    Group target IDs by the ID of the sequence they are on.
+
+    :param targets: Target IDs, e.g. ABC:SNP:SAMTOOL:1234
+    :type targets: list[str]
+    :param target_delim: Delimiter separating the sequence ID from the rest of the target ID
+    :type target_delim: str
+
+    :return: An ordered dict of sequence ID to target IDs, both in input order
+    :rtype: :class:`collections.OrderedDict`
+    """
+    targets_by_seq = OrderedDict()
+    for target in targets:
+        targets_by_seq.setdefault(re.split(target_delim, target)[0], []).append(target)
+    return targets_by_seq
+
+
+def index_gff_features(gff_file, seq_ids):
+    """
+    Read GFF annotations for the given sequences in a single pass.
+
+    :param gff_file: An open GFF file
+    :type gff_file: file
+    :param seq_ids: IDs of the sequences to keep annotations for
+    :type seq_ids: iterable[str]
+
+    :return: A dict of sequence ID to :class:`FeatureIndex`
+    :rtype: dict[str, :class:`FeatureIndex`]
+    """
+    limit_info = dict(gff_id=list(seq_ids))
+    if not limit_info['gff_id']:
+        return {}
+    from BCBio import GFF
+    return dict((rec.id, FeatureIndex(rec.features))
+                for rec in GFF.parse(gff_file, limit_info=limit_info) if rec.features)
+
+
+TargetWindow = namedtuple('TargetWindow', ['target', 'position', 'slice_start', 'target_start',
+                                           'template', 'exclude_feat', 'target_dict'])
+
+ClusterWindow = namedtuple('ClusterWindow', ['windows', 'slice_start', 'template', 'features',
+                                             'target_dict', 'regions'])
+
+
+def reference_sequences(in_file, seq_ids):
+    """
+    The reference sequences wanted, in file order, without reading them whole.
+
+    A fasta file is read through its .fai index (built by pyfaidx if need be), so only
+    the slices fetched are read from disk. Input that is not a regular file, such as
+    a pipe, is parsed record by record instead.
+
+    :param in_file: An open fasta file
+    :type in_file: file
+    :param seq_ids: IDs of the sequences wanted
+    :type seq_ids: container[str]
+
+    :return: A generator object that yields (sequence ID, length, fetch) per wanted sequence, where
+             fetch(start, end) returns the zero-based slice [start, end) as a string, while the generator runs
+    :rtype: generator[tuple]
+    """
+    if os.path.isfile(getattr(in_file, 'name', '')):
+        from pyfaidx import Fasta
+        reference = Fasta(in_file.name, as_raw=True)
+        try:
+            for seq_id in reference.keys():
+                if seq_id in seq_ids:
+                    record = reference[seq_id]
+                    yield seq_id, len(record), lambda start, end, record=record: record[start:end]
+        finally:
+            reference.close()
+        return
+    from Bio import SeqIO
+    for myrec in SeqIO.parse(in_file, "fasta"):
+        if myrec.id in seq_ids:
+            seq = str(myrec.seq)
+            yield myrec.id, len(seq), lambda start, end, seq=seq: seq[start:end]
+
+
+def target_windows(in_file, targets_by_seq, gff_index, prod_max_size):
+    """
+    Cut a design window around each target and build its primer3 target dictionary.
+
+    :param in_file: An open fasta file
+    :type in_file: file
+    :param targets_by_seq: Target IDs grouped by sequence ID, as from :func:`group_targets`
+    :type targets_by_seq: dict[str, list[str]]
+    :param gff_index: Annotations by sequence ID, as from :func:`index_gff_features`
+    :type gff_index: dict[str, :class:`FeatureIndex`]
+    :param prod_max_size: Maximum product size, the window extends this far either side of a target
+    :type prod_max_size: int
+
+    :return: A generator object that yields a :class:`TargetWindow` per target, in sequence then target order
+    :rtype: generator[:class:`TargetWindow`]
+    """
+    ##read only the windows needed from an indexed reference
+    for seq_id, seq_len, fetch in reference_sequences(in_file, targets_by_seq):
+        #check if this sequence has annotations
+        if seq_id not in gff_index:
+            continue
+        feature_index = gff_index[seq_id]
+        ##iterate over the target IDs on this sequence only
+        for target_ID in targets_by_seq[seq_id]:
+            mytarget = feature_index.get(target_ID)
+            if mytarget is None:
+                continue
+            #just consider slice of sequence in a window of +/- prod_max_size  bp
+            ##from feature UNLESS feature is close to end
+            ##Note that slice is zero-based
+            featLocation = int(mytarget.location.start)
+            if featLocation > prod_max_size:
+                slice_start = featLocation - prod_max_size
+            else:
+                slice_start = 0
+            if (seq_len - featLocation) <  prod_max_size:
+                slice_end = seq_len
+            else:
+                slice_end = featLocation + prod_max_size
+            ###grab the features lying wholly within this window
+            window_feat = feature_index.features_in(slice_start, slice_end)
+            if not any(f is mytarget for f in window_feat):
+                continue
+            target_start = featLocation - slice_start
+            if target_start == 0:
+                target_start = 1
+            #get the mask features by removing  target...all features are masked as just using snp and indels, a smarter filter could be added
+            exclude_feat = [f for f in window_feat if f is not mytarget]
+            amp_seq = fetch(slice_start, slice_end)
+            my_target_dict={'SEQUENCE_ID' : seq_id,\
+                         'SEQUENCE_TEMPLATE': amp_seq.upper(),\
+                         'SEQUENCE_TARGET': [target_start,1],\
+                         'SEQUENCE_EXCLUDED_REGION': [[int(x.location.start) - slice_start, len(x.location)] for x in exclude_feat]}
+            yield TargetWindow(mytarget, featLocation, slice_start, target_start, amp_seq, exclude_feat, my_target_dict)
+
+
+def cluster_window(windows, num_return=None):
+    """
+    Join the windows of nearby targets into one design window with a primer3 target per target.
+
+    :param windows: Target windows on one sequence whose targets are within a product size of each other
+    :type windows: list[:class:`TargetWindow`]
+    :param num_return: Primer pairs to ask primer3 for per target
+    :type num_return: int
+
+    :return: The shared window, where regions holds each target's SEQUENCE_TARGET regions on it. A single
+             window is returned as it is, with its own target dictionary
+    :rtype: :class:`ClusterWindow`
+    """
+    if len(windows) == 1:
+        window = windows[0]
+        return ClusterWindow(windows, window.slice_start, window.template, [window.target] + window.exclude_feat,
+                             window.target_dict, [[(window.target_start, 1)]])
+    offsets = [w.slice_start for w in windows]
+    template, slice_start = clusters.join_templates([w.template for w in windows], offsets)
+    target_dict, _, regions = clusters.merge_target_dicts([w.target_dict for w in windows], offsets,
+                                                          num_return=num_return)
+    ##each variant once, targets first, as a single window lists them
+    features = list(OrderedDict((id(f), f) for w in windows for f in [w.target] + w.exclude_feat).values())
+    return ClusterWindow(windows, slice_start, template, features, target_dict, regions)
+
+
+def variant_span(feature, offset=0):
+    """
+    The edit a variant feature makes to the reference.
+
+    :param feature: A GFF variant feature with a Variant_seq qualifier
+    :type feature: :class:`Bio.SeqFeature.SeqFeature`
+    :param offset: Position of the window the span is relative to
+    :type offset: int
+
+    :return: (start, end, alt) replacing [start, end) with the first variant allele. The span covers the
+             Reference_seq allele where given, as samtools GFF features extend a base past it
+    :rtype: tuple
+    """
+    start = int(feature.location.start) - offset
+    if 'Reference_seq' in feature.qualifiers:
+        end = start + len(feature.qualifiers['Reference_seq'][0])
+    else:
+        end = int(feature.location.end) - offset
+    return start, end, feature.qualifiers['Variant_seq'][0]
+
+
 def design_primers(arguments):
     """
     Design primers.
@@ -86,6 +389,22 @@ def design_primers(arguments):
     :return: A generator object that yields a header and primers strings
     :rtype: generator[str]
     """
+    yield ' '.join(output.COLUMNS)
+    for row in design_primer_rows(arguments):
+        yield ' '.join(str(i) for i in row)
+
+
+def design_primer_rows(arguments):
+    """
+    Design primers, yielding result rows as they are produced.
+
+
+    :param arguments: An :class:`argparse.ArgumentParser` object with arguments for primer design
+    :type arguments: :class:`argparse.ArgumentParser`
+
+    :return: A generator object that yields a tuple of values per primer pair, in :data:`pcr_marker_design.output.COLUMNS` order
+    :rtype: generator[tuple]
+    """
     ##Primer3 defaults or additional options defined as dictionary
     def_dict={
     'PRIMER_MIN_SIZE':18 ,
@@ -111,123 +430,402 @@ def design_primers(arguments):
 
 
 
+    if arguments.hrm_top and not arguments.run_uMelt:
+        raise ValueError("--hrm-top ranks pairs by their melts, so needs -u")
+    if arguments.unordered and arguments.shard_manifest:
+        raise ValueError("shards are merged in target order, so --unordered cannot be used with --shard-manifest")
+
+    if arguments.metrics:
+        metrics.reset()
+        metrics.enable()
+
     ##conditional import of umelt
+    umelt = None
     if arguments.run_uMelt:
         from pcr_marker_design import umelt_service as um
+        melt_cache = None
+        if arguments.melt_cache:
+            from pcr_marker_design.melt_cache import MeltCache
+            max_bytes = None if arguments.melt_cache_size is None else int(arguments.melt_cache_size * 1e6)
+            melt_cache = MeltCache(arguments.melt_cache, max_bytes=max_bytes)
+        options = dict(max_workers=arguments.melt_workers) if arguments.melt_backend == 'umelt' else {}
+        if options and arguments.umelt_url:
+            options['url'] = arguments.umelt_url
+        umelt = um.melt_service(arguments.melt_backend, cache=melt_cache, **options)
 
     #open input files
 
-    targets=[line.rstrip() for line in arguments.target_file.readlines()]
-    arguments.target_file.close()
-    ##and create a hit list of sequences from this
-    target_seq_id_list = [re.split(arguments.target_delim, X)[0] for X in targets] ## target_delimiter defaults to ':'  e.g. ABC:SNP:SAMTOOL:1234
-
-    # yield header string
-    yield ' '.join(("SNP_Target_ID", "Position","Ref_base","Variant_base" ,"Amplicon_bp","PRIMER_LEFT_SEQUENCE",'PRIMER_RIGHT_SEQUENCE', "ref_melt_Tm","var_melt_Tm","Tm_difference"))
-
-    ##create iterator returning sequence records
-    for myrec in SeqIO.parse(arguments.in_file, "fasta"):
-        #check if this sequence is included in the target list
-        if myrec.id in target_seq_id_list:
-            ##create sequence dictionary so we can add in gff annotations
-            seq_dict = {myrec.id : myrec}
-            ##just limit to gff annotations for this sequence
-            limit_info = dict(gff_id = [ myrec.id ])
-            ##rewind gff filehandle
-            arguments.gff_file.seek(0)
-            ##read annotations into sequence dictionary for this sequence record only
-            annotations = [r for r in GFF.parse(arguments.gff_file, base_dict=seq_dict, limit_info=limit_info)]
-            ##if there are any annotations, then  proceed.
-            if annotations:
-                rec=annotations[0]
-                ##iterate over list of target IDs
-                for t in targets:
-                    target_ID = t.strip('\n')
-                    target_annotations = [f for f in rec.features if f.id == target_ID ]
-                    if target_annotations:
-                        mytarget = target_annotations[0]
-                        #just consider slice of sequence in a window of +/- prod_max_size  bp
-                        ##from feature UNLESS feature is close to end
-                        ##Note that slice is zero-based
-                        featLocation = mytarget.location.start.position
-                        if featLocation > arguments.prod_max_size:
-                            slice_start = featLocation - arguments.prod_max_size
-                            featPosition =  arguments.prod_max_size
-                        else:
-                            slice_start = 0
-                            featPosition = featLocation
-                        if (len(rec) - featLocation) <  arguments.prod_max_size:
-                            slice_end = len(rec)
-                        else:
-                            slice_end = featLocation + arguments.prod_max_size
-                        ###grab slice of sequence fom this window.
-                        targetRec = rec[slice_start:slice_end]
-                        matching_feature = [f for f in targetRec.features if f.id == mytarget.id]
-                        if matching_feature:
-                            target_feat = matching_feature[0]
-                            my_target_dict={} # re-initialize target dictionary
-                            if target_feat.location.start.position == 0:
-                                target_feat.location.start.position = 1
-                            #get the mask features by removing  target...all features are masked as just using snp and indels, a smarter filter could be added
-                exclude_feat = list(targetRec.features) ##list copy to avoid possible side-effects
-                exclude_feat.remove(target_feat)
-                my_target_dict={'SEQUENCE_ID' : rec.name,\
-                             'SEQUENCE_TEMPLATE': targetRec.seq.tostring().upper(),\
-                             'SEQUENCE_TARGET': [target_feat.location.start.position,1],\
-                             'SEQUENCE_EXCLUDED_REGION': [[x.location.start.position,x.location.end.position -x.location.start.position] for x in exclude_feat]}
-                result=P3.run_P3(target_dict=my_target_dict,global_dict=def_dict)
-                if arguments.run_uMelt:
-                    amp_seq=targetRec.seq ##need to make this conditional on getting a result >0 and melt=True
-                    mutamp_seq=targetRec.seq.tomutable()
-                    mutamp_seq[target_feat.location.start:target_feat.location.end]=target_feat.qualifiers['Variant_seq'][0] #mutate to variant
-                    other_SNP=[f for f in targetRec.features if f.id != mytarget.id]
-                    if other_SNP:
-                        for snp in other_SNP:
-                            mutamp_seq[snp.location.start:snp.location.end]=snp.qualifiers['Variant_seq'][0]
-                for primerset in result:
-                    amp_start=int(primerset['PRIMER_LEFT'][0])
-                    amp_end=int(primerset['PRIMER_RIGHT'][0])
-                    ref_melt_Tm=0
-                    var_melt_Tm=0
-                    diff_melt=0
-                    if arguments.run_uMelt:
-                        try:
-                            umelt = um.UmeltService()
-                            refmelt= um.MeltSeq(amp_seq.tostring()[amp_start:amp_end+1])
-                            ref_melt_Tm=umelt.get_helicity_info(umelt.get_response(refmelt)).get_melting_temp()
-                            var_melt=um.MeltSeq(mutamp_seq.tostring()[amp_start:amp_end+1])
-                            var_melt_Tm=umelt.get_helicity_info(umelt.get_response(var_melt)).get_melting_temp()
-                            diff_melt=abs(ref_melt_Tm - var_melt_Tm)
-                        except:
-                            ref_melt_Tm="NA" ##preferably something more informative?
-                            var_melt_Tm="NA" ##exception handling to be added
-                            diff_melt="NA"
-                    if 'Reference_seq' in target_feat.qualifiers:
-                        reference_seq=target_feat.qualifiers['Reference_seq'][0]
-                    else:
-                        reference_seq="NA"
-                    if 'Variant_seq' in target_feat.qualifiers:
-                        variant_seq=target_feat.qualifiers['Variant_seq'][0]
-                    else:
-                        variant_seq="NA"
-
-                    # yield primer string
-                    yield ' '.join(str(i) for i in (mytarget.id, featLocation + 1 ,reference_seq, variant_seq,\
-                                    amp_end-amp_start,primerset['PRIMER_LEFT_SEQUENCE'],\
-                                    primerset['PRIMER_RIGHT_SEQUENCE'], ref_melt_Tm,var_melt_Tm,diff_melt))#, amp_seq.tostring()[amp_start:amp_end+1], mutamp_seq.tostring()[amp_start:amp_end+1]
+    if arguments.shard_manifest:
+        if arguments.shard_index is None:
+            raise ValueError("--shard-manifest needs --shard-index")
+        targets = shard.shard_targets(arguments.shard_manifest, arguments.shard_index)
+        ##a shard's target IDs are split as they were when the run was split
+        target_delim = shard.read_manifest(arguments.shard_manifest)['target_delim']
+        if arguments.target_delim not in (None, target_delim):
+            raise ValueError("-d {0!r} differs from the shard manifest's delimiter {1!r}".format(
+                arguments.target_delim, target_delim))
+    elif arguments.target_file:
+        targets=[line.rstrip() for line in arguments.target_file.readlines()]
+        arguments.target_file.close()
+        target_delim = arguments.target_delim or ':'
+    else:
+        raise ValueError("give a target file with -T, or a shard with --shard-manifest")
+    ##and group the target IDs by the sequence they sit on
+    targets_by_seq = group_targets(targets, target_delim)
+
+    ##read annotations for all target sequences in a single pass of the gff
+    with metrics.timer('gff_index'):
+        gff_index = index_gff_features(arguments.gff_file, targets_by_seq.keys())
+    progress = metrics.Progress(len(targets), arguments.progress) if arguments.progress else None
+
+    ##pairs priming elsewhere in the reference are dropped, against an index built once
+    specificity = None
+    if arguments.specificity_index:
+        from pcr_marker_design.specificity import KmerIndex, screen_pairs
+        with metrics.timer('specificity_index'):
+            specificity = KmerIndex.open_or_build(arguments.in_file.name, arguments.specificity_index,
+                                                  arguments.specificity_k)
+
+    ##targets completed in the journal of an earlier run are replayed, not redesigned
+    journal = None
+    completed = {}
+    if arguments.resume and not arguments.journal:
+        raise ValueError("--resume needs the --journal of the run to resume")
+    if arguments.journal:
+        run = journal_digest(arguments, targets)
+        if arguments.resume:
+            completed = read_journal(arguments.journal, run)
+        journal = Journal(arguments.journal, resume=arguments.resume, run=run)
+
+    ##extract design windows lazily, grouping nearby targets onto shared windows if asked
+    windows = metrics.timed_iter('windows', target_windows(
+        arguments.in_file, targets_by_seq, gff_index, arguments.prod_max_size))
+    if arguments.cluster_span:
+        if arguments.cluster_span > arguments.prod_max_size:
+            raise ValueError("--cluster must be at most the maximum product size, -P")
+        groups = clusters.group_nearby(windows, lambda w: w.target_dict['SEQUENCE_ID'], lambda w: w.position,
+                                       arguments.cluster_span)
+    else:
+        groups = ([w] for w in windows)
+    cluster_windows = (cluster_window(X, arguments.max_primers + 1) for X in groups)
+    from pcr_marker_design import run_p3 as P3
+    design_cache = P3.DesignCache(path=arguments.p3_cache)
+    session = P3.DesignSession(def_dict, design_cache)
+
+    def screen(result, cluster):
+        if specificity is None:
+            return result
+        with metrics.timer('specificity'):
+            screened = screen_pairs(specificity, cluster.target_dict['SEQUENCE_ID'], cluster.slice_start, result,
+                                    arguments.off_target_size, arguments.max_off_target)
+        metrics.count('pairs_off_target', len(result) - len(screened))
+        return screened
+
+    report = open(arguments.cluster_report, 'w') if arguments.cluster_report else None
+    started = time.perf_counter()
+
+    def emit(cluster, result, rows):
+        nonlocal started
+        ##targets' rows are journalled and counted as they are output
+        if len(cluster.windows) > 1:
+            metrics.count('clusters')
+            metrics.count('clustered_targets', len(cluster.windows))
+            if report is not None:
+                _report_cluster(report, cluster, result or [])
+        for window, target_rows in zip(cluster.windows, rows):
+            if progress is not None:
+                progress.update()
+            if target_rows is None:
+                metrics.count('targets_resumed')
+                target_rows = completed[window.target.id]
+            else:
+                if journal is not None:
+                    journal.record(window.target.id, target_rows)
+                metrics.observe('target_seconds', time.perf_counter() - started)
+                metrics.count('targets')
+                metrics.count('primer_pairs', len(target_rows))
+            for row in target_rows:
+                yield row
+            started = time.perf_counter()
+
+    try:
+        if report is not None:
+            report.write('SEQUENCE_ID\tPRIMER_LEFT_SEQUENCE\tPRIMER_RIGHT_SEQUENCE\tAmplicon_bp\tSNP_Target_IDs\n')
+        if arguments.pipeline:
+            rows = _pipeline_rows(arguments, umelt, cluster_windows, session, screen, completed)
+        else:
+            rows = _serial_rows(arguments, umelt, cluster_windows, session, screen, completed)
+        for cluster, result, target_rows in rows:
+            for row in emit(cluster, result, target_rows):
+                yield row
+    finally:
+        if report is not None:
+            report.close()
+        if journal is not None:
+            journal.close()
+        if umelt is not None:
+            umelt.close()
+        if progress is not None:
+            progress.report()
+        if arguments.metrics:
+            metrics.METRICS.dump(arguments.metrics)
+            metrics.disable()
 
     arguments.gff_file.close()
     arguments.in_file.close()
 
 
-def main():
+def _serial_rows(arguments, umelt, cluster_windows, session, screen, completed):
+    """
+    Design and melt the targets of each design window in turn, running primer3
+    ahead on -j worker processes.
+
+    :param arguments: An :class:`argparse.ArgumentParser` object with arguments for primer design
+    :type arguments: :class:`argparse.ArgumentParser`
+    :param umelt: The melt service, or None if not melting
+    :type umelt: :class:`pcr_marker_design.umelt_service.UmeltService`
+    :param cluster_windows: The design windows
+    :type cluster_windows: iterator[:class:`ClusterWindow`]
+    :param session: The primer3 design session
+    :type session: :class:`pcr_marker_design.run_p3.DesignSession`
+    :param screen: Specificity screen, called with the pairs and the window they were designed on
+    :type screen: function
+    :param completed: Rows of targets completed by an earlier run, by target ID
+    :type completed: dict[str, list[tuple]]
+
+    :return: A generator of (window, primer3 pairs, rows of each target or None if completed), in window order
+    :rtype: generator[tuple]
+    """
+    cluster_windows, p3_windows = itertools.tee(cluster_windows)
+    results = session.design_many((c.target_dict for c in p3_windows
+                                   if any(w.target.id not in completed for w in c.windows)),
+                                  jobs=arguments.jobs)
+    for cluster in cluster_windows:
+        result = None
+        if any(w.target.id not in completed for w in cluster.windows):
+            result = screen(next(results), cluster)
+        kept = _window_pairs(cluster, result, completed, arguments.max_primers,
+                             lambda w: screen(session.design(w.target_dict), cluster_window([w])))
+        yield cluster, result, _cluster_rows(arguments, umelt, cluster, kept)
+
+
+def _pipeline_rows(arguments, umelt, cluster_windows, session, screen, completed):
+    """
+    Design and melt the targets of the design windows as concurrent stages: primer3
+    runs on -j worker processes while --melt-targets windows are melted at once, with
+    at most --pipeline-queue windows waiting between stages.
+
+    Parameters are as for :func:`_serial_rows`.
+
+    :return: A generator of (window, primer3 pairs, rows of each target or None if completed), in window
+             order unless --unordered
+    :rtype: generator[tuple]
+    """
+    from pcr_marker_design import pipeline
+    pool = session.pool(arguments.jobs)
+
+    def design(cluster):
+        result = None
+        if any(w.target.id not in completed for w in cluster.windows):
+            result = screen(session.design_in(pool, cluster.target_dict), cluster)
+        kept = _window_pairs(cluster, result, completed, arguments.max_primers,
+                             lambda w: screen(session.design_in(pool, w.target_dict), cluster_window([w])))
+        return cluster, result, kept
+
+    def melt(designed):
+        cluster, result, kept = designed
+        return cluster, result, _cluster_rows(arguments, umelt, cluster, kept)
+
+    stages = [pipeline.Stage('design', design, arguments.jobs or multiprocessing.cpu_count()),
+              pipeline.Stage('melt', melt, arguments.melt_targets)]
+    try:
+        for designed in pipeline.run_pipeline(cluster_windows, stages, ordered=not arguments.unordered,
+                                              queue_size=arguments.pipeline_queue):
+            yield designed
+    finally:
+        pool.shutdown()
+
+
+def _window_pairs(cluster, result, completed, per_target, design_own):
+    """
+    The primer pairs each target of a design window keeps.
+
+    :param cluster: The design window
+    :type cluster: :class:`ClusterWindow`
+    :param result: The primer pairs primer3 designed for the window, None if all its targets are completed
+    :type result: list[dict]
+    :param completed: Rows of targets completed by an earlier run, by target ID
+    :type completed: dict[str, list[tuple]]
+    :param per_target: The number of pairs each target of a shared window keeps
+    :type per_target: int
+    :param design_own: Designs a target on its own window, when no shared pair covers it
+    :type design_own: function
+
+    :return: For each target, its pairs and the shared window they were designed on, or None if
+             designed on its own window; None instead for a completed target
+    :rtype: list[tuple]
+    """
+    if len(cluster.windows) == 1:
+        return [None if cluster.windows[0].target.id in completed else (result, None)]
+    covering = clusters.covering_pairs(result or [], cluster.regions, per_target)
+    kept = []
+    for i, window in enumerate(cluster.windows):
+        if window.target.id in completed:
+            kept.append(None)
+        elif covering[i]:
+            kept.append(([result[X] for X in covering[i]], cluster))
+        else:
+            ##no shared pair covers this target, so it gets a window of its own
+            metrics.count('cluster_fallbacks')
+            kept.append((design_own(window), None))
+    return kept
+
+
+def _cluster_rows(arguments, umelt, cluster, kept):
+    """
+    Result rows for the targets of a design window.
+
+    :param arguments: An :class:`argparse.ArgumentParser` object with arguments for primer design
+    :type arguments: :class:`argparse.ArgumentParser`
+    :param umelt: The melt service, or None if not melting
+    :type umelt: :class:`pcr_marker_design.umelt_service.UmeltService`
+    :param cluster: The design window
+    :type cluster: :class:`ClusterWindow`
+    :param kept: The pairs each target keeps, as from :func:`_window_pairs`
+    :type kept: list[tuple]
+
+    :return: For each target, a list of result row tuples, or None if completed
+    :rtype: list[list[tuple]]
+    """
+    ##melts are shared by the targets of a cluster, which can have the same amplicons
+    melted = {}
+    return [None if pairs is None else _target_rows(arguments, umelt, window, pairs[0], pairs[1], melted)
+            for window, pairs in zip(cluster.windows, kept)]
+
+
+def _report_cluster(report, cluster, result):
+    """
+    Write the targets each primer pair designed on a shared window covers.
+
+    :param report: The open report file
+    :type report: file
+    :param cluster: The shared window
+    :type cluster: :class:`ClusterWindow`
+    :param result: The primer pairs primer3 designed for the window
+    :type result: list[dict]
+    """
+    for pair in result:
+        covered = [w.target.id for w, regions in zip(cluster.windows, cluster.regions) if clusters.covers(pair, regions)]
+        report.write('\t'.join((cluster.target_dict['SEQUENCE_ID'], pair['PRIMER_LEFT_SEQUENCE'],
+                                pair['PRIMER_RIGHT_SEQUENCE'],
+                                str(int(pair['PRIMER_RIGHT'][0]) - int(pair['PRIMER_LEFT'][0])),
+                                ','.join(covered))) + '\n')
+
+
+def _target_rows(arguments, umelt, window, result, cluster=None, melted=None):
+    """
+    Result rows for the primer pairs designed to one target window, with melt
+    predictions if requested.
+
+    :param arguments: An :class:`argparse.ArgumentParser` object with arguments for primer design
+    :type arguments: :class:`argparse.ArgumentParser`
+    :param umelt: The melt service, or None if not melting
+    :type umelt: :class:`pcr_marker_design.umelt_service.UmeltService`
+    :param window: The target window
+    :type window: :class:`TargetWindow`
+    :param result: The primer pairs primer3 designed for the window
+    :type result: list[dict]
+    :param cluster: The shared window result was designed on, if not the target's own
+    :type cluster: :class:`ClusterWindow`
+    :param melted: Helicity curves already predicted, by amplicon sequence, None for a failed melt;
+                   new predictions are added to it
+    :type melted: dict[str, numpy.ndarray]
+
+    :return: A list of result row tuples
+    :rtype: list[tuple]
+    """
+    mytarget = window.target
+    featLocation = window.position
+    if cluster is None:
+        cluster = cluster_window([window])
+    melted = {} if melted is None else melted
+    if arguments.run_uMelt:
+        from pcr_marker_design import hrm
+        from pcr_marker_design import umelt_service as um
+        from pcr_marker_design.variants import VariantWindow
+        ##apply the target and its neighbouring variants to the window once
+        variant_window = VariantWindow(str(cluster.template),
+                                       [variant_span(f, cluster.slice_start) for f in cluster.features])
+        amplicons = variant_window.amplicons([int(pair['PRIMER_LEFT'][0]) for pair in result],
+                                             [int(pair['PRIMER_RIGHT'][0]) + 1 for pair in result])
+        ##melt the ref and variant amplicons not melted yet in one concurrent batch
+        new = [X for X in OrderedDict.fromkeys(X for pair in amplicons for X in pair) if X not in melted]
+        with metrics.timer('melt'):
+            melts = umelt.melt_many([um.MeltSeq(X) for X in new])
+        melted.update((seq, melt.helicity_info.helicity_data if melt.ok else None) for seq, melt in zip(new, melts))
+        ##and score the pairs with both amplicons melted together
+        scored = [n for n, (ref, var) in enumerate(amplicons) if melted[ref] is not None and melted[var] is not None]
+        scores = hrm.score_pairs([melted[amplicons[n][0]] for n in scored], [melted[amplicons[n][1]] for n in scored])
+        score_of = dict((n, i) for i, n in enumerate(scored))
+    rows = []
+    for n, primerset in enumerate(result):
+        amp_start=int(primerset['PRIMER_LEFT'][0])
+        amp_end=int(primerset['PRIMER_RIGHT'][0])
+        ref_melt_Tm=0
+        var_melt_Tm=0
+        diff_melt=0
+        if arguments.run_uMelt:
+            if n in score_of:
+                i = score_of[n]
+                ref_melt_Tm, var_melt_Tm, diff_melt = scores.ref_tm[i], scores.var_tm[i], scores.delta_tm[i]
+            else:
+                ##melt failures are reported in MeltResult.error once retries are exhausted
+                metrics.count('pairs_not_melted')
+                ref_melt_Tm="NA"
+                var_melt_Tm="NA"
+                diff_melt="NA"
+        if 'Reference_seq' in mytarget.qualifiers:
+            reference_seq=mytarget.qualifiers['Reference_seq'][0]
+        else:
+            reference_seq="NA"
+        if 'Variant_seq' in mytarget.qualifiers:
+            variant_seq=mytarget.qualifiers['Variant_seq'][0]
+        else:
+            variant_seq="NA"
+
+        # add primer row
+        rows.append((mytarget.id, featLocation + 1 ,reference_seq, variant_seq,\
+                     amp_end-amp_start,primerset['PRIMER_LEFT_SEQUENCE'],\
+                     primerset['PRIMER_RIGHT_SEQUENCE'], ref_melt_Tm,var_melt_Tm,diff_melt))#, amp_seq[amp_start:amp_end+1], mutamp_seq[amp_start:amp_end+1]
+    if arguments.hrm_top:
+        ##keep the pairs whose alleles HRM tells apart best, pairs that failed to melt last
+        ranked = hrm.rank_pairs(scores)
+        order = [scored[i] for i in ranked] + [n for n in range(len(rows)) if n not in score_of]
+        rows = [rows[n] for n in order[:arguments.hrm_top]]
+    return rows
+
+
+def main(arguments=None):
     """
     Main function for running design_primers.py as a script.
-    Parses arguments from standard in and prints results to standard out.
+    Parses arguments from standard in and writes results, as they are produced,
+    to standard out or the -o file. A shard run marks its -o file complete
+    once every row is written.
+
+    :param arguments: Arguments to parse instead of the command line
+    :type arguments: list[str]
     """
-    arguments = parse_args(sys.argv[1:])
-    lines = design_primers(arguments)
-    print('\n'.join(lines))
+    arguments = parse_args(sys.argv[1:] if arguments is None else arguments)
+    if arguments.shard_manifest and arguments.output in (None, '-'):
+        raise ValueError("a shard run needs an output file, -o")
+    if arguments.shard_manifest and os.path.exists(arguments.output + '.done'):
+        ##a rerun of the shard is not complete until it finishes again
+        os.remove(arguments.output + '.done')
+    with output.open_writer(arguments.output, arguments.format) as writer:
+        for row in design_primer_rows(arguments):
+            writer.write(row)
+    if arguments.shard_manifest:
+        shard.write_done(arguments.output, arguments.shard_manifest, arguments.shard_index, writer.rows)
 
 if __name__ == '__main__':
     main()
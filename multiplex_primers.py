@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+##screen designed primer pairs for cross-pair primer dimers and assign them to multiplex pools
+#usage: multiplex_primers.py [-h] [--format FORMAT] [-o OUTPUT] [--conflicts CONFLICTS]
+#                            [--max-dg MAX_DG] [--pool-size POOL_SIZE] [-k KMER]
+#                            [--pairs-per-target N] [--salt SALT] [--dna-conc DNA_CONC]
+#                            [-j JOBS] [--metrics METRICS]
+#                            design_output
+
+#This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+import sys
+import argparse
+from pcr_marker_design import output
+from pcr_marker_design import metrics
+from pcr_marker_design import multiplex
+from pcr_marker_design import run_p3 as P3
+
+
+def parse_args(arguments):
+    """
+    CLI argument parsers for multiplex_primers.py.
+
+    :param arguments: A list of arguments to parse
+    :type arguments: list[str]
+
+    :return: The parsed arguments
+    :rtype: :class:`argparse.Namespace`
+    """
+    parser = argparse.ArgumentParser(description='Multiplex primer dimer screening and pool assignment')
+    parser.add_argument('design_output', type=str, help="design_primers.py output file")
+    parser.add_argument('--format', choices=output.FORMATS, help="format of the design output, default as implied by the file extension", dest='format', default=None)
+    parser.add_argument('-o', '--output', type=str, help="pool assignment as tab separated text, default is standard output", dest='output', default=None)
+    parser.add_argument('--conflicts', type=str, help="write the conflict graph as tab separated edges to this file, optional", dest='conflicts', default=None)
+    parser.add_argument('--max-dg', type=float, help="heterodimer dG, in kcal/mol, at or below which two pairs conflict, default=-9", dest='max_dg', default=-9.0)
+    parser.add_argument('--pool-size', type=int, help="maximum pairs per pool, default unlimited", dest='pool_size', default=None)
+    parser.add_argument('-k', type=int, help="3' end k-mer length of the dimer prefilter, default=5", dest='kmer', default=5)
+    parser.add_argument('--pairs-per-target', type=int, help="designed pairs per target to choose from when pooling, default=1", dest='pairs_per_target', default=1)
+    parser.add_argument('--salt', type=float, help="monovalent cation concentration of the dimer checks, in mM, default={0}, as primer3 designs with".format(P3.p3_globals['PRIMER_SALT_MONOVALENT']), dest='salt', default=P3.p3_globals['PRIMER_SALT_MONOVALENT'])
+    parser.add_argument('--dna-conc', type=float, help="primer concentration of the dimer checks, in nM, default={0}, as primer3 designs with".format(P3.p3_globals['PRIMER_DNA_CONC']), dest='dna_conc', default=P3.p3_globals['PRIMER_DNA_CONC'])
+    parser.add_argument('-j', '--jobs', type=int, help="number of worker processes for dG checks, 0 for all CPUs, default=1", dest='jobs', default=1)
+    parser.add_argument('--metrics', type=str, help="write stage timings and counters as JSON to this file, optional", dest='metrics', default=None)
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    """
+    Main function for running multiplex_primers.py as a script.
+
+    :param arguments: Arguments to parse instead of the command line
+    :type arguments: list[str]
+    """
+    arguments = parse_args(sys.argv[1:] if arguments is None else arguments)
+    if arguments.metrics:
+        metrics.reset()
+        metrics.enable()
+    ##skip targets primer3 found no pairs for
+    rows = (X for X in output.read_rows(arguments.design_output, arguments.format) if X[5] and X[6])
+    pairs = multiplex.pairs_from_rows(rows, arguments.pairs_per_target)
+    ##dimer conditions, by default as primer3 designed with
+    thermo = dict(mv_conc=arguments.salt, dna_conc=arguments.dna_conc)
+    conflicts = multiplex.conflict_graph(pairs, arguments.max_dg * 1000, arguments.kmer, arguments.jobs, **thermo)
+    pools = multiplex.assign_pools(pairs, conflicts, arguments.pool_size)
+
+    handle = sys.stdout if arguments.output in (None, '-') else open(arguments.output, 'w')
+    try:
+        handle.write('\t'.join(('Pool', 'SNP_Target_ID', 'Pair_rank', 'PRIMER_LEFT_SEQUENCE', 'PRIMER_RIGHT_SEQUENCE')) + '\n')
+        for number, members in enumerate(pools, 1):
+            for pair in members:
+                handle.write('\t'.join((str(number), pair.target_id, str(pair.rank), pair.left, pair.right)) + '\n')
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+    if arguments.conflicts:
+        with open(arguments.conflicts, 'w') as handle:
+            handle.write('pair_a\tpair_b\tdG_kcal\n')
+            for a, others in conflicts.items():
+                for b, dg in others.items():
+                    if a < b:
+                        handle.write('{0}\t{1}\t{2:.2f}\n'.format(a, b, dg / 1000))
+    if arguments.metrics:
+        metrics.METRICS.dump(arguments.metrics)
+        metrics.disable()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Target clusters
+---------------
+
+Dense variant panels put many targets within a product length of each
+other, and cutting a nearly identical window around each for its own
+primer3 run repeats most of the work. Nearby targets are instead grouped
+and designed on one shared template holding a SEQUENCE_TARGET for each.
+
+primer3 returns pairs that flank at least one of the targets, so each
+pair is then assigned to every target its amplicon covers; a target left
+with no pair can be designed on its own window as before.
+
+Usage:
+
+    for group in group_nearby(windows, key, position, max_span):
+        merged, offset, regions = merge_target_dicts([X.target_dict for X in group],
+                                                     [X.offset for X in group])
+        pairs = session.design(merged)
+        covering = covering_pairs(pairs, regions, per_target=5)
+"""
+
+
+def group_nearby(items, key, position, max_span):
+    """Group consecutive items on the same key(item), a sequence, whose
+    position(item) all lie within max_span of each other. Yields the
+    groups as lists, lazily and in input order, so that results stay in
+    target order.
+    """
+    group = []
+    low = high = None
+    for item in items:
+        at = position(item)
+        if group:
+            if key(item) == key(group[0]) and max(high, at) - min(low, at) <= max_span:
+                group.append(item)
+                low, high = min(low, at), max(high, at)
+                continue
+            yield group
+        group = [item]
+        low = high = at
+    if group:
+        yield group
+
+
+def join_templates(templates, offsets):
+    """One template from overlapping templates of a sequence starting at
+    offsets, and the offset it starts at.
+    """
+    order = sorted(range(len(templates)), key=lambda i: offsets[i])
+    offset = offsets[order[0]]
+    template = templates[order[0]][:0]
+    for i in order:
+        start = offsets[i] - offset
+        if start > len(template):
+            raise ValueError("target windows must overlap to be merged")
+        template += templates[i][len(template) - start:]
+    return template, offset
+
+
+def _regions(value):
+    """SEQUENCE_TARGET or SEQUENCE_EXCLUDED_REGION as a list of (start, length)"""
+    if not value:
+        return []
+    if isinstance(value[0], (list, tuple)):
+        return [(int(X[0]), int(X[1])) for X in value]
+    return [(int(value[0]), int(value[1]))]
+
+
+def _overlaps(region, others):
+    return any(region[0] < X[0] + X[1] and X[0] < region[0] + region[1] for X in others)
+
+
+def merge_target_dicts(target_dicts, offsets, seq_id=None, num_return=None):
+    """Merge primer3 target dicts for overlapping windows of one sequence
+    into one dict on their joined template.
+
+    offsets are the sequence positions the templates start at. The merged
+    dict keeps each dict's SEQUENCE_TARGET and those excluded regions that
+    are not another target, and returns up to num_return pairs per target
+    if given. Returns (merged dict, its offset, the SEQUENCE_TARGET regions
+    of each input dict in merged template coordinates).
+    """
+    template, offset = join_templates([X['SEQUENCE_TEMPLATE'] for X in target_dicts], offsets)
+    regions = [[(X[0] + offsets[i] - offset, X[1]) for X in _regions(target_dict.get('SEQUENCE_TARGET'))]
+               for i, target_dict in enumerate(target_dicts)]
+    targets = [X for Y in regions for X in Y]
+    excluded = []
+    for i, target_dict in enumerate(target_dicts):
+        for X in _regions(target_dict.get('SEQUENCE_EXCLUDED_REGION')):
+            region = (X[0] + offsets[i] - offset, X[1])
+            if region not in excluded and not _overlaps(region, targets):
+                excluded.append(region)
+    merged = dict(target_dicts[offsets.index(offset)])
+    merged.update(SEQUENCE_TEMPLATE=template, SEQUENCE_TARGET=[list(X) for X in targets],
+                  SEQUENCE_EXCLUDED_REGION=[list(X) for X in sorted(excluded)])
+    if seq_id is not None:
+        merged['SEQUENCE_ID'] = seq_id
+    if 'REF_OFFSET' in merged:
+        merged['REF_OFFSET'] = offset
+    if 'TARGET_ID' in merged:
+        merged['TARGET_ID'] = ','.join(X['TARGET_ID'] for X in target_dicts)
+    if num_return is not None:
+        merged['PRIMER_NUM_RETURN'] = num_return * len(target_dicts)
+    return merged, offset, regions
+
+
+def covers(pair, regions, offset=0):
+    """Whether a primer3 pair's amplicon, between its primers, holds all
+    of the (start, length) regions; pair positions are less offset
+    """
+    left_end = pair['PRIMER_LEFT'][0] + pair['PRIMER_LEFT'][1] - offset
+    right_start = pair['PRIMER_RIGHT'][0] - pair['PRIMER_RIGHT'][1] + 1 - offset
+    return all(left_end <= start and start + length <= right_start for start, length in regions)
+
+
+def covering_pairs(pairs, regions, per_target, offset=0):
+    """For each target's regions, the indices of the first per_target
+    pairs covering it, in primer3 rank order
+    """
+    return [[i for i, pair in enumerate(pairs) if covers(pair, target, offset)][:per_target]
+            for target in regions]
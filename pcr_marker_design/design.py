@@ -19,17 +19,39 @@ return an iterable  of primer sets
 """
 
 
-from pyfaidx import Fasta, FastaVariant
-from pybedtools import BedTool
+from pyfaidx import Fasta
 from pcr_marker_design import run_p3 as P3
 from pcr_marker_design import  umelt_service as um
+from pcr_marker_design import metrics
+from pcr_marker_design import clusters
+from pcr_marker_design.intervals import IntervalIndex, slop, subtract, sweep_overlaps, vcf_intervals
+from pcr_marker_design.specificity import DEFAULT_K, KmerIndex, screen_pairs
+from pcr_marker_design.variants import apply_variants
+
+import numpy as np
 
-import vcf
 import re
-import warnings
 
+## pybedtools and pyvcf are imported by the designers that use them, as
+## importing them takes longer than the rest of this module
+
+
+class SpecificityMixin:
+    """Off-target checks for a design object with a pyfaidx reference"""
+
+    _specificity_index = None
+
+    def specificity_index(self, path=None, k=DEFAULT_K):
+        """KmerIndex of the reference for off-target checks, built on first
+        use at path, by default next to the reference
+        """
+        path = path or '{0}.k{1}'.format(self.reference.filename, k)
+        if self._specificity_index is None or self._specificity_index.path != path:
+            self._specificity_index = KmerIndex.open_or_build(self.reference, path, k)
+        return self._specificity_index
 
-class PrimerDesign:
+
+class PrimerDesign(SpecificityMixin):
     """A primer design object that is primed
     with genome reference and variant data
     """
@@ -39,8 +61,11 @@ class PrimerDesign:
         Initialise a design object witha  reference assembly and
         annotation file(s)
         """
+        from pybedtools import BedTool
         self.reference = Fasta(reference)
         self.annotations = BedTool(annot_file)
+        ### Index annotations once, for range queries per target
+        self.annotation_index = IntervalIndex.from_bedtool(self.annotations)
         self.desc = desc
         self.genome = re.sub("fasta$", "fasta.fai", re.sub("fa$", "fa.fai", self.reference.filename))
 
@@ -48,27 +73,37 @@ class PrimerDesign:
         """Pass a bedtool target to a designer and get a dictionary
         slice that we can pass to P3
         """
-        target_int = target.slop(b=max_size, g=self.genome)
-        offset = target_int[0].start
-        target_len = target_int[0].length
+        target = target[0]
+        chrom = target.chrom
+        slice_start, slice_end = slop(target.start, target.end, max_size, len(self.reference[chrom]))
+        offset = slice_start
         sldic = dict(SEQUENCE_ID=self.desc)
         ### Target in  region format
         #### ie CHR:start-{start + length -1}
-        sldic['TARGET_ID'] = str(target[0].chrom + ":" +
-                                 str(target[0].start +1) + "-" +
-                                 str(target[0].end))
+        sldic['TARGET_ID'] = str(chrom + ":" +
+                                 str(target.start +1) + "-" +
+                                 str(target.end))
         ### Pass the offset to allow correction
         sldic['REF_OFFSET']=offset
-        sldic['SEQUENCE_TEMPLATE'] = str(self.reference[target[0].chrom][target_int[0].start:target_int[0].end].seq)
-        slice_annot = [(X.start-offset, X.length) for
-                       X in (self.annotations - target) if
-                       (X.chrom == target[0].chrom) & (X.start > target_int[0].start) & (X.end < target_int[0].end)]
+        sldic['SEQUENCE_TEMPLATE'] = str(self.reference[chrom][slice_start:slice_end].seq)
+        ### Annotations within the slice, less the target itself
+        starts, ends, _ = self.annotation_index.overlapping(chrom, slice_start, slice_end)
+        starts, ends = subtract(starts, ends, target.start, target.end)
+        inside = (starts > slice_start) & (ends < slice_end)
+        slice_annot = [(int(X) - offset, int(Y - X)) for X, Y in zip(starts[inside], ends[inside])]
         sldic['SEQUENCE_EXCLUDED_REGION'] = slice_annot
-        sldic['SEQUENCE_TARGET'] = (target[0].start - offset, target[0].length)
+        sldic['SEQUENCE_TARGET'] = (target.start - offset, target.length)
+        metrics.count('slices')
         return sldic
 
 
-class VcfPrimerDesign:
+## batches this large sweep the VCF once rather than indexing all of it
+SWEEP_BATCH = 1000
+## slices further apart than this are read from the reference separately
+SPAN_GAP = 10000
+
+
+class VcfPrimerDesign(SpecificityMixin):
     """A primer design object that is primed
     with genome reference and vcf variant data
     """
@@ -79,52 +114,139 @@ class VcfPrimerDesign:
         variant file(s)
         """
         self.reference = Fasta(reference)
-        ## Following to be gagged https://docs.python.org/2/library/warnings.html#temporarily-suppressing-warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            self.alt=FastaVariant(reference,vcf_file,het=True, hom=True,sample=None, as_raw=True)
-        self.annot = vcf.Reader(filename=vcf_file) ## Do we need bot of these? FastaVariant may suffice for snps
+        import vcf
+        self.annot = vcf.Reader(filename=vcf_file)
+        self.vcf_file = vcf_file
+        self._variant_index = None
         self.desc = desc
         self.genome = re.sub("fasta$", "fasta.fai", re.sub("fa$", "fa.fai", self.reference.filename))
 
+    @property
+    def variant_index(self):
+        """IntervalIndex of the variants in the VCF, read on first use"""
+        if self._variant_index is None:
+            self._variant_index = IntervalIndex(vcf_intervals(self.vcf_file))
+        return self._variant_index
+
     def getseqslicedict(self, interval , max_size, flanking=True):
         """Pass an interval target to a designer and get a dictionary
         slice that we can pass to P3. Default is for design flanking a target.
         """
-        ## Grab a slice for design
-        if flanking:
-            lst=[interval.chrom,interval.start,interval.stop]
-            interval_bed=BedTool("\t".join([str(X) for X in lst]),from_string=True)
-            target_int = interval_bed.slop(b=max_size, g=self.genome)[0]
+        return self.getseqslicedicts([interval], max_size, flanking)[0]
+
+    def getseqslicedicts(self, intervals, max_size, flanking=True, sweep=None):
+        """Pass interval targets (a BedTool, BED file name or list of
+        intervals) and get a list of dictionary slices for P3, in target order.
+
+        Windows are clamped to the reference in one step and the variants
+        in each come from the in-memory variant index, so no subprocesses
+        or temporary files are involved. With sweep, or by default for a
+        batch of SWEEP_BATCH targets or more when the index is not loaded,
+        they come from one pass over the sorted VCF instead, joined with
+        the windows in start order; a tabix-indexed VCF is only read for
+        the target chromosomes.
+        """
+        if isinstance(intervals, str):
+            from pybedtools import BedTool
+            intervals = BedTool(intervals)
+        intervals = list(intervals)
+        if sweep is None:
+            sweep = self._variant_index is None and len(intervals) >= SWEEP_BATCH
+        with metrics.timer('slices'):
+            slices = self._slicedicts(intervals, max_size, flanking, sweep)
+        metrics.count('slices', len(slices))
+        return slices
+
+    def _slicedicts(self, intervals, max_size, flanking, sweep=False):
+        slices = [None] * len(intervals)
+        by_chrom = {}
+        for i, X in enumerate(intervals):
+            by_chrom.setdefault(X.chrom, []).append(i)
+        windows = {}
+        for chrom, rows in by_chrom.items():
+            starts = np.array([intervals[i].start for i in rows], dtype=np.int64)
+            ends = np.array([intervals[i].end for i in rows], dtype=np.int64)
+            ## Grab a slice for design
+            if flanking:
+                windows[chrom] = (np.maximum(starts - max_size, 0),
+                                  np.minimum(ends + max_size, len(self.reference[chrom])))
+            else:
+                windows[chrom] = (starts, ends)
+        if sweep:
+            variants = dict((X, [None] * len(Y)) for X, Y in by_chrom.items())
+            with metrics.timer('vcf_sweep'):
+                for chrom, i, var_starts, var_ends in sweep_overlaps(vcf_intervals(self.vcf_file, list(windows)),
+                                                                     windows):
+                    variants[chrom][i] = (var_starts, var_ends, None)
         else:
-            target_int = interval
-        target_chrom = target_int.chrom
-        target_start = target_int.start
-        target_end = target_int.end
-        offset = target_int.start  ## so we can adjust against the reference
-        ### this ID is for the slice passed for design
-        sldic = dict(SEQUENCE_ID=target_chrom + ":" + str(target_start) + "-" + str(target_end))
-        sldic['REF_OFFSET'] = offset
-        ### This id is for the original target
-        sldic['TARGET_ID'] = target_chrom + ":" + str(interval.start ) + "-" + str(interval.end-1)
-        ### Cut out the sequence from the index
-        sldic['SEQUENCE_TEMPLATE'] = str(self.reference[target_chrom][target_start:target_end].seq)
-        ### Build a list of the variant features for masking
-        slice_vars = [target_chrom + " " + str(max(X.start,target_start)) + " " + str(min(X.end,target_int.end)) \
-                      for X in self.annot.fetch(target_chrom, target_start - 200, target_end) \
-                      if X.end > target_start]  # <----  Quick fix here. Need more work
-        ### and turn these into a bedtool
-        slice_annot = BedTool("\n".join(slice_vars), from_string=True)
-        ### Remove any annotations overlapping with target
-        slice_annot = slice_annot.subtract(interval_bed,A=True) ### Check this!!!
-        sldic['SEQUENCE_EXCLUDED_REGION'] = [(X.start - offset, X.length) for X in slice_annot]
-        if flanking:
-            sldic['SEQUENCE_TARGET'] = (max_size, interval.length)
-        return sldic
+            variants = dict((X, self.variant_index.overlapping_many(X, *Y)) for X, Y in windows.items())
+        for chrom, rows in by_chrom.items():
+            starts = [intervals[i].start for i in rows]
+            ends = [intervals[i].end for i in rows]
+            slice_starts, slice_ends = windows[chrom]
+            ### One read covers each run of slices less than SPAN_GAP apart
+            spans = self._spans(chrom, slice_starts, slice_ends)
+            for i, start, end, slice_start, slice_end, (span_start, span), (var_starts, var_ends, _) in \
+                    zip(rows, starts, ends, slice_starts.tolist(), slice_ends.tolist(), spans, variants[chrom]):
+                offset = slice_start  ## so we can adjust against the reference
+                ### this ID is for the slice passed for design
+                sldic = dict(SEQUENCE_ID=chrom + ":" + str(slice_start) + "-" + str(slice_end))
+                sldic['REF_OFFSET'] = offset
+                ### This id is for the original target
+                sldic['TARGET_ID'] = chrom + ":" + str(start) + "-" + str(end - 1)
+                ### Cut out the sequence from the index
+                sldic['SEQUENCE_TEMPLATE'] = span[slice_start - span_start:slice_end - span_start]
+                ### Variants clipped to the slice, less any overlapping the target
+                var_starts = np.maximum(var_starts, slice_start)
+                var_ends = np.minimum(var_ends, slice_end)
+                keep = (var_ends <= start) | (var_starts >= end)
+                sldic['SEQUENCE_EXCLUDED_REGION'] = [(X - offset, Y - X) for X, Y in
+                                                     zip(var_starts[keep].tolist(), var_ends[keep].tolist())]
+                if flanking:
+                    sldic['SEQUENCE_TARGET'] = (max_size, end - start)
+                slices[i] = sldic
+        return slices
+
+    def _spans(self, chrom, slice_starts, slice_ends):
+        """For each slice, the start and sequence of the reference span
+        read for it: slices are read together in runs where each starts
+        less than SPAN_GAP past the end of those before it, so nearby
+        slices share a read and distant ones are not joined by one
+        """
+        order = np.argsort(slice_starts, kind='stable')
+        starts, ends = slice_starts[order], slice_ends[order]
+        reach = np.maximum.accumulate(ends)
+        runs = np.cumsum(np.concatenate([[0], starts[1:] > reach[:-1] + SPAN_GAP]))
+        spans = [None] * len(order)
+        for run in range(int(runs[-1]) + 1 if len(runs) else 0):
+            members = np.flatnonzero(runs == run)
+            span_start = int(starts[members[0]])
+            span = (span_start, str(self.reference[chrom][span_start:int(reach[members[-1]])].seq))
+            for j in order[members].tolist():
+                spans[j] = span
+        return spans
+
+    def called_variants(self, chrom, start, end):
+        """Variants lying within [start, end) that the first sample carries,
+        as (start, end, alt) edits relative to start, for variants.apply_variants.
+        Unlike pyfaidx's FastaVariant, indels are applied as well as SNPs.
+        """
+        edits = []
+        for record in self.annot.fetch(chrom, start, end):
+            if record.start < start or record.end > end or not record.samples:
+                continue
+            call = record.samples[0]
+            if not call.is_variant:
+                continue
+            ## the first alt allele the sample carries
+            allele = min(int(X) for X in call.gt_alleles if X not in (None, '.', '0'))
+            edits.append((record.start - start, record.end - start, str(record.ALT[allele - 1])))
+        return edits
 
-    def meltSlice(self, region):
+    def meltSlice(self, region, backend='umelt'):
         """Apply variants to an amplicon region and pass
-        ref and alt consensus to uMelt web service, returning a tuple of (ref_Tm, alt_Tm)
+        ref and alt consensus to uMelt web service, returning a tuple of (ref_Tm, alt_Tm).
+        backend='local' melts in-process instead of calling uMelt.
         """
         target=region.split(':')
         coord=[int(X)  for X in target[1].split('-')]
@@ -132,24 +254,81 @@ class VcfPrimerDesign:
         target_start=coord[0] -1
         target_end=coord[1]
         ref_seq=str(self.reference[target_chrom][target_start:target_end].seq)
-        alt_seq=self.alt[target_chrom][target_start:target_end]
+        alt_seq=apply_variants(ref_seq, self.called_variants(target_chrom, target_start, target_end))
         ## Melt both
-        umelt = um.UmeltService()
+        umelt = um.melt_service(backend)
         refmelt = um.MeltSeq(ref_seq)
         altmelt=um.MeltSeq(alt_seq)
-        ref_melt_Tm = umelt.get_helicity_info(umelt.get_response(refmelt)).get_melting_temp()
-        alt_melt_Tm = umelt.get_helicity_info(umelt.get_response(altmelt)).get_melting_temp()
+        try:
+            ref_melt_Tm = umelt.melt(refmelt).get_melting_temp()
+            alt_melt_Tm = umelt.melt(altmelt).get_melting_temp()
+        finally:
+            umelt.close()
         return (ref_melt_Tm,alt_melt_Tm)
 
 
 
-def designfromvcf(bedtargets, VCFdesigner, max_size, min_size):
+def designfromvcf(bedtargets, VCFdesigner, max_size, min_size, jobs=1, cache=None, specificity=None,
+                  off_target_size=1000, reject_off_target=True, cluster=None):
     """
-    usage: bedTool of targets,designer obj, max , min
-    pass targets as bedtool to a designer
+    usage: bedTool of targets,designer obj, max , min, [jobs, cache, specificity, cluster]
+    pass targets as bedtool to a designer, running primer3 over
+    jobs worker processes (0 for all CPUs), optionally through
+    a run_p3.DesignCache
+    with a specificity KmerIndex, pairs with off-target products up to
+    off_target_size are dropped, or only flagged if not reject_off_target
+    with cluster, a span in bp, targets on a chromosome within cluster of
+    each other are designed on one shared slice, and each pair listed
+    under every target it covers, with those targets in TARGET_IDS; a
+    target no shared pair covers gets a slice of its own
     return a list of dicts
     """
-    P3.p3_globals['PRIMER_PRODUCT_SIZE_RANGE'] = [[min_size, max_size]]
-    designdict = [VCFdesigner.getseqslicedict(BedTool([b]), max_size) for b in bedtargets]
-    PCR_result = [P3.run_P3(X, P3.p3_globals) for X in designdict]
+    session = P3.DesignSession(P3.p3_globals, cache, PRIMER_PRODUCT_SIZE_RANGE=[[min_size, max_size]])
+    designdict = VCFdesigner.getseqslicedicts(bedtargets, max_size)
+
+    def design(target_dicts):
+        PCR_result = list(session.design_many(target_dicts, jobs=jobs))
+        if specificity is not None:
+            ## run_P3 has already placed pairs on the chromosome, by REF_OFFSET
+            PCR_result = [screen_pairs(specificity, target_dict['SEQUENCE_ID'].split(':')[0], 0, pairs,
+                                       max_size=off_target_size, reject=reject_off_target)
+                          for target_dict, pairs in zip(target_dicts, PCR_result)]
+        return PCR_result
+
+    if not cluster:
+        return design(designdict)
+    if cluster > max_size:
+        raise ValueError("cluster must be at most the maximum product size")
+    groups = list(clusters.group_nearby(range(len(designdict)), lambda i: designdict[i]['SEQUENCE_ID'].split(':')[0],
+                                        lambda i: designdict[i]['REF_OFFSET'] + designdict[i]['SEQUENCE_TARGET'][0],
+                                        cluster))
+    ## primer3 returns one pair fewer than asked for, from each slice
+    num_return = session.global_dict['PRIMER_NUM_RETURN']
+    merged = []
+    for group in groups:
+        target_dicts = [designdict[i] for i in group]
+        if len(group) == 1:
+            merged.append(target_dicts[0])
+            continue
+        offsets = [X['REF_OFFSET'] for X in target_dicts]
+        end = max(X + len(Y['SEQUENCE_TEMPLATE']) for X, Y in zip(offsets, target_dicts))
+        seq_id = '{0}:{1}-{2}'.format(target_dicts[0]['SEQUENCE_ID'].split(':')[0], min(offsets), end)
+        merged.append(clusters.merge_target_dicts(target_dicts, offsets, seq_id, num_return))
+    metrics.count('clusters', sum(len(X) > 1 for X in groups))
+    PCR_result = [None] * len(designdict)
+    fallback = []
+    for group, shared, pairs in zip(groups, merged, design([X if isinstance(X, dict) else X[0] for X in merged])):
+        if len(group) == 1:
+            PCR_result[group[0]] = [dict(X, TARGET_IDS=[X['TARGET_ID']]) for X in pairs]
+            continue
+        _, offset, regions = shared
+        ids = [designdict[i]['TARGET_ID'] for i in group]
+        covered = [[X for X, Y in zip(ids, regions) if clusters.covers(pair, Y, offset)] for pair in pairs]
+        for i, target_id, chosen in zip(group, ids, clusters.covering_pairs(pairs, regions, num_return - 1, offset)):
+            PCR_result[i] = [dict(pairs[j], TARGET_ID=target_id, TARGET_IDS=covered[j]) for j in chosen]
+            if not chosen:
+                fallback.append(i)
+    metrics.count('cluster_fallbacks', len(fallback))
+    for i, pairs in zip(fallback, design([designdict[i] for i in fallback])):
+        PCR_result[i] = [dict(X, TARGET_IDS=[X['TARGET_ID']]) for X in pairs]
     return PCR_result
@@ -0,0 +1,127 @@
+"""
+HRM discrimination
+------------------
+
+Scores how well high resolution melting tells the reference and variant
+amplicons of candidate primer pairs apart, for all pairs at once.
+
+The difference in melting temperature alone misses variants that change
+the shape of the melt rather than where it peaks, so each pair gets
+three metrics from its two helicity curves:
+
+- delta_tm: the absolute difference in melting temperature, as design
+  has always reported it
+- curve_difference: the largest difference between the two helicity
+  curves, each normalised to run from 1 (helical) to 0 (melted), as in
+  an HRM difference plot
+- width_difference: the absolute difference in the full width at half
+  maximum of the two -dH/dT melt peaks, in degrees C
+
+The helicity curves of every pair are given as two 2-D arrays, one row
+per pair, and the metrics come out of one vectorised pass: the curves are
+splined and differentiated together by umelt_service.melting_temps.
+Pairs are ranked on the three metrics together, so that a pair whose
+alleles melt with clearly different shapes is not passed over for one
+with a slightly larger Tm difference.
+
+Usage:
+
+    scores = score_pairs(ref_helicity, var_helicity)
+    best = top_pairs(scores, target_ids, 3)
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from pcr_marker_design import metrics
+from pcr_marker_design.umelt_service import TEMPERATURE_RANGE, melting_temps
+
+METRICS = ('delta_tm', 'curve_difference', 'width_difference')
+
+HrmScores = namedtuple('HrmScores', ('ref_tm', 'var_tm') + METRICS)
+
+
+def normalise(helicity):
+    """Helicity curves, one per row, scaled to run from 1 to 0"""
+    helicity = np.asarray(helicity, dtype=float)
+    low = helicity.min(axis=1, keepdims=True)
+    span = helicity.max(axis=1, keepdims=True) - low
+    return (helicity - low) / np.where(span > 0, span, 1)
+
+
+def peak_widths(temperatures, derivatives):
+    """Full width at half maximum of the highest peak of each melt curve,
+    one per row of derivatives, over temperatures
+    """
+    n = derivatives.shape[1]
+    peaks = derivatives.argmax(axis=1)[:, None]
+    below = derivatives < derivatives.max(axis=1, keepdims=True) / 2
+    positions = np.arange(n)
+    ## the half maximum crossings nearest the peak on either side, or the ends of the grid
+    left = np.where(below & (positions < peaks), positions, -1).max(axis=1) + 1
+    right = np.where(below & (positions > peaks), positions, n).min(axis=1) - 1
+    return temperatures[right] - temperatures[left]
+
+
+def score_pairs(ref_helicity, var_helicity, temperature_range=TEMPERATURE_RANGE, min_temp=65, max_temp=100.5):
+    """HRM discrimination metrics of pairs with the reference and variant
+    amplicon helicity curves given, one row per pair, over temperature_range.
+    Melt curves are taken between min_temp and max_temp, as melting_temps does.
+
+    Returns HrmScores of arrays with a value per pair.
+    """
+    points = len(temperature_range)
+    ref_helicity = np.asarray(ref_helicity, dtype=float).reshape(-1, points)
+    var_helicity = np.asarray(var_helicity, dtype=float).reshape(-1, points)
+    if ref_helicity.shape != var_helicity.shape:
+        raise ValueError("ref and variant helicity curves must be given for the same pairs")
+    n = len(ref_helicity)
+    curves = melting_temps(np.concatenate([ref_helicity, var_helicity]), temperature_range, min_temp, max_temp)
+    with metrics.timer('hrm_score'):
+        widths = peak_widths(curves.temperatures, curves.derivatives) if n else np.zeros(0)
+        curve_difference = np.abs(normalise(ref_helicity) - normalise(var_helicity)).max(axis=1) if n \
+            else np.zeros(0)
+    ref_tm, var_tm = curves.melting_temps[:n], curves.melting_temps[n:]
+    metrics.count('hrm_pairs_scored', n)
+    return HrmScores(ref_tm, var_tm, np.abs(ref_tm - var_tm), curve_difference, np.abs(widths[:n] - widths[n:]))
+
+
+def combined_scores(scores, by=METRICS):
+    """The mean of the metrics of by for each pair, each metric scaled by
+    its largest value over the pairs to run from 0 to 1, so that a pair
+    separating the curves well ranks with one shifting Tm well; NaN for
+    pairs with a metric missing
+    """
+    values = np.array([getattr(scores, X) for X in by], dtype=float).reshape(len(by), -1)
+    largest = np.nan_to_num(values, nan=0).max(axis=1, initial=0)[:, None]
+    return (values / np.where(largest > 0, largest, 1)).mean(axis=0)
+
+
+def rank_pairs(scores, by=METRICS):
+    """Indices of the pairs, best discriminating first, by their
+    combined_scores over the metrics of by; pairs with a metric missing
+    (NaN) go last, and ties keep input order
+    """
+    if not by:
+        return np.arange(len(scores.delta_tm))
+    combined = np.nan_to_num(-combined_scores(scores, by), nan=np.inf)
+    return np.argsort(combined, kind='stable')
+
+
+def top_pairs(scores, target_ids, top=None, by=METRICS):
+    """Indices of the best top pairs of each target, as rank_pairs orders
+    them, targets in the order they first appear in target_ids, a target
+    per pair. With no top, all pairs of each target are returned.
+    """
+    target_ids = list(target_ids)
+    first = {}
+    groups = np.array([first.setdefault(X, len(first)) for X in target_ids], dtype=np.int64)
+    order = rank_pairs(scores, by)
+    order = order[np.argsort(groups[order], kind='stable')]
+    if top is None or not len(order):
+        return order
+    ## rank of each pair within its target, from the start of its target's run
+    starts = np.flatnonzero(np.concatenate([[True], groups[order][1:] != groups[order][:-1]]))
+    sizes = np.diff(np.append(starts, len(order)))
+    return order[np.arange(len(order)) - np.repeat(starts, sizes) < top]
@@ -0,0 +1,181 @@
+"""
+In-memory interval indexing
+---------------------------
+
+Annotation intervals are loaded once into per-chromosome start/end arrays,
+sorted by start, so that the intervals overlapping a design window come
+from a binary search rather than a bedtools run over the whole annotation
+file.
+
+For a large batch of windows against a large, sorted VCF, sweep_overlaps
+instead merge-joins the windows, sorted, with the records as they are
+read, holding only the records that can still reach a window.
+
+Coordinates are zero-based and half-open, as in BED.
+"""
+
+import gzip
+import itertools
+import os
+
+import numpy as np
+
+
+class IntervalIndex(object):
+    """Per-chromosome index of (chrom, start, end) intervals.
+
+    Query results come back in input order, so they line up with
+    what bedtools would report for the same file.
+    """
+
+    def __init__(self, intervals):
+        rows = {}
+        for i, (chrom, start, end) in enumerate(intervals):
+            rows.setdefault(chrom, []).append((start, end, i))
+        self._index = {}
+        for chrom, chrom_rows in rows.items():
+            table = np.array(chrom_rows, dtype=np.int64).reshape(-1, 3)
+            table = table[np.argsort(table[:, 0], kind='mergesort')]
+            self._index[chrom] = (table[:, 0].copy(), table[:, 1].copy(), table[:, 2].copy(),
+                                  int((table[:, 1] - table[:, 0]).max()))
+
+    @classmethod
+    def from_bedtool(cls, bedtool):
+        """Index the intervals of a BedTool, or any iterable of objects
+        with chrom, start and end attributes.
+        """
+        return cls((X.chrom, X.start, X.end) for X in bedtool)
+
+    def __contains__(self, chrom):
+        return chrom in self._index
+
+    def overlapping(self, chrom, start, end):
+        """Intervals on chrom overlapping [start, end).
+
+        Returns (starts, ends, rows) arrays in input order, where rows
+        are the positions of the intervals in the input.
+        """
+        return next(self.overlapping_many(chrom, [start], [end]))
+
+    def overlapping_many(self, chrom, starts, ends):
+        """Intervals on chrom overlapping each of the [start, end) windows
+        given as arrays. The binary searches for all windows are done in
+        one step; yields a (starts, ends, rows) triple per window.
+        """
+        if chrom not in self._index:
+            empty = np.zeros(0, dtype=np.int64)
+            for _ in range(len(starts)):
+                yield empty, empty, empty
+            return
+        index_starts, index_ends, index_rows, max_len = self._index[chrom]
+        starts = np.asarray(starts, dtype=np.int64)
+        lows = np.searchsorted(index_starts, starts - max_len, side='left')
+        highs = np.searchsorted(index_starts, np.asarray(ends, dtype=np.int64), side='left')
+        for start, lo, hi in zip(starts, lows, highs):
+            hit = np.nonzero(index_ends[lo:hi] > start)[0] + lo
+            hit = hit[np.argsort(index_rows[hit], kind='mergesort')]
+            yield index_starts[hit], index_ends[hit], index_rows[hit]
+
+
+def slop(start, end, size, chrom_length):
+    """Extend [start, end) by size both ways, clamped to the chromosome,
+    as bedtools slop -b does.
+    """
+    return max(0, start - size), min(chrom_length, end + size)
+
+
+def subtract(starts, ends, hole_start, hole_end):
+    """Remove [hole_start, hole_end) from each interval, as bedtools
+    subtract does for a single B interval.
+
+    Intervals overlapping the hole are trimmed, or split in two if
+    they span it, and dropped if they lie inside it. Returns the
+    (starts, ends) of the pieces, in input order.
+    """
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    hit = (starts < hole_end) & (ends > hole_start)
+    left_ends = np.where(hit, np.minimum(ends, hole_start), ends)
+    right_starts = np.where(hit, np.maximum(starts, hole_end), ends)
+    piece_starts = np.column_stack([starts, right_starts]).ravel()
+    piece_ends = np.column_stack([left_ends, ends]).ravel()
+    keep = np.column_stack([left_ends > starts, hit & (ends > right_starts)]).ravel()
+    return piece_starts[keep], piece_ends[keep]
+
+
+def _sweep(rows, starts, ends):
+    """Merge-join (start, end) rows of one chromosome, sorted by start,
+    against windows; yields (window number, starts, ends) in window start
+    order.
+    """
+    held = []
+    last = None
+    pending = next(rows, None)
+    for i in np.argsort(starts, kind='mergesort').tolist():
+        start, end = int(starts[i]), int(ends[i])
+        while pending is not None and pending[0] < end:
+            if last is not None and pending[0] < last:
+                raise ValueError("intervals are not sorted by start")
+            last = pending[0]
+            held.append(pending)
+            pending = next(rows, None)
+        ## windows come in start order, so a row ending before this one can reach no other;
+        ## a long deletion starting well before the window stays held for as long as it reaches
+        held = [X for X in held if X[1] > start]
+        hits = np.array([X for X in held if X[0] < end], dtype=np.int64).reshape(-1, 2)
+        yield i, hits[:, 0], hits[:, 1]
+
+
+def sweep_overlaps(intervals, windows):
+    """Intervals overlapping each of many windows, in one pass.
+
+    intervals is an iterable of (chrom, start, end) with each chromosome's
+    in one run sorted by start, as in a sorted VCF; windows maps chrom to
+    the (starts, ends) arrays of its windows. Yields (chrom, window
+    number, starts, ends) per window, with the overlapping intervals in
+    input order, as IntervalIndex.overlapping_many would give them.
+    Windows on chromosomes with no intervals come last.
+    """
+    done = set()
+    for chrom, rows in itertools.groupby(intervals, key=lambda X: X[0]):
+        if chrom in done:
+            raise ValueError("intervals on {0} are not in one run".format(chrom))
+        done.add(chrom)
+        if chrom in windows:
+            for i, starts, ends in _sweep(((X[1], X[2]) for X in rows), *windows[chrom]):
+                yield chrom, i, starts, ends
+    empty = np.zeros(0, dtype=np.int64)
+    for chrom, (starts, _) in windows.items():
+        if chrom not in done:
+            for i in range(len(starts)):
+                yield chrom, i, empty, empty
+
+
+def _vcf_lines(vcf_file, chroms):
+    if chroms is not None and os.path.exists(vcf_file + '.tbi'):
+        ## read only the chromosomes wanted, each from its first block
+        import pysam
+        with pysam.TabixFile(vcf_file) as tabix:
+            for chrom in chroms:
+                if chrom in tabix.contigs:
+                    for line in tabix.fetch(chrom):
+                        yield line
+        return
+    opener = gzip.open if vcf_file.endswith('.gz') else open
+    with opener(vcf_file, 'rt') as handle:
+        for line in handle:
+            if not line.startswith('#'):
+                yield line
+
+
+def vcf_intervals(vcf_file, chroms=None):
+    """(chrom, start, end) of each record of a VCF file, plain or
+    bgzipped, spanning the reference allele as pyvcf does.
+
+    With chroms, records of other chromosomes may be left out: a
+    tabix-indexed file is read only for those.
+    """
+    for line in _vcf_lines(vcf_file, chroms):
+        chrom, pos, _, ref = line.split('\t', 4)[:4]
+        start = int(pos) - 1
+        yield chrom, start, start + len(ref)
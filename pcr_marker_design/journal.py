@@ -0,0 +1,114 @@
+"""
+Design run journal
+------------------
+
+An append-only record of completed targets and their result rows, so that
+an interrupted run can be resumed without designing or melting those
+targets again.
+
+Each completed target is one JSON line, {"target": ID, "rows": [...]},
+after a first line {"run": digest} identifying the inputs and settings of
+the run, so that a journal is only ever resumed by the run that wrote it.
+Lines are buffered and flushed and fsynced in batches, every fsync_every
+targets or fsync_seconds, so journalling costs the main loop little. A
+crash can lose at most the last unsynced batch, and a torn final line is
+dropped when the journal is reopened.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+def _complete_lines(path):
+    """Bytes of path up to and including its last newline"""
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    return data[:data.rfind(b'\n') + 1]
+
+
+class JournalError(ValueError):
+    """A journal that does not belong to the run resuming it"""
+
+
+def run_digest(settings):
+    """Digest of a run's inputs and settings, a dict of JSON values"""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_journal(path, run=None):
+    """Completed targets in a journal, as an OrderedDict of target ID
+    to a list of result row tuples. A missing journal is empty.
+
+    With run, a run_digest, raise JournalError if the journal was not
+    started by a run with that digest.
+    """
+    completed = OrderedDict()
+    if not os.path.exists(path):
+        return completed
+    started = None
+    for line in _complete_lines(path).decode('utf-8').splitlines():
+        if line.strip():
+            entry = json.loads(line)
+            if 'run' in entry:
+                started = entry['run']
+            else:
+                completed[entry['target']] = [tuple(X) for X in entry['rows']]
+    if run is not None and (started or completed) and started != run:
+        raise JournalError("{0} was written by a run with other inputs or settings; "
+                           "remove it to start afresh".format(path))
+    return completed
+
+
+class Journal(object):
+    """Appends completed targets to the journal at path.
+
+    With resume=True an existing journal is kept and added to,
+    otherwise it is started afresh, headed by run, a run_digest, if given.
+    """
+
+    def __init__(self, path, resume=False, run=None, fsync_every=64, fsync_seconds=5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        if resume and os.path.exists(path):
+            ## drop a torn final line left by a crash before appending
+            complete = _complete_lines(path)
+            with open(path, 'r+b') as handle:
+                handle.truncate(len(complete))
+            self.handle = open(path, 'a')
+        else:
+            self.handle = open(path, 'w')
+        if run is not None and not self.handle.tell():
+            self.handle.write(json.dumps({'run': run}) + '\n')
+            self.sync()
+
+    def record(self, target_id, rows):
+        """Record a target as completed, with its result rows"""
+        self.handle.write(json.dumps({'target': target_id, 'rows': [list(X) for X in rows]}) + '\n')
+        self._pending += 1
+        if self._pending >= self.fsync_every or \
+                time.monotonic() - self._last_sync >= self.fsync_seconds:
+            self.sync()
+
+    def sync(self):
+        """Flush recorded targets to disk"""
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if not self.handle.closed:
+            self.sync()
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
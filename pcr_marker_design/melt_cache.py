@@ -0,0 +1,224 @@
+"""
+Persistent melt cache
+---------------------
+
+An on-disk, content-addressed store of helicity curves so that amplicons
+melted once, by any run or process, are never sent to a melt service again.
+
+Entries are keyed by a hash of the backend name, the amplicon sequence and
+the MeltSeq conditions (resolution, DMSO, cations, free Mg2+). Curves are
+stored as raw float32 bytes in an SQLite database in WAL mode, which lets
+several processes read and write the same cache. An optional size limit
+evicts the least recently used entries.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from pcr_marker_design import metrics
+from pcr_marker_design.umelt_service import HelicityInfo, MeltResult, TEMPERATURE_RANGE
+
+
+def melt_key(sequence, namespace=''):
+    """Content hash for a MeltSeq object melted by the namespace backend"""
+
+    ## conditions as floats, so that 20 and 20.0 mM share a key
+    fields = (namespace, sequence.sequence.upper()) + tuple(float(X) for X in (
+        sequence.resolution, sequence.dmso_percent, sequence.cations, sequence.free_mg))
+    return hashlib.sha1('|'.join(str(X) for X in fields).encode('utf-8')).hexdigest()
+
+
+class MeltCache:
+    """An SQLite-backed cache of helicity arrays.
+
+    path is the database file, created if need be. max_bytes, if given,
+    bounds the stored helicity data: every check_every writes the size
+    is checked and, if over the limit, the least recently used entries
+    are evicted down to 90% of it.
+
+    Hits do not write their use time at once, which would take the write
+    lock on every read; times are held and written together every
+    touch_every hits, before an eviction and on close.
+    """
+
+    def __init__(self, path, max_bytes=None, timeout=60, check_every=64, touch_every=256):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.check_every = check_every
+        self.touch_every = touch_every
+        self._writes = 0
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS melt ('
+                         'key TEXT PRIMARY KEY, helicity BLOB NOT NULL, '
+                         'nbytes INTEGER NOT NULL, last_used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS melt_last_used ON melt (last_used)')
+
+    def _connect(self):
+        # connections must not cross a fork or a thread, so open one per process and thread
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=self.timeout)
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local'], state['_lock']
+        state['_touched'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get(self, key):
+        """Return the cached helicity array for key, or None."""
+
+        conn = self._connect()
+        row = conn.execute('SELECT helicity FROM melt WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        with self._lock:
+            self._touched[key] = time.time()
+            full = len(self._touched) >= self.touch_every
+        if full:
+            self.flush()
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def flush(self):
+        """Write the use times of hits not yet written."""
+
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            with self._connect() as conn:
+                conn.executemany('UPDATE melt SET last_used = ? WHERE key = ?',
+                                 [(used, key) for key, used in touched.items()])
+
+    def put(self, key, helicity_array):
+        """Store a helicity array under key."""
+
+        blob = np.asarray(helicity_array, dtype=np.float32).tobytes()
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO melt (key, helicity, nbytes, last_used) '
+                         'VALUES (?, ?, ?, ?)', (key, sqlite3.Binary(blob), len(blob), time.time()))
+        with self._lock:
+            self._writes += 1
+            check = self._writes % self.check_every == 0
+        if self.max_bytes is not None and check and self.size() > self.max_bytes:
+            self.evict(int(0.9 * self.max_bytes))
+
+    def size(self):
+        """Total bytes of helicity data stored."""
+
+        return self._connect().execute('SELECT COALESCE(SUM(nbytes), 0) FROM melt').fetchone()[0]
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM melt').fetchone()[0]
+
+    def evict(self, target_bytes):
+        """Drop least recently used entries until at most target_bytes remain."""
+
+        self.flush()
+        conn = self._connect()
+        with conn:
+            excess = self.size() - target_bytes
+            stale = []
+            for key, nbytes in conn.execute('SELECT key, nbytes FROM melt ORDER BY last_used').fetchall():
+                if excess <= 0:
+                    break
+                stale.append((key,))
+                excess -= nbytes
+            conn.executemany('DELETE FROM melt WHERE key = ?', stale)
+
+    def close(self):
+        """Close this thread's connection; others close as their threads end."""
+
+        self.flush()
+        local = self._local
+        if getattr(local, 'conn', None) is not None and local.pid == os.getpid():
+            local.conn.close()
+        local.conn = None
+
+
+class CachedMeltService:
+    """A melt service that consults a MeltCache first.
+
+    service is any object with a melt(MeltSeq) method returning
+    HelicityInfo, such as UmeltService or LocalMeltService. namespace
+    keeps curves from different backends apart in a shared cache.
+    """
+
+    def __init__(self, service, cache, namespace=''):
+        self.service = service
+        self.cache = cache
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+    def melt(self, sequence):
+        """Melt a MeltSeq object, returning a HelicityInfo object."""
+
+        key = melt_key(sequence, self.namespace)
+        helicity = self.cache.get(key)
+        if helicity is not None:
+            self.hits += 1
+            metrics.count('melt_cache_hits')
+            return HelicityInfo(helicity, TEMPERATURE_RANGE)
+        self.misses += 1
+        metrics.count('melt_cache_misses')
+        helicity_info = self.service.melt(sequence)
+        self.cache.put(key, helicity_info.helicity_data)
+        return helicity_info
+
+    def melt_many(self, sequences):
+        """Melt MeltSeq objects, passing only cache misses to the
+        service. Returns a list of MeltResult objects in input order.
+        """
+
+        sequences = list(sequences)
+        keys = [melt_key(X, self.namespace) for X in sequences]
+        results = [None] * len(sequences)
+        misses = []
+        for i, key in enumerate(keys):
+            helicity = self.cache.get(key)
+            if helicity is None:
+                misses.append(i)
+            else:
+                results[i] = MeltResult(sequences[i], HelicityInfo(helicity, TEMPERATURE_RANGE), None)
+        self.hits += len(sequences) - len(misses)
+        self.misses += len(misses)
+        metrics.count('melt_cache_hits', len(sequences) - len(misses))
+        metrics.count('melt_cache_misses', len(misses))
+        if misses:
+            ## a sequence missed more than once in the batch is melted once
+            first = {}
+            for i in misses:
+                first.setdefault(keys[i], i)
+            melts = dict(zip(first, self.service.melt_many([sequences[i] for i in first.values()])))
+            for key, result in melts.items():
+                if result.ok:
+                    self.cache.put(key, result.helicity_info.helicity_data)
+            for i in misses:
+                results[i] = melts[keys[i]]._replace(sequence=sequences[i])
+        return results
+
+    def close(self):
+        """Close the service and this thread's cache connection."""
+
+        self.service.close()
+        self.cache.close()
@@ -0,0 +1,204 @@
+"""
+Local melt prediction
+---------------------
+
+An in-process stand-in for the uMelt web service, for hosts without
+network access or when many amplicons need melting.
+
+Helicity is predicted with a nearest-neighbour helix-coil (Zimm-Bragg)
+model: each base pair is either helical or melted, every pair of adjacent
+helical base pairs contributes the Boltzmann weight of its stacking free
+energy, and each helical segment pays a cooperativity penalty. Stacking
+parameters are the unified set of SantaLucia (1998), salt-corrected for
+monovalent cations and free Mg2+ (von Ahsen et al. 2001), with DMSO
+lowering melting temperatures by 0.6 degrees C per percent.
+
+Helicity at each temperature is the expected fraction of helical base
+pairs, found by a scaled forward-backward pass along the sequences that is
+vectorised over amplicons and temperatures. Predicted melting temperatures
+come within a few degrees of uMelt and track its differences between
+alleles; they are not identical to it.
+"""
+
+import numpy as np
+
+from pcr_marker_design import metrics
+from pcr_marker_design.umelt_service import HelicityInfo, MeltResult, TEMPERATURE_RANGE
+
+# SantaLucia (1998) unified nearest-neighbour parameters at 1 M NaCl
+# dinucleotide: (dH kcal/mol, dS cal/K/mol)
+NN_PARAMS = {
+    'AA': (-7.9, -22.2), 'TT': (-7.9, -22.2),
+    'AT': (-7.2, -20.4), 'TA': (-7.2, -21.3),
+    'CA': (-8.5, -22.7), 'TG': (-8.5, -22.7),
+    'GT': (-8.4, -22.4), 'AC': (-8.4, -22.4),
+    'CT': (-7.8, -21.0), 'AG': (-7.8, -21.0),
+    'GA': (-8.2, -22.2), 'TC': (-8.2, -22.2),
+    'CG': (-10.6, -27.2), 'GC': (-9.8, -24.4),
+    'GG': (-8.0, -19.9), 'CC': (-8.0, -19.9),
+}
+
+# cooperativity penalty for starting a helical segment
+SIGMA = 1e-5
+# Tm depression per percent DMSO
+DMSO_FACTOR = 0.6
+GAS_CONSTANT = 1.987
+
+_BASES = 'ACGT'
+_N_CODE = len(_BASES)
+
+
+def _stack_tables():
+    """dH (cal/mol) and dS lookup tables indexed by 5 * code(i) + code(i + 1),
+    where stacks with an ambiguous base take the mean of all stacks.
+    """
+    d_h = np.full(25, 1000 * np.mean([v[0] for v in NN_PARAMS.values()]))
+    d_s = np.full(25, np.mean([v[1] for v in NN_PARAMS.values()]))
+    for stack, (enthalpy, entropy) in NN_PARAMS.items():
+        index = _BASES.index(stack[0]) * 5 + _BASES.index(stack[1])
+        d_h[index] = 1000 * enthalpy
+        d_s[index] = entropy
+    return d_h, d_s
+
+
+_DH, _DS = _stack_tables()
+
+_CODES = np.full(256, _N_CODE, dtype=np.uint8)
+for _i, _base in enumerate(_BASES):
+    _CODES[ord(_base)] = _i
+    _CODES[ord(_base.lower())] = _i
+
+
+def equivalent_sodium(cations=20, free_mg=2):
+    """Monovalent-equivalent cation concentration (M) for cations
+    and free Mg2+ given in mM.
+    """
+    return (cations + 120 * np.sqrt(max(free_mg, 0))) / 1000.0
+
+
+def _melt_batch(sequences, stack_weights, sigma):
+    """Helicity (%) of a batch of sequences, given the Boltzmann weight
+    of each stack (row) at each temperature (column).
+    """
+    n_seq = len(sequences)
+    lengths = np.array([len(X) for X in sequences])
+    max_len = lengths.max()
+    codes = np.full((n_seq, max_len), _N_CODE, dtype=np.uint8)
+    for i, seq in enumerate(sequences):
+        codes[i, :len(seq)] = _CODES[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+    # stacking weights, laid out (position, sequence, temperature)
+    weights = stack_weights[(codes[:, :-1].astype(np.intp) * 5 + codes[:, 1:]).T]
+    # positions past the end of a sequence can only be melted
+    helix_ok = (np.arange(max_len)[:, None] < lengths[None, :])[:, :, None]
+    padded = max_len - lengths.min()
+
+    shape = (n_seq, stack_weights.shape[1])
+    fwd_h = np.empty((max_len,) + shape)
+    inv_scale = np.empty((max_len,) + shape)
+    h, c = np.empty(shape), np.empty(shape)
+    inv_scale[0] = 1 / (1 + sigma)
+    fwd_h[0] = sigma * inv_scale[0]
+    fwd_c = inv_scale[0].copy()
+    for i in range(1, max_len):
+        np.multiply(fwd_h[i - 1], weights[i - 1], out=h)
+        h += sigma * fwd_c
+        if i >= max_len - padded:
+            h *= helix_ok[i]
+        np.add(fwd_h[i - 1], fwd_c, out=c)
+        np.add(h, c, out=inv_scale[i])
+        np.reciprocal(inv_scale[i], out=inv_scale[i])
+        np.multiply(h, inv_scale[i], out=fwd_h[i])
+        np.multiply(c, inv_scale[i], out=fwd_c)
+
+    back_h, back_c = np.ones(shape), np.ones(shape)
+    helical = fwd_h[max_len - 1].copy()
+    for i in range(max_len - 2, -1, -1):
+        if i + 1 >= max_len - padded:
+            back_h *= helix_ok[i + 1]
+        np.multiply(weights[i], back_h, out=h)
+        h += back_c
+        np.multiply(back_h, sigma, out=c)
+        c += back_c
+        np.multiply(h, inv_scale[i + 1], out=back_h)
+        np.multiply(c, inv_scale[i + 1], out=back_c)
+        helical += fwd_h[i] * back_h
+    return 100 * helical / lengths[:, None]
+
+
+def predict_helicity(sequences, cations=20, free_mg=2, dmso_percent=0,
+                     temperature_range=TEMPERATURE_RANGE, sigma=SIGMA, batch_size=256):
+    """Predict helicity curves for a list of sequence strings melted
+    under the same conditions.
+
+    cations and free_mg are in mM, as for MeltSeq.
+
+    Returns a float32 array with a row of helicity (%) per sequence
+    and a column per temperature in temperature_range.
+    """
+    temperature_range = np.asarray(temperature_range, dtype=np.float64)
+    result = np.zeros((len(sequences), temperature_range.size), dtype=np.float32)
+    temperatures = temperature_range + DMSO_FACTOR * dmso_percent + 273.15
+    entropy = _DS + 0.368 * np.log(equivalent_sodium(cations, free_mg))
+    stack_weights = np.exp(-(_DH[:, None] - temperatures * entropy[:, None]) / (GAS_CONSTANT * temperatures))
+    # batch sequences of similar length together to limit padding
+    order = sorted((i for i, X in enumerate(sequences) if len(X) > 1), key=lambda i: len(sequences[i]))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        result[batch] = _melt_batch([sequences[i] for i in batch], stack_weights, sigma)
+    return result
+
+
+class LocalMeltService:
+    """A local, offline drop-in for UmeltService.
+
+    Responses are helicity arrays predicted in-process rather than
+    uMelt XML, so get_helicity_info(get_response(seq)) works as it
+    does for the web service.
+    """
+
+    def __init__(self, sigma=SIGMA):
+        self.sigma = sigma
+        self.temperature_range = TEMPERATURE_RANGE
+
+    def get_response(self, sequence):
+        """Predict helicity for a MeltSeq object.
+
+        Returns a numpy array of helicity (%) over the uMelt
+        temperature range.
+        """
+
+        return predict_helicity([sequence.sequence], sequence.cations, sequence.free_mg,
+                                sequence.dmso_percent, self.temperature_range, self.sigma)[0]
+
+    def get_helicity_info(self, response):
+
+        return HelicityInfo(response, self.temperature_range)
+
+    def melt(self, sequence):
+        """Melt a MeltSeq object, returning a HelicityInfo object."""
+
+        return self.get_helicity_info(self.get_response(sequence))
+
+    def melt_many(self, sequences):
+        """Melt MeltSeq objects in vectorised batches, one batch
+        per set of melt conditions.
+
+        Returns a list of MeltResult objects in input order.
+        """
+
+        sequences = list(sequences)
+        groups = {}
+        for i, sequence in enumerate(sequences):
+            conditions = (sequence.cations, sequence.free_mg, sequence.dmso_percent)
+            groups.setdefault(conditions, []).append(i)
+        results = [None] * len(sequences)
+        for (cations, free_mg, dmso_percent), members in groups.items():
+            with metrics.timer('melt_local'):
+                helicity = predict_helicity([sequences[i].sequence for i in members], cations, free_mg,
+                                            dmso_percent, self.temperature_range, self.sigma)
+            for i, row in zip(members, helicity):
+                results[i] = MeltResult(sequences[i], self.get_helicity_info(row), None)
+        return results
+
+    def close(self):
+        """Nothing to release; here so services can be closed alike."""
@@ -0,0 +1,248 @@
+"""
+Run metrics
+-----------
+
+Per-stage wall time, call counts, counters (cache hits, failures, ...) and
+latency histograms, collected across a design run and summarised as JSON.
+
+Collection is off until enable() is called; while off, timer() hands back
+a shared do-nothing context manager and count() and observe() return at
+once, so instrumented code pays next to nothing. Worker processes collect
+into their own registry and send snapshots back to be merged.
+
+Usage:
+
+    from pcr_marker_design import metrics
+    with metrics.timer('primer3'):
+        ...
+    metrics.count('p3_cache_hits')
+    metrics.observe('target_seconds', elapsed)
+"""
+
+import bisect
+import json
+import sys
+import threading
+import time
+
+## histogram bucket upper bounds in seconds, 1 ms to about 4 minutes
+BUCKETS = tuple(2.0 ** X for X in range(-10, 9))
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics(object):
+    """A registry of stage timers, counters and histograms"""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+
+    def timer(self, name):
+        """Context manager adding its wall time to stage name"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            entry = self.timers.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def count(self, name, n=1):
+        """Add n to counter name"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        """Add a latency to histogram name"""
+        if not self.enabled:
+            return
+        with self._lock:
+            counts = self.histograms.setdefault(name, [0] * (len(BUCKETS) + 1))
+            counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        """Plain, picklable copy of what has been collected"""
+        with self._lock:
+            return dict(timers=dict((X, list(Y)) for X, Y in self.timers.items()),
+                        counters=dict(self.counters),
+                        histograms=dict((X, list(Y)) for X, Y in self.histograms.items()))
+
+    def merge(self, snapshot):
+        """Add a snapshot, e.g. from a worker process"""
+        with self._lock:
+            for name, (calls, total, longest) in snapshot['timers'].items():
+                entry = self.timers.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += calls
+                entry[1] += total
+                entry[2] = max(entry[2], longest)
+            for name, n in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, counts in snapshot['histograms'].items():
+                mine = self.histograms.setdefault(name, [0] * (len(BUCKETS) + 1))
+                for i, n in enumerate(counts):
+                    mine[i] += n
+
+    def summary(self):
+        """JSON-ready summary of the run so far"""
+        snapshot = self.snapshot()
+        stages = dict((name, dict(calls=calls, seconds=total, mean_seconds=total / calls if calls else 0,
+                                  max_seconds=longest))
+                      for name, (calls, total, longest) in snapshot['timers'].items())
+        histograms = {}
+        for name, counts in snapshot['histograms'].items():
+            histograms[name] = dict(count=sum(counts),
+                                    buckets=[dict(le=le, count=n) for le, n in
+                                             zip(list(BUCKETS) + ['inf'], counts) if n],
+                                    p50=_quantile(counts, 0.5), p90=_quantile(counts, 0.9),
+                                    p99=_quantile(counts, 0.99))
+        return dict(wall_seconds=time.time() - self.started, stages=stages,
+                    counters=snapshot['counters'], histograms=histograms)
+
+    def dump(self, path):
+        """Write the summary as JSON to path"""
+        with open(path, 'w') as handle:
+            json.dump(self.summary(), handle, indent=2, sort_keys=True)
+
+
+def _quantile(counts, q):
+    """Upper bucket bound below which fraction q of observations fall"""
+    total = sum(counts)
+    if not total:
+        return None
+    running = 0
+    for le, n in zip(BUCKETS, counts):
+        running += n
+        if running >= q * total:
+            return le
+    return 'inf'
+
+
+class Progress(object):
+    """Reports progress and ETA on stream at most every interval seconds.
+
+    total, if known, is the number of items expected.
+    """
+
+    def __init__(self, total=None, interval=10.0, stream=None, label='targets'):
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.label = label
+        self.done = 0
+        self.started = time.monotonic()
+        self._last = self.started
+
+    def update(self, n=1):
+        self.done += n
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.monotonic()) - self.started
+        rate = self.done / elapsed if elapsed else 0
+        line = '{0} {1}'.format(self.done, self.label)
+        if self.total:
+            line = '{0}/{1} {2}'.format(self.done, self.total, self.label)
+        line += ', {0:.1f}/s, elapsed {1}'.format(rate, _hms(elapsed))
+        if self.total and rate:
+            line += ', ETA {0}'.format(_hms(max(self.total - self.done, 0) / rate))
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+
+def _hms(seconds):
+    seconds = int(round(seconds))
+    return '{0}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+## the registry for this process
+
+METRICS = Metrics()
+
+
+def enable():
+    METRICS.enabled = True
+
+
+def disable():
+    METRICS.enabled = False
+
+
+def enabled():
+    return METRICS.enabled
+
+
+def reset():
+    METRICS.reset()
+
+
+def timer(name):
+    """Context manager timing stage name, a no-op unless enabled"""
+    if not METRICS.enabled:
+        return _NULL_TIMER
+    return _Timer(METRICS, name)
+
+
+def count(name, n=1):
+    if METRICS.enabled:
+        METRICS.count(name, n)
+
+
+def observe(name, seconds):
+    if METRICS.enabled:
+        METRICS.observe(name, seconds)
+
+
+def timed_iter(name, iterable):
+    """Iterate, timing each step under stage name when enabled"""
+    if not METRICS.enabled:
+        for item in iterable:
+            yield item
+        return
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        METRICS.add_time(name, time.perf_counter() - start)
+        yield item
@@ -0,0 +1,197 @@
+"""
+Multiplex compatibility
+-----------------------
+
+Screens designed primer pairs for primer dimers between pairs, builds a
+conflict graph and assigns the pairs to multiplex pools with no conflict
+inside a pool.
+
+An exact primer3 heterodimer calculation takes a fraction of a
+millisecond, so checking every primer against every other does not scale
+past a few thousand targets. A primer dimer is only extended if a
+primer's 3' end anneals to the other primer, which then contains the
+reverse complement of that 3' end. Candidates are found with an index of
+the k-mers of every primer: only pairs where the last k bases of one,
+reverse complemented, occur in the other get an exact heterodimer dG,
+and those checks run in chunks over a process pool.
+
+Usage:
+
+    pairs = pairs_from_rows(output.read_rows('design.tsv'))
+    conflicts = conflict_graph(pairs, max_dg=-9000, jobs=8)
+    pools = assign_pools(pairs, conflicts, pool_size=12)
+"""
+
+import multiprocessing
+from collections import OrderedDict, defaultdict, namedtuple
+
+import numpy as np
+import primer3
+
+from pcr_marker_design import metrics
+
+Pair = namedtuple('Pair', ['pair_id', 'target_id', 'rank', 'left', 'right'])
+
+_COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+def reverse_complement(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def pairs_from_rows(rows, pairs_per_target=1):
+    """Primer pairs from design result rows, the first pairs_per_target
+    of each target (primer3's best first) as candidates for pooling.
+    """
+    pairs = []
+    seen = defaultdict(int)
+    for row in rows:
+        target_id, left, right = row[0], row[5], row[6]
+        rank = seen[target_id]
+        seen[target_id] += 1
+        if rank < pairs_per_target:
+            pairs.append(Pair('{0}#{1}'.format(target_id, rank), target_id, rank, left.upper(), right.upper()))
+    return pairs
+
+
+def kmer_index(primers, k):
+    """k-mer to the indices of the primers containing it"""
+    index = defaultdict(list)
+    for i, primer in enumerate(primers):
+        for kmer in set(primer[j:j + k] for j in range(len(primer) - k + 1)):
+            index[kmer].append(i)
+    return index
+
+
+def candidate_dimers(primers, k=5):
+    """Index pairs of primers where the 3' end k-mer of one is
+    complementary to a k-mer of the other, as an (n, 2) array of
+    (i, j), i < j, sorted.
+    """
+    index = kmer_index(primers, k)
+    ## the index flattened: primers of each k-mer in one array, found by offset and count
+    kmer_ids = dict((X, i) for i, X in enumerate(index))
+    counts = np.array([len(X) for X in index.values()], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    holders = np.fromiter((X for Y in index.values() for X in Y), dtype=np.int64, count=int(counts.sum()))
+    tails = np.array([kmer_ids.get(reverse_complement(X[-k:]), -1) if len(X) >= k else -1 for X in primers],
+                     dtype=np.int64)
+    primer_ids = np.flatnonzero(tails >= 0)
+    hits = counts[tails[primer_ids]]
+    ## every (primer, holder of its tail's complement), without a Python loop per candidate
+    left = np.repeat(primer_ids, hits)
+    within = np.arange(hits.sum()) - np.repeat(np.cumsum(hits) - hits, hits)
+    right = holders[np.repeat(offsets[tails[primer_ids]], hits) + within]
+    keep = left != right
+    low, high = np.minimum(left[keep], right[keep]), np.maximum(left[keep], right[keep])
+    pairs = np.sort(low * len(primers) + high)
+    pairs = pairs[np.concatenate([[True], pairs[1:] != pairs[:-1]])] if len(pairs) else pairs
+    return np.column_stack([pairs // max(len(primers), 1), pairs % max(len(primers), 1)])
+
+
+# process pool workers hold the primers and dimer conditions, set by the pool initializer
+
+_worker_primers = None
+_worker_thermo = None
+
+
+def _init_worker(primers, thermo):
+    global _worker_primers, _worker_thermo
+    _worker_primers = primers
+    _worker_thermo = thermo
+
+
+def _heterodimer_dgs(chunk, primers=None, thermo=None):
+    primers = _worker_primers if primers is None else primers
+    thermo = _worker_thermo if thermo is None else thermo
+    return [primer3.calc_homodimer(primers[i], **thermo).dg if i == j else
+            primer3.calc_heterodimer(primers[i], primers[j], **thermo).dg for i, j in chunk.tolist()]
+
+
+def dimer_dgs(primers, candidates, jobs=1, chunk_size=2000, **thermo):
+    """primer3 dimer dG, in cal/mol, of each (i, j) pair of primers in
+    candidates, in order: the heterodimer, or the homodimer where i == j.
+    thermo passes conditions (mv_conc, dna_conc, temp_c, ...) on to
+    primer3. jobs is the number of worker processes; 1 calculates in this
+    process and 0 or None uses all CPUs.
+    """
+    candidates = np.asarray(candidates, dtype=np.int64).reshape(-1, 2)
+    chunks = [candidates[i:i + chunk_size] for i in range(0, len(candidates), chunk_size)]
+    if jobs == 1 or len(chunks) < 2:
+        return np.array([X for chunk in chunks for X in _heterodimer_dgs(chunk, primers, thermo)], dtype=float)
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count(), initializer=_init_worker,
+                                initargs=(primers, thermo))
+    try:
+        dgs = np.array([X for result in pool.imap(_heterodimer_dgs, chunks) for X in result], dtype=float)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return dgs
+
+
+def conflict_graph(pairs, max_dg=-9000.0, k=5, jobs=1, **thermo):
+    """Conflicts between primer pairs: a primer of one forms a dimer with
+    a primer of the other with dG at or below max_dg (cal/mol), including
+    the homodimer of a primer both pairs use.
+
+    Returns a mapping of each pair ID to a dict of the pair IDs it
+    conflicts with and the lowest dG between them. Pairs for the same
+    target never share a pool, so have no conflicts with each other, and
+    dimers within a pair are left to primer3's own PRIMER_PAIR_MAX_COMPL_*
+    checks.
+    """
+    ## each distinct primer sequence is checked once, for all pairs using it
+    primers = list(OrderedDict.fromkeys(X for pair in pairs for X in (pair.left, pair.right)))
+    position = dict((X, i) for i, X in enumerate(primers))
+    users = defaultdict(list)
+    for pair in pairs:
+        for primer in set((pair.left, pair.right)):
+            users[position[primer]].append(pair)
+    with metrics.timer('dimer_prefilter'):
+        candidates = candidate_dimers(primers, k)
+        ## primers of more than one target's pairs can dimerise with themselves in a pool
+        shared = [i for i, X in sorted(users.items()) if len(set(Y.target_id for Y in X)) > 1
+                  and len(primers[i]) >= k and reverse_complement(primers[i][-k:]) in primers[i]]
+        candidates = np.concatenate([candidates, np.column_stack([shared, shared]).astype(np.int64)])
+    metrics.count('dimer_candidates', len(candidates))
+    with metrics.timer('dimer_dg'):
+        dgs = dimer_dgs(primers, candidates, jobs=jobs, **thermo)
+    graph = OrderedDict((pair.pair_id, {}) for pair in pairs)
+    strong = dgs <= max_dg
+    for (i, j), dg in zip(candidates[strong].tolist(), dgs[strong].tolist()):
+        for a in users[i]:
+            for b in users[j]:
+                if a.target_id != b.target_id:
+                    graph[a.pair_id][b.pair_id] = min(dg, graph[a.pair_id].get(b.pair_id, dg))
+                    graph[b.pair_id][a.pair_id] = graph[a.pair_id][b.pair_id]
+    metrics.count('dimer_conflicts', sum(len(X) for X in graph.values()) // 2)
+    return graph
+
+
+def assign_pools(pairs, conflicts, pool_size=None):
+    """Greedily assign one pair per target to pools with no conflicts
+    inside a pool, and at most pool_size pairs per pool.
+
+    Targets are placed most constrained first, by the number of conflicts
+    of their best pair, each into the first pool one of its pairs (in rank
+    order) fits; a target no pool can take opens a new pool. Returns the
+    pools as lists of Pairs, in input order within each pool.
+    """
+    by_target = OrderedDict()
+    for order, pair in enumerate(pairs):
+        by_target.setdefault(pair.target_id, []).append((order, pair))
+    targets = sorted(by_target.values(), key=lambda X: (-len(conflicts.get(X[0][1].pair_id, ())), X[0][0]))
+    pools = []
+    for options in targets:
+        for members in pools:
+            if pool_size and len(members) >= pool_size:
+                continue
+            fits = [X for X in options if not any(Y[1].pair_id in conflicts.get(X[1].pair_id, ()) for Y in members)]
+            if fits:
+                members.append(fits[0])
+                break
+        else:
+            pools.append([options[0]])
+    metrics.count('multiplex_pools', len(pools))
+    return [[pair for _, pair in sorted(members)] for members in pools]
@@ -0,0 +1,258 @@
+"""
+Streaming result writers
+------------------------
+
+Writers for primer design result rows. Each row is written as soon as it
+is produced; text formats flush every flush_every rows or flush_seconds,
+whichever comes first, and columnar formats hold at most flush_every rows
+before writing a chunk, so output keeps pace with a long run.
+
+Formats:
+
+- text: space separated, as design_primers.py has always printed
+- tsv: tab separated, with a header line
+- jsonl: one JSON object per row, "NA" as null
+- parquet: Apache Parquet, one row group per chunk (needs pyarrow)
+- npz: NumPy arrays per column, written on close
+"""
+
+import json
+import math
+import sys
+import time
+
+COLUMNS = ("SNP_Target_ID", "Position", "Ref_base", "Variant_base", "Amplicon_bp",
+           "PRIMER_LEFT_SEQUENCE", "PRIMER_RIGHT_SEQUENCE", "ref_melt_Tm", "var_melt_Tm", "Tm_difference")
+
+## column types for the typed formats
+_TYPES = (str, int, str, str, int, str, str, float, float, float)
+## NumPy dtypes of the npz format, by column type, as named by np.dtype
+_NUMPY_TYPES = {str: 'str', int: 'int64', float: 'float64'}
+
+FORMATS = ('text', 'tsv', 'jsonl', 'parquet', 'npz')
+
+_EXTENSIONS = {'.tsv': 'tsv', '.jsonl': 'jsonl', '.json': 'jsonl',
+               '.parquet': 'parquet', '.npz': 'npz'}
+
+
+def guess_format(path):
+    """Output format implied by a file name, text if none is"""
+    if path:
+        for extension, format in _EXTENSIONS.items():
+            if path.endswith(extension):
+                return format
+    return 'text'
+
+
+def _typed(row):
+    """Row values as their column types, with NA or missing values as None"""
+    return [None if value is None or value == "NA" else kind(value)
+            for kind, value in zip(_TYPES, row)]
+
+
+class ResultWriter(object):
+    """Base class for writers: write rows, then close.
+
+    path of None or '-' writes to standard output, for the formats
+    that can.
+    """
+    binary = False
+
+    def __init__(self, path=None, flush_every=64, flush_seconds=1.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.rows = 0
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._owned = path not in (None, '-')
+        if self._owned:
+            self.handle = open(path, 'wb' if self.binary else 'w')
+        else:
+            self.handle = sys.stdout.buffer if self.binary else sys.stdout
+        self.start()
+
+    def start(self):
+        pass
+
+    def write(self, row):
+        """Write one result row, a tuple of values in COLUMNS order"""
+        self.write_row(row)
+        self.rows += 1
+        self._pending += 1
+        if self._pending >= self.flush_every or \
+                time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def write_row(self, row):
+        raise NotImplementedError
+
+    def flush(self):
+        self.handle.flush()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def finish(self):
+        pass
+
+    def close(self):
+        self.finish()
+        self.handle.flush()
+        if self._owned:
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TextWriter(ResultWriter):
+    """Delimited text, values as str() gives them"""
+
+    def __init__(self, path=None, sep=' ', **options):
+        self.sep = sep
+        super(TextWriter, self).__init__(path, **options)
+
+    def start(self):
+        self.handle.write(self.sep.join(COLUMNS) + '\n')
+
+    def write_row(self, row):
+        self.handle.write(self.sep.join(str(X) for X in row) + '\n')
+
+
+class JsonLinesWriter(ResultWriter):
+    """One JSON object per row"""
+
+    def write_row(self, row):
+        self.handle.write(json.dumps(dict(zip(COLUMNS, _typed(row)))) + '\n')
+
+
+class _ColumnarWriter(ResultWriter):
+    """Collects rows into column chunks of up to flush_every rows"""
+    binary = True
+
+    def start(self):
+        self._columns = [[] for _ in COLUMNS]
+
+    def write_row(self, row):
+        for column, value in zip(self._columns, _typed(row)):
+            column.append(value)
+
+    def flush(self):
+        if self._columns[0]:
+            self.write_chunk(self._columns)
+            self._columns = [[] for _ in COLUMNS]
+        super(_ColumnarWriter, self).flush()
+
+    def finish(self):
+        self.flush()
+
+
+class ParquetWriter(_ColumnarWriter):
+    """Apache Parquet, one row group per chunk"""
+
+    def __init__(self, path, flush_every=10000, **options):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("parquet output needs pyarrow, use npz output instead or install pyarrow")
+        self._pa = pyarrow
+        types = {str: pyarrow.string(), int: pyarrow.int64(), float: pyarrow.float64()}
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in zip(COLUMNS, _TYPES)])
+        super(ParquetWriter, self).__init__(path, flush_every=flush_every, flush_seconds=float('inf'), **options)
+        self._parquet = pyarrow.parquet.ParquetWriter(self.handle, self.schema)
+
+    def write_chunk(self, columns):
+        self._parquet.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(X, type=F.type) for X, F in zip(columns, self.schema)], schema=self.schema))
+
+    def finish(self):
+        super(ParquetWriter, self).finish()
+        self._parquet.close()
+
+
+class NpzWriter(_ColumnarWriter):
+    """NumPy .npz of one array per column.
+
+    The format cannot be appended to, so chunks are kept as arrays,
+    which are much more compact than rows, and saved on close. Missing
+    values are NaN in float columns.
+    """
+
+    def __init__(self, path, flush_every=10000, **options):
+        import numpy
+        self._np = numpy
+        self._chunks = [[] for _ in COLUMNS]
+        super(NpzWriter, self).__init__(path, flush_every=flush_every, flush_seconds=float('inf'), **options)
+
+    def write_chunk(self, columns):
+        for chunks, kind, values in zip(self._chunks, _TYPES, columns):
+            if kind is float:
+                values = [math.nan if X is None else X for X in values]
+            chunks.append(self._np.array(values, dtype=_NUMPY_TYPES[kind]))
+
+    def finish(self):
+        super(NpzWriter, self).finish()
+        np = self._np
+        np.savez_compressed(self.handle, **dict(
+            (name, np.concatenate(chunks) if chunks else np.zeros(0, dtype=_NUMPY_TYPES[kind]))
+            for name, kind, chunks in zip(COLUMNS, _TYPES, self._chunks)))
+
+
+def open_writer(path=None, format=None, **options):
+    """Open a result writer for path (None or '-' for standard output)
+    in format, which if not given is guessed from the file name.
+    """
+    format = format or guess_format(path)
+    if format in ('parquet', 'npz') and path in (None, '-'):
+        raise ValueError("{0} output needs an output file".format(format))
+    if format == 'text':
+        return TextWriter(path, **options)
+    if format == 'tsv':
+        return TextWriter(path, sep='\t', **options)
+    if format == 'jsonl':
+        return JsonLinesWriter(path, **options)
+    if format == 'parquet':
+        return ParquetWriter(path, **options)
+    if format == 'npz':
+        return NpzWriter(path, **options)
+    raise ValueError("unknown output format {0}, expected one of {1}".format(format, ', '.join(FORMATS)))
+
+
+def read_rows(path, format=None):
+    """Read result rows back from a file written in format, guessed from
+    the file name if not given, as tuples of typed values with None for
+    missing ones.
+    """
+    format = format or guess_format(path)
+    if format in ('text', 'tsv'):
+        sep = ' ' if format == 'text' else '\t'
+        with open(path) as handle:
+            if handle.readline().rstrip('\n') != sep.join(COLUMNS):
+                raise ValueError("{0} is not {1} output".format(path, format))
+            for line in handle:
+                yield tuple(_typed(line.rstrip('\n').split(sep)))
+    elif format == 'jsonl':
+        with open(path) as handle:
+            for line in handle:
+                record = json.loads(line)
+                yield tuple(_typed([record[X] for X in COLUMNS]))
+    elif format == 'parquet':
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("reading parquet output needs pyarrow")
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(columns=list(COLUMNS)):
+            for row in zip(*[X.to_pylist() for X in batch.columns]):
+                yield row
+    elif format == 'npz':
+        import numpy as np
+        with np.load(path) as arrays:
+            columns = [arrays[X].tolist() for X in COLUMNS]
+        for row in zip(*columns):
+            yield tuple(None if isinstance(X, float) and math.isnan(X) else X for X in row)
+    else:
+        raise ValueError("unknown output format {0}, expected one of {1}".format(format, ', '.join(FORMATS)))
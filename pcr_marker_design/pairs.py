@@ -0,0 +1,145 @@
+"""
+Primer pair records
+-------------------
+
+Compact records of designed primer pairs.
+
+A PrimerPair holds one pair in slots rather than a dict per pair, and
+keeps primer3's penalties, Tm and GC content, which the dicts run_P3 used
+to return left out. It reads like one of those dicts, with the extra
+fields under primer3's own names less the pair number:
+
+    pair['PRIMER_LEFT']           # (start, length), as before
+    pair['PRIMER_PAIR_PENALTY']   # and the new fields
+    dict(pair, TARGET_IDS=ids)    # copies into a plain dict
+
+A PrimerPairTable holds any number of pairs as columns of one NumPy
+structured array, for bulk results; indexing it with a number gives a
+PrimerPair, with a field name the whole column.
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+
+## slots, in the order records are built from
+FIELDS = ('target_id', 'seq_id', 'left_seq', 'right_seq', 'left_start', 'left_length', 'right_start',
+          'right_length', 'penalty', 'left_penalty', 'right_penalty', 'left_tm', 'right_tm', 'left_gc',
+          'right_gc', 'product_size')
+
+## the dict keys of a pair, and the slots they come from
+_KEYS = dict(TARGET_ID='target_id', SEQUENCE_ID='seq_id', PRIMER_LEFT_SEQUENCE='left_seq',
+             PRIMER_RIGHT_SEQUENCE='right_seq', PRIMER_PAIR_PENALTY='penalty', PRIMER_LEFT_PENALTY='left_penalty',
+             PRIMER_RIGHT_PENALTY='right_penalty', PRIMER_LEFT_TM='left_tm', PRIMER_RIGHT_TM='right_tm',
+             PRIMER_LEFT_GC_PERCENT='left_gc', PRIMER_RIGHT_GC_PERCENT='right_gc',
+             PRIMER_PAIR_PRODUCT_SIZE='product_size')
+_DERIVED = dict(PRIMER_LEFT=lambda X: (X.left_start, X.left_length),
+                PRIMER_RIGHT=lambda X: (X.right_start, X.right_length),
+                AMPLICON_REGION=lambda X: X.amplicon_region)
+KEYS = tuple(_KEYS) + tuple(_DERIVED)
+
+
+class PrimerPair(Mapping):
+    """A designed primer pair, with positions on the sequence seq_id.
+
+    Fields are given in FIELDS order. Positions are primer3's: left_start
+    is the 5' end of the left primer and right_start the 5' end, the
+    rightmost base, of the right primer.
+    """
+
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        if len(values) != len(FIELDS):
+            raise TypeError("PrimerPair takes {0} fields, not {1}".format(len(FIELDS), len(values)))
+        for name, value in zip(FIELDS, values):
+            setattr(self, name, value)
+
+    @property
+    def amplicon_region(self):
+        """One-based sequence:start-end of the amplicon, or None for a pair
+        without a sequence ID
+        """
+        if self.seq_id is None:
+            return None
+        return '{0}:{1}-{2}'.format(self.seq_id.split(':')[0], self.left_start + 1, self.right_start + 1)
+
+    def __getitem__(self, key):
+        if key in _KEYS:
+            return getattr(self, _KEYS[key])
+        if key in _DERIVED:
+            return _DERIVED[key](self)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(KEYS)
+
+    def __len__(self):
+        return len(KEYS)
+
+    def __reduce__(self):
+        return PrimerPair, tuple(getattr(self, X) for X in FIELDS)
+
+    def __repr__(self):
+        return 'PrimerPair({0})'.format(', '.join('{0}={1!r}'.format(X, getattr(self, X)) for X in FIELDS))
+
+
+_STRINGS = ('target_id', 'seq_id', 'left_seq', 'right_seq')
+
+
+def _dtype(pairs):
+    """Structured array dtype for pairs, with strings as wide as the longest"""
+    width = dict((X, max([len(getattr(Y, X) or '') for Y in pairs] + [1])) for X in _STRINGS)
+    return np.dtype([(X, 'S{0}'.format(width[X])) for X in _STRINGS] +
+                    [('left_start', np.int64), ('left_length', np.int16), ('right_start', np.int64),
+                     ('right_length', np.int16)] +
+                    [(X, np.float64) for X in ('penalty', 'left_penalty', 'right_penalty', 'left_tm', 'right_tm',
+                                               'left_gc', 'right_gc')] +
+                    [('product_size', np.int32)])
+
+
+class PrimerPairTable(object):
+    """Primer pairs as columns of a NumPy structured array, one row per
+    pair with the fields of FIELDS. IDs and sequences are held as ASCII
+    bytes, a byte a base.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """A table of PrimerPairs, or of any records with their fields"""
+        pairs = list(pairs)
+        array = np.empty(len(pairs), dtype=_dtype(pairs))
+        for name in FIELDS:
+            if name in _STRINGS:
+                array[name] = [(getattr(X, name) or '').encode('ascii') for X in pairs]
+            else:
+                array[name] = [getattr(X, name) for X in pairs]
+        return cls(array)
+
+    @classmethod
+    def from_results(cls, results):
+        """A table of the pairs of many targets' results, as from
+        DesignSession.design_many, in order
+        """
+        return cls.from_pairs(X for pairs in results for X in pairs)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.array[key]
+        if isinstance(key, (int, np.integer)):
+            values = dict((X, self.array[key][X].item()) for X in FIELDS)
+            values.update((X, values[X].decode('ascii')) for X in _STRINGS)
+            ## a pair without IDs is stored with empty ones
+            values.update(target_id=values['target_id'] or None, seq_id=values['seq_id'] or None)
+            return PrimerPair(*[values[X] for X in FIELDS])
+        return PrimerPairTable(self.array[key])
+
+    def __iter__(self):
+        for i in range(len(self.array)):
+            yield self[i]
@@ -0,0 +1,170 @@
+"""
+Staged pipelines
+----------------
+
+Runs a stream of items through a chain of stages on an asyncio event
+loop, so that stages waiting on different things (file reads, worker
+processes, network round trips) overlap instead of taking turns.
+
+Items are read from the source iterable in a thread of their own and
+passed from stage to stage through bounded queues; a stage that falls
+behind fills its input queue, which holds up the stages before it rather
+than letting work pile up in memory. Each stage runs up to its number of
+workers items at a time. A stage function is either a coroutine function,
+awaited on the loop, or a plain function, run on the stage's executor: a
+thread pool of that many workers unless one is given.
+
+Results come out of a plain generator, in source order, or with ordered
+False as soon as each is ready. Either way at most max_pending items are
+between the source and the consumer, which bounds the results held back
+waiting for a slow item. An exception in any stage stops the pipeline and
+is raised by the generator.
+
+Needs Python 3.7 or later, for asyncio.get_running_loop and all_tasks; the
+package requires 3.8.
+
+Usage:
+
+    stages = [Stage('design', design, workers=4), Stage('melt', melt, workers=8)]
+    for result in run_pipeline(targets, stages):
+        ...
+"""
+
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from pcr_marker_design import metrics
+
+
+class Stage(namedtuple('Stage', ['name', 'func', 'workers', 'executor'])):
+    """A pipeline stage: func(item) gives the item for the next stage,
+    up to workers items at a time, run on executor if not a coroutine
+    function
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, name, func, workers=1, executor=None):
+        if workers < 1:
+            raise ValueError("stage {0} needs at least one worker".format(name))
+        return super(Stage, cls).__new__(cls, name, func, workers, executor)
+
+
+## marks the end of the stream in a queue
+_DONE = object()
+
+
+async def _read(items, outbox, pending, reader):
+    loop = asyncio.get_running_loop()
+    iterator = iter(items)
+    number = 0
+    while True:
+        await pending.acquire()
+        item = await loop.run_in_executor(reader, next, iterator, _DONE)
+        if item is _DONE:
+            break
+        await outbox.put((number, item))
+        number += 1
+    await outbox.put(_DONE)
+
+
+async def _work(stage, run, inbox, outbox, running):
+    while True:
+        entry = await inbox.get()
+        if entry is _DONE:
+            ## left for the stage's other workers; the last one out passes it on
+            inbox.put_nowait(_DONE)
+            running[stage.name] -= 1
+            if not running[stage.name]:
+                await outbox.put(_DONE)
+            return
+        number, item = entry
+        with metrics.timer('pipeline_' + stage.name):
+            result = await run(item)
+        await outbox.put((number, result))
+
+
+def _runner(stage, executor):
+    if asyncio.iscoroutinefunction(stage.func):
+        return stage.func
+
+    async def run(item):
+        return await asyncio.get_running_loop().run_in_executor(executor, stage.func, item)
+    return run
+
+
+async def _emit(inbox, outbox, ordered):
+    waiting = {}
+    number = 0
+    while True:
+        entry = await inbox.get()
+        if entry is _DONE:
+            await outbox.put(_DONE)
+            return
+        if not ordered:
+            await outbox.put(entry[1])
+            continue
+        waiting[entry[0]] = entry[1]
+        while number in waiting:
+            await outbox.put(waiting.pop(number))
+            number += 1
+
+
+async def _cancel(tasks, supervisor=None):
+    for task in tasks:
+        task.cancel()
+    ## the supervisor's exception, if any, has been raised or is moot, but must be collected
+    futures = list(tasks) + ([] if supervisor is None else [supervisor])
+    await asyncio.gather(*futures, return_exceptions=True)
+
+
+def run_pipeline(items, stages, ordered=True, queue_size=4, max_pending=None):
+    """Run items through stages, a list of Stages, yielding the results of
+    the last stage.
+
+    queue_size bounds the queue in front of each stage and of the output.
+    max_pending defaults to enough items to keep every worker busy and
+    every queue full.
+    """
+    stages = list(stages)
+    if max_pending is None:
+        max_pending = sum(X.workers for X in stages) + queue_size * (len(stages) + 1)
+    executors = [X.executor or ThreadPoolExecutor(X.workers) for X in stages]
+    reader = ThreadPoolExecutor(1)
+    loop = asyncio.new_event_loop()
+    supervisor = None
+
+    async def start():
+        queues = [asyncio.Queue(queue_size) for _ in range(len(stages) + 2)]
+        pending = asyncio.Semaphore(max_pending)
+        running = dict((X.name, X.workers) for X in stages)
+        tasks = [loop.create_task(_read(items, queues[0], pending, reader))]
+        for i, (stage, executor) in enumerate(zip(stages, executors)):
+            run = _runner(stage, executor)
+            tasks.extend(loop.create_task(_work(stage, run, queues[i], queues[i + 1], running))
+                         for _ in range(stage.workers))
+        tasks.append(loop.create_task(_emit(queues[-2], queues[-1], ordered)))
+        return queues[-1], pending, asyncio.gather(*tasks)
+
+    try:
+        outbox, pending, supervisor = loop.run_until_complete(start())
+        while True:
+            getter = loop.create_task(outbox.get())
+            done, _ = loop.run_until_complete(asyncio.wait([getter, supervisor], return_when=asyncio.FIRST_COMPLETED))
+            if getter not in done:
+                ## a stage failed, or every task has finished and the result is on its way
+                supervisor.result()
+                loop.run_until_complete(getter)
+            result = getter.result()
+            if result is _DONE:
+                break
+            pending.release()
+            yield result
+    finally:
+        loop.run_until_complete(_cancel(asyncio.all_tasks(loop), supervisor))
+        reader.shutdown()
+        for stage, executor in zip(stages, executors):
+            if stage.executor is None:
+                executor.shutdown()
+        loop.close()
@@ -1,6 +1,20 @@
 #!/usr/bin/python
 
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
 import primer3
+import primer3.thermoanalysis
+
+from pcr_marker_design import metrics
+from pcr_marker_design.pairs import PrimerPair, PrimerPairTable
 
 # run primer3 by passing Python dictionary
 
@@ -34,26 +48,319 @@ p3_globals = {
 # call P3 with dict of args, returns dict, no exception handling
 
 
-def run_P3(target_dict, global_dict):
-    P3_dict = primer3.bindings.designPrimers(target_dict, global_dict)
+def run_P3(target_dict, global_dict, cache=None):
+    """Design primers for a target dict, returning a list of PrimerPairs,
+    which read as dicts, with positions re-based by the target's REF_OFFSET.
+
+    cache is an optional DesignCache; designs are looked up in it before
+    primer3 is run, and re-based afterwards so that a cached design can be
+    reused at any offset. To design many targets with the same settings,
+    use a DesignSession.
+    """
+    if cache is None:
+        pairs = _design(target_dict, global_dict)
+    else:
+        pairs = _cached_design(target_dict, global_dict, cache, design_key(target_dict, global_dict))
+    return _primer_list(target_dict, pairs)
+
+
+def _cached_design(target_dict, global_dict, cache, key, analysis=None):
+    pairs = cache.get(key)
+    if pairs is None:
+        metrics.count('p3_cache_misses')
+        pairs = _design(target_dict, global_dict, analysis)
+        cache.put(key, pairs)
+    else:
+        metrics.count('p3_cache_hits')
+    return pairs
+
+
+def _primer_list(target_dict, pairs):
     # return iterable list
     my_offset=target_dict.get('REF_OFFSET',0)
     my_seq_id=target_dict.get('SEQUENCE_ID')
-    primer_list=[]
+    target_id=target_dict.get('TARGET_ID')
+    return [PrimerPair(target_id, my_seq_id, left_seq, right_seq, pr_left[0] + my_offset, pr_left[1],
+                       pr_right[0] + my_offset, pr_right[1], *scores)
+            for left_seq, right_seq, pr_left, pr_right, *scores in pairs]
+
+
+## primer3 result fields kept per pair, after the sequences and positions
+_SCORES = ('PRIMER_PAIR_{0}_PENALTY', 'PRIMER_LEFT_{0}_PENALTY', 'PRIMER_RIGHT_{0}_PENALTY', 'PRIMER_LEFT_{0}_TM',
+           'PRIMER_RIGHT_{0}_TM', 'PRIMER_LEFT_{0}_GC_PERCENT', 'PRIMER_RIGHT_{0}_GC_PERCENT',
+           'PRIMER_PAIR_{0}_PRODUCT_SIZE')
+
+
+def _design(target_dict, global_dict, analysis=None):
+    """Run primer3, returning (left sequence, right sequence, left (start, length),
+    right (start, length), pair penalty, left and right penalties, Tms and GC
+    percentages, product size) per pair, with positions relative to the template
+    """
+    metrics.count('p3_designs')
+    with metrics.timer('primer3'):
+        if analysis is None:
+            P3_dict = primer3.bindings.designPrimers(target_dict, global_dict)
+        else:
+            P3_dict = analysis.run_design(global_args=global_dict, seq_args=target_dict)
+    pairs = []
     for i in range(0, int(P3_dict.get('PRIMER_RIGHT_NUM_RETURNED')) - 1):
-        primer_dict=dict(TARGET_ID=target_dict.get('TARGET_ID'),
-                         SEQUENCE_ID=my_seq_id)
-        primer_dict['PRIMER_LEFT_SEQUENCE']=P3_dict.get('PRIMER_LEFT_' + str(i) + '_SEQUENCE')
-        primer_dict['PRIMER_RIGHT_SEQUENCE'] = P3_dict.get('PRIMER_RIGHT_' + str(i) + '_SEQUENCE')
-        pr_left=P3_dict.get('PRIMER_LEFT_' + str(i))
-        primer_dict['PRIMER_LEFT']=(pr_left[0] + my_offset,pr_left[1])
-        pr_right = P3_dict.get('PRIMER_RIGHT_' + str(i))
-        primer_dict['PRIMER_RIGHT'] = (pr_right[0] + my_offset, pr_right[1])
-        primer_dict['AMPLICON_REGION']= my_seq_id.split(':')[0] + ":" +\
-                                        str(pr_left[0] + my_offset + 1) + "-" + \
-                                        str(pr_right[0] + my_offset +1)
-
-        primer_list.append(primer_dict)
-
-    return primer_list
+        pairs.append((P3_dict.get('PRIMER_LEFT_' + str(i) + '_SEQUENCE'),
+                      P3_dict.get('PRIMER_RIGHT_' + str(i) + '_SEQUENCE'),
+                      tuple(P3_dict.get('PRIMER_LEFT_' + str(i))),
+                      tuple(P3_dict.get('PRIMER_RIGHT_' + str(i))))
+                     + tuple(P3_dict.get(X.format(i)) for X in _SCORES))
+    return pairs
+
+
+# design results are cached under a hash of everything primer3 sees,
+# less the keys that only label or place the result
+
+_UNKEYED = ('REF_OFFSET', 'SEQUENCE_ID', 'TARGET_ID')
+_CACHE_VERSION = 2
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def design_key(target_dict, global_dict, global_json=None):
+    """Canonical hash of a target dict (less REF_OFFSET and IDs) and global dict.
+
+    global_json, the canonical JSON of global_dict, can be given to save
+    encoding the same settings for every target.
+    """
+    target = dict((k, v) for k, v in target_dict.items() if k not in _UNKEYED)
+    ## the same as encoding [_CACHE_VERSION, target, global_dict] in one go
+    canonical = '[{0},{1},{2}]'.format(_CACHE_VERSION, _canonical(target),
+                                       _canonical(global_dict) if global_json is None else global_json)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class DesignCache(object):
+    """An in-memory LRU cache of primer3 designs, optionally backed by
+    a persistent SQLite store at path shared between runs and processes.
+    """
+
+    def __init__(self, maxsize=10000, path=None, timeout=60):
+        self.maxsize = maxsize
+        self.path = path
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if path is not None:
+            conn = self._connect()
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS design (key TEXT PRIMARY KEY, pairs TEXT NOT NULL)')
+
+    def _connect(self):
+        # connections must not cross a fork or a thread, so open one per process and thread
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=self.timeout)
+            local.conn.execute('PRAGMA journal_mode=WAL')
+            local.conn.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock'], state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _remember(self, key, pairs):
+        with self._lock:
+            self._lru[key] = pairs
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached pairs for key, or None"""
+        with self._lock:
+            pairs = self._lru.get(key)
+        if pairs is None and self.path is not None:
+            row = self._connect().execute('SELECT pairs FROM design WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                pairs = [(l, r, tuple(pl), tuple(pr)) + tuple(scores) for l, r, pl, pr, *scores in json.loads(row[0])]
+        if pairs is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, pairs)
+        return pairs
+
+    def put(self, key, pairs):
+        """Store the pairs designed for key"""
+        self._remember(key, pairs)
+        if self.path is not None:
+            conn = self._connect()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO design (key, pairs) VALUES (?, ?)',
+                             (key, json.dumps(pairs)))
+
+
+class DesignSession(object):
+    """Designs any number of targets against one set of primer3 global
+    settings.
+
+    The settings are copied, checked by primer3 and encoded for the design
+    cache once, when the session is made, and are not changed after; other
+    settings need another session. primer3-py 2 has no way to keep
+    settings loaded between designs, so primer3 itself still parses them
+    with each target's sequence settings on every design; the session
+    saves the copying and checking around that, not the parse. Each session runs primer3 through its
+    own ThermoAnalysis rather than the module-wide one, so sessions can be
+    used one per thread, and are pickled to worker processes.
+
+    global_dict defaults to p3_globals; keyword arguments override single
+    settings, e.g. DesignSession(PRIMER_PRODUCT_SIZE_RANGE=[[100, 300]]).
+    cache is an optional DesignCache.
+    """
+
+    def __init__(self, global_dict=None, cache=None, **settings):
+        self.global_dict = copy.deepcopy(dict(p3_globals if global_dict is None else global_dict, **settings))
+        self.cache = cache
+        self._global_json = _canonical(self.global_dict)
+        self._analysis = primer3.thermoanalysis.ThermoAnalysis()
+        self._check()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_analysis']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._analysis = primer3.thermoanalysis.ThermoAnalysis()
+
+    def _check(self):
+        """Raise ValueError now if primer3 rejects the settings, rather
+        than on the first target
+        """
+        ## an all-N template as long as the longest product has no primers to search
+        sizes = [int(X) for X in _flatten(self.global_dict.get('PRIMER_PRODUCT_SIZE_RANGE', []))] or [1000]
+        probe = dict(SEQUENCE_ID='probe', SEQUENCE_TEMPLATE='N' * (max(sizes) + 1))
+        try:
+            self._analysis.run_design(global_args=self.global_dict, seq_args=probe)
+        except (OSError, TypeError, ValueError) as error:
+            raise ValueError("primer3 rejects the global settings: {0}".format(error))
+
+    def design(self, target_dict):
+        """The run_P3 result for one target dict"""
+        if self.cache is None:
+            pairs = _design(target_dict, self.global_dict, self._analysis)
+        else:
+            key = design_key(target_dict, self.global_dict, self._global_json)
+            pairs = _cached_design(target_dict, self.global_dict, self.cache, key, self._analysis)
+        return _primer_list(target_dict, pairs)
+
+    def design_table(self, target_dicts, jobs=1):
+        """The pairs designed for an iterable of target dicts, all in one
+        PrimerPairTable, in input order
+        """
+        return PrimerPairTable.from_results(self.design_many(target_dicts, jobs))
+
+    def pool(self, jobs=1):
+        """A process pool executor whose workers each hold a copy of the
+        session, to design in with design_in from any thread. jobs is as
+        for design_many.
+        """
+        pool = ProcessPoolExecutor(jobs or multiprocessing.cpu_count(), initializer=_init_worker,
+                                   initargs=(self, metrics.enabled()))
+        ## workers are forked on the first submission, so make it now, from the calling thread
+        pool.submit(_ping).result()
+        return pool
+
+    def design_in(self, pool, target_dict):
+        """The run_P3 result for one target dict, designed in a worker of
+        pool, a pool made by this session
+        """
+        return _collect(pool.submit(_run_worker, target_dict).result())
+
+    def design_many(self, target_dicts, jobs=1):
+        """Design an iterable of target dicts, yielding the result for each
+        in input order as soon as it is ready.
+
+        jobs is the number of worker processes; 1 designs serially in this
+        process and 0 or None uses all CPUs. At most a few targets per worker
+        are in flight, so long target streams are not read ahead into memory.
+        Each worker gets its own copy of the session, sharing the cache's
+        persistent store if it has one.
+        """
+        if jobs == 1:
+            for target_dict in target_dicts:
+                yield self.design(target_dict)
+            return
+        jobs = jobs or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(self, metrics.enabled()))
+        try:
+            max_pending = 4 * jobs
+            pending = deque()
+            for target_dict in target_dicts:
+                pending.append(pool.apply_async(_run_worker, (target_dict,)))
+                if len(pending) >= max_pending:
+                    yield _collect(pending.popleft().get())
+            while pending:
+                yield _collect(pending.popleft().get())
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def _flatten(value):
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            for X in _flatten(item):
+                yield X
+    else:
+        yield value
+
+
+# process pool workers hold a design session, set by the pool initializer,
+# and, if metrics are being collected, send theirs back with each result
+
+_worker_session = None
+
+
+def _init_worker(session, collect_metrics=False):
+    global _worker_session
+    _worker_session = session
+    if collect_metrics:
+        metrics.enable()
+
+
+def _ping():
+    return True
+
+
+def _run_worker(target_dict):
+    if not metrics.enabled():
+        return _worker_session.design(target_dict), None
+    metrics.reset()
+    return _worker_session.design(target_dict), metrics.METRICS.snapshot()
+
+
+def _collect(worker_result):
+    result, snapshot = worker_result
+    if snapshot is not None:
+        metrics.METRICS.merge(snapshot)
+    return result
+
+
+def run_P3_many(target_dicts, global_dict, jobs=1, cache=None):
+    """Run primer3 over an iterable of target dicts, yielding the run_P3
+    result for each in input order as soon as it is ready.
 
+    A DesignSession for global_dict and cache does the work; see
+    DesignSession.design_many for jobs.
+    """
+    return DesignSession(global_dict, cache).design_many(target_dicts, jobs)
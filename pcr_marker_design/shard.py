@@ -0,0 +1,211 @@
+"""
+Sharded design runs
+-------------------
+
+Splits a target list into N shards that can be designed on separate
+nodes, and merges the shard outputs back into exactly the rows, in exactly
+the order, that a single run would have produced.
+
+- split: targets are assigned to shards deterministically, either in
+  contiguous runs of near-equal size ('count') or as whole sequences
+  balanced by target count ('chrom'). A manifest records the assignment,
+  the reference sequence order and a digest of the target list.
+- work: design_primers.py --shard-manifest M --shard-index I -o FILE
+  designs one shard and, on success, writes FILE.done.
+- merge: the shard outputs are checked against the manifest (every shard
+  present and complete, every row in the right shard) and merged in
+  reference then target order.
+
+Shard outputs are merged as text, tsv or jsonl.
+"""
+
+import hashlib
+import heapq
+import json
+import os
+import re
+
+from pcr_marker_design import output
+
+MANIFEST_VERSION = 1
+SHARD_MODES = ('count', 'chrom')
+
+
+class ShardError(ValueError):
+    """Shard outputs do not add up to the run in the manifest"""
+
+
+def _digest(lines):
+    return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def balance(sizes, n_shards):
+    """Assign items of the given sizes to n_shards bins, largest first
+    to the least loaded bin, ties going to the earlier item and bin.
+    Returns the bin of each item.
+    """
+    loads = [(0, i) for i in range(n_shards)]
+    heapq.heapify(loads)
+    bins = [None] * len(sizes)
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i], i)):
+        load, shard = heapq.heappop(loads)
+        bins[i] = shard
+        heapq.heappush(loads, (load + sizes[i], shard))
+    return bins
+
+
+def assign_shards(targets, n_shards, by='count', target_delim=':'):
+    """Shard index of each target.
+
+    by='count' cuts the target list into contiguous runs of near-equal
+    length; by='chrom' keeps the targets of each sequence together and
+    balances target counts across shards.
+    """
+    if n_shards < 1:
+        raise ValueError("need at least one shard")
+    if by == 'count':
+        return [i * n_shards // len(targets) for i in range(len(targets))]
+    if by == 'chrom':
+        seq_ids = [re.split(target_delim, X)[0] for X in targets]
+        order = list(dict.fromkeys(seq_ids))
+        sizes = dict.fromkeys(order, 0)
+        for seq_id in seq_ids:
+            sizes[seq_id] += 1
+        bins = dict(zip(order, balance([sizes[X] for X in order], n_shards)))
+        return [bins[X] for X in seq_ids]
+    raise ValueError("unknown shard mode {0}, expected one of {1}".format(by, ', '.join(SHARD_MODES)))
+
+
+def split(targets, sequence_order, out_dir, n_shards, by='count', target_delim=':'):
+    """Write the target list of each shard and a manifest into out_dir.
+
+    sequence_order is the order of the sequences in the reference, which
+    decides the order of a single run's output. Returns the manifest path.
+    """
+    if len(set(targets)) != len(targets):
+        raise ShardError("the target list has duplicate IDs, which cannot be merged back in order")
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    shards = assign_shards(targets, n_shards, by, target_delim)
+    entries = []
+    for index in range(n_shards):
+        mine = [X for X, shard in zip(targets, shards) if shard == index]
+        name = 'shard-{0:04d}-of-{1:04d}.targets'.format(index, n_shards)
+        with open(os.path.join(out_dir, name), 'w') as handle:
+            handle.write(''.join(X + '\n' for X in mine))
+        entries.append(dict(index=index, targets=name, count=len(mine), digest=_digest(mine)))
+    manifest = dict(version=MANIFEST_VERSION, n_shards=n_shards, by=by, target_delim=target_delim,
+                    count=len(targets), digest=_digest(targets), sequence_order=list(sequence_order),
+                    assignment=shards, shards=entries)
+    path = os.path.join(out_dir, 'manifest.json')
+    with open(path, 'w') as handle:
+        json.dump(manifest, handle, indent=1)
+    return path
+
+
+def read_manifest(path):
+    with open(path) as handle:
+        manifest = json.load(handle)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ShardError("{0} is not a version {1} shard manifest".format(path, MANIFEST_VERSION))
+    manifest['path'] = path
+    return manifest
+
+
+def shard_targets(manifest_path, index):
+    """The target IDs of one shard"""
+    manifest = read_manifest(manifest_path)
+    if not 0 <= index < manifest['n_shards']:
+        raise ShardError("shard index {0} out of range for {1} shards".format(index, manifest['n_shards']))
+    path = os.path.join(os.path.dirname(manifest_path), manifest['shards'][index]['targets'])
+    with open(path) as handle:
+        targets = [X.rstrip('\n') for X in handle]
+    if _digest(targets) != manifest['shards'][index]['digest']:
+        raise ShardError("{0} does not match its manifest".format(path))
+    return targets
+
+
+def write_done(output_path, manifest_path, index, rows):
+    """Mark a shard output as complete"""
+    manifest = read_manifest(manifest_path)
+    with open(output_path + '.done', 'w') as handle:
+        json.dump(dict(index=index, rows=rows, manifest_digest=manifest['digest'],
+                       shard_digest=manifest['shards'][index]['digest']), handle)
+
+
+def _read_rows(path, format):
+    """(target ID, line) of each row of a shard output"""
+    with open(path) as handle:
+        if format in ('text', 'tsv'):
+            sep = ' ' if format == 'text' else '\t'
+            header = handle.readline()
+            if header.rstrip('\n') != sep.join(output.COLUMNS):
+                raise ShardError("{0} is not {1} output".format(path, format))
+            for line in handle:
+                yield line.split(sep, 1)[0], line
+        elif format == 'jsonl':
+            for line in handle:
+                yield json.loads(line)['SNP_Target_ID'], line
+        else:
+            raise ShardError("shard outputs can be merged as text, tsv or jsonl, not {0}".format(format))
+
+
+def merge(manifest_path, outputs, merged_path, format=None):
+    """Check shard outputs against the manifest and merge them into
+    merged_path in single-run order. outputs lists the output file of
+    each shard, in shard order. Returns the number of rows merged.
+    """
+    manifest = read_manifest(manifest_path)
+    format = format or output.guess_format(outputs[0] if outputs else None)
+    if len(outputs) != manifest['n_shards']:
+        raise ShardError("{0} shard outputs given for {1} shards".format(len(outputs), manifest['n_shards']))
+    missing = [str(i) for i, path in enumerate(outputs) if not os.path.exists(path + '.done')]
+    if missing:
+        raise ShardError("shards {0} are missing or unfinished".format(', '.join(missing)))
+    done = []
+    for index, path in enumerate(outputs):
+        with open(path + '.done') as handle:
+            marker = json.load(handle)
+        if marker['index'] != index or marker['manifest_digest'] != manifest['digest'] \
+                or marker['shard_digest'] != manifest['shards'][index]['digest']:
+            raise ShardError("{0} is not output for shard {1} of this manifest".format(path, index))
+        done.append(marker)
+
+    ## a single run orders rows by reference sequence, then by target list position
+    seq_rank = dict((X, i) for i, X in enumerate(manifest['sequence_order']))
+    target_rank = {}
+    target_shard = {}
+    for position, (target, index) in enumerate(zip(_all_targets(manifest_path, manifest), manifest['assignment'])):
+        target_rank[target] = (seq_rank.get(re.split(manifest['target_delim'], target)[0], len(seq_rank)), position)
+        target_shard[target] = index
+
+    counts = [0] * len(outputs)
+
+    def keyed(index, path):
+        for target, line in _read_rows(path, format):
+            if target_shard.get(target) != index:
+                raise ShardError("{0} has rows for {1}, which is not in shard {2}".format(path, target, index))
+            counts[index] += 1
+            yield target_rank[target], line
+
+    rows = 0
+    with open(merged_path, 'w') as handle:
+        if format in ('text', 'tsv'):
+            handle.write((' ' if format == 'text' else '\t').join(output.COLUMNS) + '\n')
+        for _, line in heapq.merge(*[keyed(i, X) for i, X in enumerate(outputs)], key=lambda X: X[0]):
+            handle.write(line)
+            rows += 1
+    short = [str(i) for i, (marker, n) in enumerate(zip(done, counts)) if marker['rows'] != n]
+    if short:
+        os.remove(merged_path)
+        raise ShardError("shards {0} have a different number of rows than when they finished".format(', '.join(short)))
+    return rows
+
+
+def _all_targets(manifest_path, manifest):
+    """The full target list, in its original order, rebuilt from the shards"""
+    shards = [iter(shard_targets(manifest_path, i)) for i in range(manifest['n_shards'])]
+    targets = [next(shards[X]) for X in manifest['assignment']]
+    if _digest(targets) != manifest['digest']:
+        raise ShardError("shard target lists do not add up to the manifest's")
+    return targets
@@ -0,0 +1,228 @@
+"""
+Primer specificity
+------------------
+
+Off-target checks for designed primer pairs against a k-mer index of the
+whole reference, without an external aligner.
+
+A primer is only extended where its 3' end anneals, so the index records
+where every k-mer of the reference's forward strand occurs, and a primer
+binds wherever its last k bases occur on either strand. Pairs of sites
+facing each other within max_size on one sequence are PCR products; any
+beyond the intended amplicon are off-target.
+
+The index is built once, in two passes over the reference in chunks, and
+kept on disk in a directory of:
+
+- offsets.npy: for each k-mer code, where its positions start, 4**k + 1
+- positions.npy: forward strand positions of every k-mer, grouped by code
+  and sorted within each
+- meta.json: k and the sequence names and lengths
+
+Both arrays are memory-mapped, so opening an index reads next to nothing,
+and a lookup reads two offsets and the positions of one k-mer, whatever
+the size of the genome.
+
+Usage:
+
+    index = KmerIndex.build(Fasta('ref.fasta'), 'ref.kidx')   # once
+    index = KmerIndex('ref.kidx')
+    pairs = screen_pairs(index, 'chr1', slice_start, primer3_pairs)
+"""
+
+import json
+import os
+
+import numpy as np
+
+INDEX_VERSION = 1
+DEFAULT_K = 12
+## the offsets array alone is 8 * 4**k bytes, 512 MiB at k=13
+MAX_K = 13
+
+## 2-bit base codes, 4 for anything that is not ACGT
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _base in enumerate('ACGT'):
+    _BASE_CODES[ord(_base)] = _i
+    _BASE_CODES[ord(_base.lower())] = _i
+
+_COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+def reverse_complement(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+def kmer_codes(seq, k):
+    """Code of the k-mer starting at each position of seq, and whether
+    it is made of ACGT only, as two arrays of len(seq) - k + 1.
+    """
+    bases = _BASE_CODES[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+    n = len(bases) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    invalid = np.concatenate([[0], np.cumsum(bases == 4)])
+    valid = invalid[k:] - invalid[:-k] == 0
+    codes = np.zeros(n, dtype=np.int64)
+    for i in range(k):
+        codes = (codes << 2) | (bases[i:i + n] & 3)
+    return codes, valid
+
+
+def _chunks(reference, names, k, chunk_size):
+    """(global start, sequence) of overlapping chunks of every sequence"""
+    offset = 0
+    for name in names:
+        record = reference[name]
+        length = len(record)
+        for start in range(0, max(length - k + 1, 0), chunk_size):
+            yield offset + start, str(record[start:min(start + chunk_size + k - 1, length)])
+        offset += length
+
+
+class KmerIndex(object):
+    """A memory-mapped index of the k-mer positions of a reference"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as handle:
+            meta = json.load(handle)
+        if meta.get('version') != INDEX_VERSION:
+            raise ValueError("{0} is not a version {1} k-mer index".format(path, INDEX_VERSION))
+        self.path = path
+        self.k = meta['k']
+        self.names = meta['names']
+        self.lengths = np.array(meta['lengths'], dtype=np.int64)
+        self.seq_offsets = np.concatenate([[0], np.cumsum(self.lengths)[:-1]]).astype(np.int64)
+        self._seq_numbers = dict((X, i) for i, X in enumerate(self.names))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.positions = np.load(os.path.join(path, 'positions.npy'), mmap_mode='r')
+
+    @classmethod
+    def build(cls, reference, path, k=DEFAULT_K, chunk_size=1 << 22):
+        """Index the k-mers of reference, a pyfaidx Fasta or a fasta file
+        name, into directory path, and open the index.
+        """
+        if not 1 <= k <= MAX_K:
+            raise ValueError("k must be from 1 to {0}".format(MAX_K))
+        if isinstance(reference, str):
+            from pyfaidx import Fasta
+            reference = Fasta(reference, as_raw=True)
+        names = list(reference.keys())
+        lengths = [len(reference[X]) for X in names]
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        ## first pass: count each k-mer, giving where its positions go
+        counts = np.zeros(4 ** k, dtype=np.int64)
+        for start, seq in _chunks(reference, names, k, chunk_size):
+            codes, valid = kmer_codes(seq, k)
+            ## counted by sorting the chunk's codes, not over all 4**k per chunk
+            present, present_counts = np.unique(codes[valid], return_counts=True)
+            counts[present] += present_counts
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        dtype = np.uint32 if sum(lengths) < 2 ** 32 else np.int64
+        positions = np.lib.format.open_memmap(os.path.join(path, 'positions.npy'), mode='w+',
+                                              dtype=dtype, shape=(int(offsets[-1]),))
+        ## second pass: place positions, in reference order within each k-mer
+        fill = offsets[:-1].copy()
+        for start, seq in _chunks(reference, names, k, chunk_size):
+            codes, valid = kmer_codes(seq, k)
+            where = np.flatnonzero(valid)
+            order = np.argsort(codes[where], kind='stable')
+            codes, where = codes[where][order], where[order] + start
+            if not len(codes):
+                continue
+            first = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+            sizes = np.diff(np.append(first, len(codes)))
+            rank = np.arange(len(codes)) - np.repeat(first, sizes)
+            positions[fill[codes] + rank] = where
+            fill[codes[first]] += sizes
+        positions.flush()
+        del positions
+        ## written last, so an interrupted build is not mistaken for an index
+        with open(os.path.join(path, 'meta.json'), 'w') as handle:
+            json.dump(dict(version=INDEX_VERSION, k=k, names=names, lengths=lengths), handle)
+        return cls(path)
+
+    @classmethod
+    def open_or_build(cls, reference, path, k=DEFAULT_K):
+        """The index at path, built from reference first if there is none"""
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            index = cls(path)
+            if index.k != k:
+                raise ValueError("{0} indexes {1}-mers, not {2}-mers".format(path, index.k, k))
+            return index
+        return cls.build(reference, path, k)
+
+    def hits(self, kmer):
+        """Global forward strand positions of a k-mer, sorted"""
+        if len(kmer) != self.k:
+            return np.zeros(0, dtype=np.int64)
+        codes, valid = kmer_codes(kmer, self.k)
+        if not valid[0]:
+            return np.zeros(0, dtype=np.int64)
+        code = int(codes[0])
+        return np.asarray(self.positions[int(self.offsets[code]):int(self.offsets[code + 1])], dtype=np.int64)
+
+    def global_position(self, seq_id, position):
+        return int(self.seq_offsets[self._seq_numbers[seq_id]]) + position
+
+    def locate(self, positions):
+        """(sequence name, position) of global positions"""
+        numbers = np.searchsorted(self.seq_offsets, positions, side='right') - 1
+        return [(self.names[i], int(X - self.seq_offsets[i])) for i, X in zip(numbers.tolist(), positions)]
+
+    def primer_sites(self, primer):
+        """Where a primer's 3' end binds: global starts of the products it
+        primes on the forward strand and ends of those it primes on the
+        reverse strand. A primer whose 5' end would hang off its sequence
+        primes from the sequence's end, not from the next sequence.
+        """
+        tail = primer[-self.k:]
+        forward = self.hits(tail)
+        reverse = self.hits(reverse_complement(tail))
+        forward_numbers = np.searchsorted(self.seq_offsets, forward, side='right') - 1
+        reverse_numbers = np.searchsorted(self.seq_offsets, reverse, side='right') - 1
+        return (np.maximum(forward + self.k - len(primer), self.seq_offsets[forward_numbers]),
+                np.minimum(reverse + len(primer), self.seq_offsets[reverse_numbers] + self.lengths[reverse_numbers]))
+
+    def products(self, left, right, max_size=1000):
+        """Global (start, end) of every product the two primers, in either
+        role, could amplify: a forward site and a reverse site facing each
+        other on one sequence, at most max_size apart.
+        """
+        forward, reverse = zip(self.primer_sites(left), self.primer_sites(right))
+        starts = np.sort(np.concatenate(forward))
+        ends = np.sort(np.concatenate(reverse))
+        numbers = np.searchsorted(self.seq_offsets, starts, side='right') - 1
+        limits = np.minimum(starts + max_size, self.seq_offsets[numbers] + self.lengths[numbers])
+        low = np.searchsorted(ends, starts, side='right')
+        high = np.searchsorted(ends, limits, side='right')
+        sizes = np.maximum(high - low, 0)
+        within = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return np.column_stack([np.repeat(starts, sizes), ends[np.repeat(low, sizes) + within]])
+
+
+def screen_pairs(index, seq_id, offset, pairs, max_size=1000, max_off_target=0, reject=True):
+    """Check primer3 pairs designed on a template starting at offset on
+    sequence seq_id for off-target products.
+
+    Each pair is copied with OFF_TARGET_PRODUCTS, the products other than
+    the intended amplicon, and PRIMER_LEFT_SITES and PRIMER_RIGHT_SITES,
+    the number of places each primer's 3' end binds. With reject, pairs
+    with more than max_off_target off-target products are dropped;
+    otherwise all pairs are returned, flagged.
+    """
+    screened = []
+    for pair in pairs:
+        left, right = pair['PRIMER_LEFT_SEQUENCE'], pair['PRIMER_RIGHT_SEQUENCE']
+        products = index.products(left, right, max_size)
+        intended = (index.global_position(seq_id, offset + int(pair['PRIMER_LEFT'][0])),
+                    index.global_position(seq_id, offset + int(pair['PRIMER_RIGHT'][0]) + 1))
+        found = int(((products[:, 0] == intended[0]) & (products[:, 1] == intended[1])).any())
+        flagged = dict(pair, OFF_TARGET_PRODUCTS=len(products) - found,
+                       PRIMER_LEFT_SITES=sum(len(X) for X in index.primer_sites(left)),
+                       PRIMER_RIGHT_SITES=sum(len(X) for X in index.primer_sites(right)))
+        if not reject or flagged['OFF_TARGET_PRODUCTS'] <= max_off_target:
+            screened.append(flagged)
+    return screened
@@ -12,13 +12,22 @@ to be easier to test and more object-oriented.
 """
 
 from __future__ import print_function
-import requests
-import xml.etree.ElementTree as ET
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from scipy import interpolate
 
-# Silence InsecureRequestWarning
-requests.packages.urllib3.disable_warnings()
+from pcr_marker_design import metrics
+
+# requests, scipy and the XML parser are imported where they are used,
+# so that importing this module (for its constants, or for the local
+# backend) does not pay for the uMelt client and spline fitting
+
+# Temperatures (degrees C) at which uMelt reports helicity
+TEMPERATURE_RANGE = np.arange(65, 100.5, 0.5)
+
+UMELT_URL = 'https://www.dna.utah.edu/db/services/cgi-bin/udesign.cgi'
 
 
 class MeltSeq:
@@ -79,31 +88,139 @@ class HelicityInfo:
         # to increase resolution
         # s = 0 means no smoothing
         # just straight interpolation
-        tck = interpolate.splrep(self.temperature_range, self.helicity_data, s=0)
+        from scipy import interpolate
+        with metrics.timer('tm'):
+            tck = interpolate.splrep(self.temperature_range, self.helicity_data, s=0)
 
-        # make some new x points with 10 times
-        # the resolution of our original points
-        xnew = np.linspace(self.min_temp, self.max_temp, self.helicity_data.size * 10)
+            # make some new x points with 10 times
+            # the resolution of our original points
+            xnew = np.linspace(self.min_temp, self.max_temp, self.helicity_data.size * 10)
 
-        # first derivative of the line
-        ynew_derivative = interpolate.splev(xnew, tck, der=1)
+            # first derivative of the line
+            ynew_derivative = interpolate.splev(xnew, tck, der=1)
 
         # return the x value corresponding to the
         # point with the steepest downward slope
         return xnew[ynew_derivative.argmin()]
 
 
+MeltCurves = namedtuple('MeltCurves', ['melting_temps', 'temperatures', 'derivatives'])
+
+
+def melting_temps(helicity_array, temperature_range=TEMPERATURE_RANGE, min_temp=65, max_temp=100.5):
+    """Melting temperatures of many helicity curves at once.
+
+    helicity_array is a 2-D array with one
+    helicity curve per row, all over
+    temperature_range. Each row is fitted
+    with the same interpolating cubic
+    spline as get_melting_temp, in one
+    vectorised step, and differentiated on
+    a grid with 10 times the resolution.
+
+    Returns a MeltCurves tuple of the melting
+    temperatures (the steepest fall in
+    helicity), the fine temperature grid and
+    the -dH/dT melt curves on it, one row per
+    curve. Melting temperatures agree with
+    get_melting_temp to within one step of
+    the fine grid, (max_temp - min_temp) /
+    (10 * points - 1), 0.05 C for uMelt curves.
+    """
+
+    helicity_array = np.asarray(helicity_array, dtype=float).reshape(-1, len(temperature_range))
+    temperatures = np.linspace(min_temp, max_temp, helicity_array.shape[1] * 10)
+    if helicity_array.shape[0] == 0:
+        return MeltCurves(np.zeros(0), temperatures, np.zeros((0, temperatures.size)))
+    from scipy import interpolate
+    with metrics.timer('tm'):
+        spline = interpolate.make_interp_spline(temperature_range, helicity_array, k=3, axis=1)
+        derivatives = -spline.derivative()(temperatures)
+    return MeltCurves(temperatures[derivatives.argmax(axis=1)], temperatures, derivatives)
+
+
+class MeltError(Exception):
+    """A sequence could not be melted.
+
+    reason describes the failure, status is the HTTP status
+    code if the service answered and attempts the number of
+    requests made.
+    """
+
+    def __init__(self, reason, status=None, attempts=1):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.status = status
+        self.attempts = attempts
+
+
+class MeltResult(namedtuple('MeltResult', ['sequence', 'helicity_info', 'error'])):
+    """The outcome of melting one MeltSeq object.
+
+    helicity_info is a HelicityInfo object on success,
+    otherwise error is the MeltError that was raised.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class RateLimiter:
+    """Spaces calls, across threads, at most rate per second.
+
+    A rate of None or 0 means no limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
 class UmeltService:
     """An API for the uMelt service.
 
     This class knows everything about how to
     use the uMelt web service, so no other
     classes have to.
+
+    Requests share a keep-alive connection pool.
+    Transient failures (connection errors, timeouts,
+    HTTP 429 and 5xx) are retried up to retries times
+    with exponential backoff, and rate_limit caps the
+    requests per second across all threads. melt_many
+    runs on a pool of max_workers threads kept for the
+    life of the service; close() releases it and the
+    connections.
     """
 
-    def __init__(self):
-        self.url = 'https://www.dna.utah.edu/db/services/cgi-bin/udesign.cgi'
-        self.timeout = 500
+    def __init__(self, url=UMELT_URL, timeout=500, max_workers=8, retries=3, backoff=0.5, rate_limit=None):
+        self.url = url
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limiter = RateLimiter(rate_limit)
+        import requests
+        # Silence InsecureRequestWarning
+        requests.packages.urllib3.disable_warnings()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers)
 
     def get_response(self, sequence):
         """Send a sequence to uMelt and return the response.
@@ -119,8 +236,7 @@ class UmeltService:
                   'cation': sequence.cations,
                   'mg': sequence.free_mg}
 
-        # TODO: add in error handling
-        response = requests.get(self.url, params=values, timeout=self.timeout, verify=False)
+        response = self.session.get(self.url, params=values, timeout=self.timeout, verify=False)
         # TODO: replace 'verify = False' with something
         # that's not a massive security hole
 
@@ -128,6 +244,7 @@ class UmeltService:
 
     def get_helicity_info(self, response):
 
+        import xml.etree.ElementTree as ET
         melt_data = response.text
         tree = ET.fromstring(melt_data)
         helicity = [amp.find('helicity').text.split() for amp in tree.findall('amplicon')]
@@ -135,25 +252,115 @@ class UmeltService:
         # helicity is a list of 3 lists, which for our
         # purposes are identical
         helicity_array = np.array(helicity[0], dtype=np.float32).transpose()
-        temperature_range = np.arange(65, 100.5, 0.5)
+        temperature_range = TEMPERATURE_RANGE
 
         helicity_info = HelicityInfo(helicity_array, temperature_range)
 
         return helicity_info
 
+    def melt(self, sequence):
+        """Melt a MeltSeq object, returning a HelicityInfo object.
+
+        Raises MeltError once retries are exhausted or
+        on a response that is not worth retrying.
+        """
+        import requests
+        import xml.etree.ElementTree as ET
+
+        attempts = 0
+        while True:
+            attempts += 1
+            self.rate_limiter.wait()
+            metrics.count('umelt_requests')
+            try:
+                with metrics.timer('umelt_http'):
+                    response = self.get_response(sequence)
+            except requests.RequestException as e:
+                status, reason, retry = None, type(e).__name__, True
+            else:
+                status = response.status_code
+                if status == 200:
+                    try:
+                        return self.get_helicity_info(response)
+                    except (ET.ParseError, IndexError, AttributeError, ValueError) as e:
+                        metrics.count('melt_failures')
+                        raise MeltError('Unreadable response: {0}'.format(e), status, attempts)
+                reason = 'HTTP {0}'.format(status)
+                retry = status == 429 or status >= 500
+            if not retry or attempts > self.retries:
+                metrics.count('melt_failures')
+                raise MeltError(reason, status, attempts)
+            metrics.count('umelt_retries')
+            time.sleep(self.backoff * 2 ** (attempts - 1))
+
+    def melt_many(self, sequences):
+        """Melt MeltSeq objects concurrently over max_workers threads.
+
+        Returns a list of MeltResult objects in input order;
+        failures are reported in them rather than raised.
+        """
+
+        def melt_one(sequence):
+            try:
+                return MeltResult(sequence, self.melt(sequence), None)
+            except MeltError as e:
+                return MeltResult(sequence, None, e)
+
+        return list(self.executor.map(melt_one, sequences))
+
+    def close(self):
+        """Stop the melt_many threads and close the connections."""
+
+        self.executor.shutdown()
+        self.session.close()
+
+
+MELT_BACKENDS = ('umelt', 'local')
+
+
+def melt_service(backend='umelt', cache=None, **options):
+    """Return a melt service for the named backend.
+
+    'umelt' queries the uMelt web service, 'local' predicts
+    helicity in-process with melt_model.LocalMeltService.
+    Both return HelicityInfo objects from melt() and lists
+    of MeltResult objects from melt_many().
+
+    cache is an optional melt_cache.MeltCache, or the path of
+    one, consulted before the backend is called. Other keyword
+    options are passed on to UmeltService.
+    """
 
-def getmelt(input_seq):
+    if backend == 'umelt':
+        service = UmeltService(**options)
+    elif backend == 'local':
+        from pcr_marker_design.melt_model import LocalMeltService
+        service = LocalMeltService()
+    else:
+        raise ValueError('Unknown melt backend: {0}'.format(backend))
+    if cache is None:
+        return service
+    from pcr_marker_design.melt_cache import CachedMeltService, MeltCache
+    if not isinstance(cache, MeltCache):
+        cache = MeltCache(cache)
+    return CachedMeltService(service, cache, namespace=backend)
+
+
+def getmelt(input_seq, cache=None):
     """A copy of the original getmelt function.
 
     This function takes an input sequence
     string, queries the online umelt service
     at UoU and returns the helicity array
-    that results.
+    that results. If a cache (a MeltCache or
+    its path) is given, it is checked first.
     """
 
     sequence = MeltSeq(input_seq)
-    umelt = UmeltService()
-    response = umelt.get_response(sequence)
-    helicity = umelt.get_helicity_info(response)
+    umelt = melt_service('umelt', cache)
+    try:
+        helicity = umelt.melt(sequence)
+    finally:
+        umelt.close()
 
     return helicity.helicity_data
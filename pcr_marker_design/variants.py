@@ -0,0 +1,83 @@
+"""
+Variant application
+-------------------
+
+Builds the variant (alt) sequence of a design window from a set of SNPs
+and indels in one pass, and cuts matching ref and alt amplicons for any
+number of primer pairs from it.
+
+Variants are (start, end, alt) triples in window coordinates, replacing
+window[start:end] with alt, so indels change the length of the alt
+sequence. Positions are given in reference coordinates throughout; they
+are mapped across the indels to alt coordinates, so the order variants
+are listed in does not matter.
+"""
+
+import numpy as np
+
+
+class VariantWindow(object):
+    """A design window with variants applied.
+
+    template is the reference sequence of the window, variants an
+    iterable of (start, end, alt). Variants are applied in start
+    order; one overlapping a variant already applied is skipped, as
+    is one falling outside the window.
+    """
+
+    def __init__(self, template, variants=()):
+        self.template = template
+        kept = []
+        last_end = 0
+        for start, end, alt in sorted(variants, key=lambda X: (X[0], X[1])):
+            if start < last_end or start < 0 or end > len(template) or end < start:
+                continue
+            kept.append((start, end, alt))
+            last_end = max(last_end, end)
+        self.variants = kept
+        pieces = []
+        previous = 0
+        for start, end, alt in kept:
+            pieces.append(template[previous:start])
+            pieces.append(alt)
+            previous = end
+        pieces.append(template[previous:])
+        self.alt = ''.join(pieces)
+        self._starts = np.array([X[0] for X in kept], dtype=np.int64)
+        self._ends = np.array([X[1] for X in kept], dtype=np.int64)
+        alt_lengths = np.array([len(X[2]) for X in kept], dtype=np.int64)
+        ## alt sequence position of each variant's start, and the length change after it
+        self._shift_after = np.cumsum(alt_lengths - (self._ends - self._starts))
+        self._alt_starts = self._starts + np.concatenate([[0], self._shift_after[:-1]])
+        self._alt_lengths = alt_lengths
+
+    def to_alt(self, positions):
+        """Map reference window positions to alt sequence positions.
+
+        A position inside a variant maps into its alt allele, clipped
+        to the allele's length.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if not self.variants:
+            return positions
+        ## the last variant starting before each position
+        i = np.searchsorted(self._starts, positions, side='right') - 1
+        safe = np.maximum(i, 0)
+        inside = (i >= 0) & (positions < self._ends[safe])
+        after = np.where(i >= 0, self._shift_after[safe], 0)
+        within = self._alt_starts[safe] + np.minimum(positions - self._starts[safe], self._alt_lengths[safe])
+        return np.where(inside, within, positions + after)
+
+    def amplicons(self, starts, ends):
+        """Ref and alt amplicons for reference [start, end) spans, as a
+        list of (ref, alt) string pairs.
+        """
+        alt_starts = self.to_alt(starts).tolist()
+        alt_ends = self.to_alt(ends).tolist()
+        return [(self.template[s:e], self.alt[a:b])
+                for s, e, a, b in zip(starts, ends, alt_starts, alt_ends)]
+
+
+def apply_variants(template, variants):
+    """The sequence of template with variants, (start, end, alt), applied"""
+    return VariantWindow(template, variants).alt
@@ -10,15 +10,18 @@ setuptools.setup(
     long_description=open('README.rst').read(),
     #packages=setuptools.find_packages()
     packages=['pcr_marker_design', 'test'],
-    install_requires=['numpy','biopython','primer3-py','setuptools','pytest', \
-    'scipy','numpy','requests','bcbio-gff','pybedtools','pyfaidx',\
-    'pandas','pysam','cython','pyvcf'],
-    scripts=['design_primers.py'],
+    python_requires='>=3.8',
+    install_requires=['numpy>=1.17','biopython','primer3-py>=2.0','setuptools','pytest', \
+    'scipy','requests','bcbio-gff','pybedtools','pyfaidx',\
+    'pandas','pysam','cython','pyvcf3'],
+    scripts=['design_primers.py', 'shard_primers.py', 'multiplex_primers.py'],
     classifiers=[
         'Development Status :: Beta',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
 )
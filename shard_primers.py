@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+##split a design_primers.py run into shards for separate nodes, and merge the shard outputs
+#usage: shard_primers.py split -i IN_FILE -T TARGET_FILE -n SHARDS [--by {count,chrom}]
+#                              [-d TARGET_DELIM] --out-dir OUT_DIR
+#       shard_primers.py merge MANIFEST OUTPUT [OUTPUT ...] -o MERGED [--format FORMAT]
+#
+#each shard is designed with
+#       design_primers.py -i IN_FILE -g GFF_FILE --shard-manifest MANIFEST --shard-index I -o OUTPUT
+
+#This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+import sys
+import argparse
+from pyfaidx import Fasta
+from pcr_marker_design import shard
+
+
+def parse_args(arguments):
+    """
+    CLI argument parsers for shard_primers.py.
+
+    :param arguments: A list of arguments to parse
+    :type arguments: list[str]
+
+    :return: The parsed arguments, with the subcommand in ``command``
+    :rtype: :class:`argparse.Namespace`
+    """
+    parser = argparse.ArgumentParser(description='Split a primer design run into shards, and merge the shard outputs')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    splitter = commands.add_parser('split', help="write shard target lists and a manifest")
+    splitter.add_argument('-i', type=str, help="input sequence file, for the order of the output, required", dest='in_file', required=True)
+    splitter.add_argument('-T', type=argparse.FileType('r'), help="input target SNP file, required", dest='target_file', required=True)
+    splitter.add_argument('-n', type=int, help="number of shards, required", dest='n_shards', required=True)
+    splitter.add_argument('--by', choices=shard.SHARD_MODES, help="split the target list into even runs, or keep each sequence's targets together, default=count", dest='by', default='count')
+    splitter.add_argument('-d', type=str, help="variant indentifier delimiter, used to separate sequence ID from rest ", dest='target_delim', default=':')
+    splitter.add_argument('--out-dir', type=str, help="directory for the manifest and shard target lists, required", dest='out_dir', required=True)
+
+    merger = commands.add_parser('merge', help="check shard outputs and merge them in single run order")
+    merger.add_argument('manifest', type=str, help="manifest written by split")
+    merger.add_argument('outputs', type=str, nargs='+', help="output file of each shard, in shard order")
+    merger.add_argument('-o', '--output', type=str, help="merged output file, required", dest='output', required=True)
+    merger.add_argument('--format', choices=('text', 'tsv', 'jsonl'), help="shard output format, default as implied by the file extension", dest='format', default=None)
+    return parser.parse_args(arguments)
+
+
+def main(arguments=None):
+    """
+    Main function for running shard_primers.py as a script.
+
+    :param arguments: Arguments to parse instead of the command line
+    :type arguments: list[str]
+    """
+    arguments = parse_args(sys.argv[1:] if arguments is None else arguments)
+    if arguments.command == 'split':
+        targets = [line.rstrip() for line in arguments.target_file]
+        arguments.target_file.close()
+        reference = Fasta(arguments.in_file)
+        try:
+            sequence_order = list(reference.keys())
+        finally:
+            reference.close()
+        path = shard.split(targets, sequence_order, arguments.out_dir, arguments.n_shards,
+                           arguments.by, arguments.target_delim)
+        print(path)
+    else:
+        rows = shard.merge(arguments.manifest, arguments.outputs, arguments.output, arguments.format)
+        print("merged {0} rows from {1} shards into {2}".format(rows, len(arguments.outputs), arguments.output),
+              file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+import pytest
+
+from test.umelt_stub import UmeltStub
+
+
+@pytest.fixture
+def umelt_stub():
+    """A local uMelt stand-in, running for the duration of a test"""
+    stub = UmeltStub().start()
+    yield stub
+    stub.stop()
@@ -0,0 +1,58 @@
+# Test the benchmark data generators and harness
+
+import json
+import os
+import subprocess
+import sys
+
+from pyfaidx import Fasta
+from benchmarks import run_benchmarks, synthetic
+
+
+def test_make_dataset(tmpdir):
+    data = synthetic.make_dataset(str(tmpdir), n_targets=50, seed=1)
+    reference = Fasta(data.fasta)
+    name = list(data.sequences)[0]
+    assert str(reference[name][100:160]) == data.sequences[name][100:160]
+    assert len(open(data.targets).read().splitlines()) == 50
+    for X in data.variants[:20]:
+        assert data.sequences[X.chrom][X.start:X.start + len(X.ref)] == X.ref
+
+
+def test_run_and_compare(tmpdir):
+    results = str(tmpdir.join('results.json'))
+    arguments = ['--targets', '30', '--stages', 'slices', 'windows', 'tm', 'output', '--melt-amplicons', '20',
+                 '--repeat', '1', '--workdir', str(tmpdir), '-o', results]
+    assert run_benchmarks.main(arguments) == 0
+    stages = json.load(open(results))['stages']
+    assert stages['slices']['items'] == 30 and stages['windows']['items'] == 30
+
+    slower = dict(stages=dict((X, dict(Y, seconds=Y['seconds'] / 10)) for X, Y in stages.items()))
+    verdicts = dict((X[0], X[4]) for X in run_benchmarks.compare(json.load(open(results)), slower))
+    assert set(verdicts.values()) == {'regression'}
+
+
+def test_startup_imports():
+    """Entry points are timed, and leave the heavy dependencies of
+    optional code paths unimported
+    """
+    seconds, modules = run_benchmarks.import_seconds('design_primers')
+    assert seconds > 0 and modules > 0
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for module in run_benchmarks.ENTRY_POINTS:
+        loaded = subprocess.check_output(
+            [sys.executable, '-c', 'import sys, {0}; print(" ".join(sys.modules))'.format(module)],
+            cwd=root, universal_newlines=True).split()
+        assert not set(loaded) & {'scipy', 'requests', 'pybedtools', 'vcf', 'BCBio'}
+        if module == 'design_primers':
+            ## nor numpy and primer3, which --help and argument errors do not need
+            assert not set(loaded) & {'numpy', 'primer3'}
+
+
+
+def test_compare_without_items():
+    results = dict(stages=dict(empty=dict(seconds=0.5, items=0), instant=dict(seconds=0.1, items=3)))
+    baseline = dict(stages=dict(empty=dict(seconds=0.1, items=0), instant=dict(seconds=0.0, items=3)))
+    rows = dict((X[0], X) for X in run_benchmarks.compare(results, baseline))
+    assert rows['empty'][3:] == (5.0, 'regression')
+    assert rows['instant'][3:] == (None, 'ok')
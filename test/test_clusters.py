@@ -0,0 +1,38 @@
+from pcr_marker_design.clusters import covering_pairs, group_nearby, merge_target_dicts
+
+
+def test_group_nearby():
+    """
+    Consecutive items on one sequence within the span are grouped, in order.
+    """
+    items = [('a', 100), ('a', 250), ('a', 50), ('a', 500), ('b', 510), ('b', 900)]
+    groups = list(group_nearby(items, lambda X: X[0], lambda X: X[1], 200))
+    assert [[X[1] for X in Y] for Y in groups] == [[100, 250, 50], [500], [510], [900]]
+
+
+def test_merge_and_cover():
+    """
+    Two overlapping windows merge into one template with both targets, and
+    a neighbouring target is no longer excluded; pairs are assigned to the
+    targets their amplicons hold.
+    """
+    sequence = 'ACGT' * 50
+    first = dict(SEQUENCE_ID='s', SEQUENCE_TEMPLATE=sequence[0:120], SEQUENCE_TARGET=[60, 1],
+                 SEQUENCE_EXCLUDED_REGION=[[90, 1], [10, 2]])
+    second = dict(SEQUENCE_ID='s', SEQUENCE_TEMPLATE=sequence[30:150], SEQUENCE_TARGET=[60, 1],
+                  SEQUENCE_EXCLUDED_REGION=[[30, 1]])
+    merged, offset, regions = merge_target_dicts([first, second], [0, 30], num_return=3)
+
+    assert offset == 0
+    assert merged['SEQUENCE_TEMPLATE'] == sequence[0:150]
+    assert merged['SEQUENCE_TARGET'] == [[60, 1], [90, 1]]
+    assert merged['SEQUENCE_EXCLUDED_REGION'] == [[10, 2]]
+    assert merged['PRIMER_NUM_RETURN'] == 6
+    assert regions == [[(60, 1)], [(90, 1)]]
+
+    ## left primers end before, and right primers start after, the targets they cover
+    pairs = [dict(PRIMER_LEFT=[20, 20], PRIMER_RIGHT=[119, 20]),
+             dict(PRIMER_LEFT=[40, 20], PRIMER_RIGHT=[90, 20]),
+             dict(PRIMER_LEFT=[65, 20], PRIMER_RIGHT=[130, 20])]
+    assert covering_pairs(pairs, regions, 5) == [[0, 1], [0, 2]]
+    assert covering_pairs(pairs, regions, 1) == [[0], [0]]
@@ -4,6 +4,24 @@ from pybedtools import BedTool, Interval
 from pyfaidx import Fasta
 
 
+def old_vcf_slicedict(designer, interval, max_size):
+    """The slice the original VcfPrimerDesign.getseqslicedict made, one
+    pyfaidx read and VCF fetch per window, with the bedtools slop and
+    subtract -A steps done by hand, as bedtools itself may be missing
+    """
+    chrom = interval.chrom
+    slice_start = max(interval.start - max_size, 0)
+    slice_end = min(interval.end + max_size, len(designer.reference[chrom]))
+    template = str(designer.reference[chrom][slice_start:slice_end].seq)
+    variants = [(max(X.start, slice_start), min(X.end, slice_end))
+                for X in designer.annot.fetch(chrom, max(slice_start - 200, 0), slice_end) if X.end > slice_start]
+    excluded = [(X - slice_start, Y - X) for X, Y in variants if Y <= interval.start or X >= interval.end]
+    return {'SEQUENCE_ID': '{0}:{1}-{2}'.format(chrom, slice_start, slice_end), 'REF_OFFSET': slice_start,
+            'TARGET_ID': '{0}:{1}-{2}'.format(chrom, interval.start, interval.end - 1),
+            'SEQUENCE_TEMPLATE': template, 'SEQUENCE_EXCLUDED_REGION': excluded,
+            'SEQUENCE_TARGET': (max_size, interval.length)}
+
+
 class TestDesign:
 
     def test_getseqslicedict(self):
@@ -48,3 +66,73 @@ class TestDesign:
  'SEQUENCE_TEMPLATE': 'GGTTGGTCTATTCATCATTGCTCCTAACGCATTCCTCATGGCAATCTGCATTGCTGCCTCAATTTCTTTAGAAGCTTCCAGAGTTGTTGAATTGGCAGCGGCAACTACAGTCGCAACTGTTCCTAGCTTTGCAGAACCATTCCCACTCAAGGAATTCACGGACTCTTTATGTGCCTTCAGAACCAACTGTGTCGCACTGGGTTTTAAAGGAAATAAATAAATATGGAATAAAACATTGATATTACAAATAAAGGGTGCTTCTAGCTGAGTAGTCCTCCGATAAAGCACACGCATACAAAGGAATGAGAGAGAGAGAGAGAGGCGCTACCACATATAAAAGGGACAGCAAACATTTTAACATGAGCAAATCAGTGACACTAGGTAGGTGTTAGCACAAAAATGAACCTTGTTTACATCTGTTCACCACATCCTAGAACATCTTAGACACACACTGCAATAACATATGAGGTGGAGCATGGCACAGTGATACTGCAACAGTAGGATTCCCTGTAACTCTAATGCAACTTTTCATGTACTCAGCCTCTCAAATGATATCGCATGACAAAGTAAAATTAGGTTTTTTTAACTTTTAAACAATAAAACATGAAATTGGAA',
  'TARGET_ID': 'CHR1:3000-3000'}
         assert designer.getseqslicedict(target, max_size) == target_dic
+
+    def test_getVCFseqslicedicts(self):
+        """
+        Batch slices match one-at-a-time slices, in target order
+        """
+        designer = d.VcfPrimerDesign("./test/test-data/AcCHR1_test.fasta",
+                                     "./test/test-data/AcCHR1_test.vcf.gz", "TestCHR1")
+        targets = [Interval('CHR1', 3000, 3001), Interval('CHR1', 100, 110),
+                   Interval('CHR1', 2500, 2501), Interval('CHR1', 135, 140)]
+        batch = designer.getseqslicedicts(targets, 307)
+        assert batch == [designer.getseqslicedict(X, 307) for X in targets]
+        assert designer.getseqslicedicts(targets, 307, sweep=True) == batch
+        assert batch[1]['REF_OFFSET'] == 0
+        assert all((X[0] + X[1] <= 135 or X[0] >= 140) for X in batch[3]['SEQUENCE_EXCLUDED_REGION'])
+
+    def test_slicedicts_match_original(self, monkeypatch):
+        """
+        Batch slices, read in shared spans or window by window, match the
+        original one-window-at-a-time slices
+        """
+        designer = d.VcfPrimerDesign("./test/test-data/AcCHR1_test.fasta",
+                                     "./test/test-data/AcCHR1_test.vcf.gz", "TestCHR1")
+        length = len(designer.reference['CHR1'])
+        targets = [Interval('CHR1', X, X + 1) for X in (3000, 100, length - 50, 2500, 9000, 2520, length // 2)]
+        original = [old_vcf_slicedict(designer, X, 307) for X in targets]
+        assert designer.getseqslicedicts(targets, 307) == original
+        assert designer.getseqslicedicts(targets, 307, sweep=True) == original
+        monkeypatch.setattr(d, 'SPAN_GAP', 0)
+        assert designer.getseqslicedicts(targets, 307) == original
+
+    def test_designfromvcf_specificity(self, tmpdir):
+        """
+        Pairs are flagged with their off-target products, the intended
+        amplicon found and not counted
+        """
+        size_range = list(d.P3.p3_globals['PRIMER_PRODUCT_SIZE_RANGE'])
+        designer = d.VcfPrimerDesign("./test/test-data/AcCHR1_test.fasta",
+                                     "./test/test-data/AcCHR1_test.vcf.gz", "TestCHR1")
+        index = designer.specificity_index(str(tmpdir.join('index')), k=10)
+        assert designer.specificity_index(str(tmpdir.join('index')), k=10) is index
+        result = d.designfromvcf([Interval('CHR1', 3000, 3001)], designer, 300, 100,
+                                 specificity=index, reject_off_target=False)
+        assert result[0]
+        for pair in result[0]:
+            products = index.products(pair['PRIMER_LEFT_SEQUENCE'], pair['PRIMER_RIGHT_SEQUENCE'])
+            assert pair['OFF_TARGET_PRODUCTS'] == len(products) - 1
+        ## the size range is the session's, not written back to the module settings
+        assert d.P3.p3_globals['PRIMER_PRODUCT_SIZE_RANGE'] == size_range
+
+    def test_designfromvcf_cluster(self):
+        """
+        Nearby targets designed on a shared slice get only pairs covering
+        them, listed with the targets each covers; a lone target's design
+        is unchanged
+        """
+        designer = d.VcfPrimerDesign("./test/test-data/AcCHR1_test.fasta",
+                                     "./test/test-data/AcCHR1_test.vcf.gz", "TestCHR1")
+        targets = [Interval('CHR1', 3000, 3001), Interval('CHR1', 3100, 3101),
+                   Interval('CHR1', 3250, 3251), Interval('CHR1', 6000, 6001)]
+        single = d.designfromvcf(targets, designer, 300, 100)
+        clustered = d.designfromvcf(targets, designer, 300, 100, cluster=300)
+        assert len(clustered) == len(targets)
+        for target, pairs in zip(targets, clustered):
+            assert pairs
+            for pair in pairs:
+                assert pair['TARGET_ID'] == '{0}:{1}-{1}'.format(target.chrom, target.start)
+                assert pair['TARGET_ID'] in pair['TARGET_IDS']
+                assert pair['PRIMER_LEFT'][0] + pair['PRIMER_LEFT'][1] <= target.start
+                assert pair['PRIMER_RIGHT'][0] - pair['PRIMER_RIGHT'][1] >= target.start
+        assert [dict(X, TARGET_IDS=None) for X in clustered[3]] == [dict(X, TARGET_IDS=None) for X in single[3]]
@@ -1,5 +1,10 @@
+import json
 import os
-from design_primers import parse_args, design_primers
+
+import pytest
+from Bio import SeqIO
+from pcr_marker_design.journal import JournalError
+from design_primers import parse_args, design_primers, design_primer_rows, group_targets, index_gff_features, reference_sequences
 
 
 def test_design_primers():
@@ -20,11 +25,21 @@ def test_design_primers():
 
     # expected result
     expected = """SNP_Target_ID Position Ref_base Variant_base Amplicon_bp PRIMER_LEFT_SEQUENCE PRIMER_RIGHT_SEQUENCE ref_melt_Tm var_melt_Tm Tm_difference
+k69_93535:SAMTOOLS:SNP:1147 1147 C G 285 CTCTTCAGTTGCTTCCTGCC CTTCACTCCTTCTCGCGTTC 0 0 0
+k69_93535:SAMTOOLS:SNP:1147 1147 C G 182 CTCTTCAGTTGCTTCCTGCC GGTATCGTTTCACCCGACAC 0 0 0
+k69_93535:SAMTOOLS:SNP:1147 1147 C G 296 CTCTTCAGTTGCTTCCTGCC GTAAGAGGGCCCTTCACTCC 0 0 0
+k69_93535:SAMTOOLS:SNP:1147 1147 C G 233 ACAGGGAAGCTTCATAGGCC CTTCACTCCTTCTCGCGTTC 0 0 0
+k69_93535:SAMTOOLS:SNP:1147 1147 C G 130 ACAGGGAAGCTTCATAGGCC GGTATCGTTTCACCCGACAC 0 0 0
 k69_93535:SAMTOOLS:SNP:1336 1336 G A 149 GAACGCGAGAAGGAGTGAAG GCAACCCAGGTTTCAACTCC 0 0 0
 k69_93535:SAMTOOLS:SNP:1336 1336 G A 252 GTGTCGGGTGAAACGATACC GCAACCCAGGTTTCAACTCC 0 0 0
 k69_93535:SAMTOOLS:SNP:1336 1336 G A 183 GAACGCGAGAAGGAGTGAAG GAAGGAACACCGCCATTAGG 0 0 0
 k69_93535:SAMTOOLS:SNP:1336 1336 G A 184 GAACGCGAGAAGGAGTGAAG GGAAGGAACACCGCCATTAG 0 0 0
 k69_93535:SAMTOOLS:SNP:1336 1336 G A 286 GTGTCGGGTGAAACGATACC GAAGGAACACCGCCATTAGG 0 0 0
+k69_98089:SAMTOOLS:SNP:550 550 G A 227 GGAGAAGGTCGAGGTCAGC ACGGCCGAATATACATACAACG 0 0 0
+k69_98089:SAMTOOLS:SNP:550 550 G A 294 GGGAGACCGATCAGTGTTGG AACGGCCGAATATACATACAACG 0 0 0
+k69_98089:SAMTOOLS:SNP:550 550 G A 225 AGAAGGTCGAGGTCAGCG ACGGCCGAATATACATACAACG 0 0 0
+k69_98089:SAMTOOLS:SNP:550 550 G A 292 GGGAGACCGATCAGTGTTGG CGGCCGAATATACATACAACGTC 0 0 0
+k69_98089:SAMTOOLS:SNP:550 550 G A 228 GGAGAAGGTCGAGGTCAGC AACGGCCGAATATACATACAACG 0 0 0
 k69_98089:SAMTOOLS:SNP:625 625 A G 227 GGAGAAGGTCGAGGTCAGC ACGGCCGAATATACATACAACG 0 0 0
 k69_98089:SAMTOOLS:SNP:625 625 A G 294 GGGAGACCGATCAGTGTTGG AACGGCCGAATATACATACAACG 0 0 0
 k69_98089:SAMTOOLS:SNP:625 625 A G 225 AGAAGGTCGAGGTCAGCG ACGGCCGAATATACATACAACG 0 0 0
@@ -34,6 +49,110 @@ k69_98089:SAMTOOLS:SNP:625 625 A G 228 GGAGAAGGTCGAGGTCAGC AACGGCCGAATATACATACAA
     assert result == expected
 
 
+
+def test_index_gff_features():
+    """
+    Test that targets are grouped by sequence and the GFF is indexed per sequence
+    in one pass, with window queries returning features in GFF order.
+    """
+    test_directory = os.path.dirname(os.path.abspath(__file__))
+    targets = [line.rstrip() for line in open(os.path.join(test_directory, 'test-data/targets'))]
+    targets_by_seq = group_targets(targets, ':')
+    assert list(targets_by_seq) == ['k69_93535', 'k69_98089']
+    assert targets_by_seq['k69_93535'] == ['k69_93535:SAMTOOLS:SNP:1147', 'k69_93535:SAMTOOLS:SNP:1336']
+
+    with open(os.path.join(test_directory, 'test-data/targets.gff')) as gff_file:
+        gff_index = index_gff_features(gff_file, ['k69_93535'])
+    assert list(gff_index) == ['k69_93535']
+    feature_index = gff_index['k69_93535']
+    assert int(feature_index.get('k69_93535:SAMTOOLS:SNP:1336').location.start) == 1335
+    assert [f.id for f in feature_index.features_in(1100, 1200)] == ['k69_93535:SAMTOOLS:SNP:1141',
+                                                                     'k69_93535:SAMTOOLS:SNP:1147']
+    assert feature_index.features_in(1141, 1147) == []
+
+
+def test_reference_sequences():
+    """
+    Indexed reads give the same windows as whole-record parsing, for wanted sequences only.
+    """
+    test_directory = os.path.dirname(os.path.abspath(__file__))
+    fasta = os.path.join(test_directory, 'test-data/targets.fasta')
+    records = dict((rec.id, str(rec.seq)) for rec in SeqIO.parse(fasta, 'fasta'))
+    with open(fasta) as in_file:
+        sequences = [(seq_id, seq_len, fetch(250, 850))
+                     for seq_id, seq_len, fetch in reference_sequences(in_file, {'k69_98089'})]
+    assert sequences == [('k69_98089', len(records['k69_98089']), records['k69_98089'][250:850])]
+
+
+def test_design_primers_umelt_stub(umelt_stub):
+    """
+    Melting through the uMelt client, against a local stand-in that fails
+    every fifth request, matches melting with the local backend.
+    """
+    test_directory = os.path.dirname(os.path.abspath(__file__))
+    inputs = ['-i', os.path.join(test_directory, 'test-data/targets.fasta'),
+              '-g', os.path.join(test_directory, 'test-data/targets.gff'),
+              '-T', os.path.join(test_directory, 'test-data/targets'), '-u']
+    umelt_stub.fail_every = 5
+    remote = list(design_primers(parse_args(inputs + ['--umelt-url', umelt_stub.url])))
+    local = list(design_primers(parse_args(inputs + ['--melt-backend', 'local'])))
+
+    assert len(remote) == 21
+    assert remote == local
+
+
+def test_design_primers_resume(tmpdir):
+    """
+    A resumed run replays journalled targets without designing them again,
+    tolerates a torn final journal line, and designs the rest.
+    """
+    test_directory = os.path.dirname(os.path.abspath(__file__))
+    inputs = ['-i', os.path.join(test_directory, 'test-data/targets.fasta'),
+              '-g', os.path.join(test_directory, 'test-data/targets.gff'),
+              '-T', os.path.join(test_directory, 'test-data/targets')]
+    journal = str(tmpdir.join('journal.jsonl'))
+    full = list(design_primers(parse_args(inputs + ['--journal', journal])))
+    entries = open(journal).read().splitlines()
+
+    ## keep the run's header and first target, marked so a replay can be told from a redesign, and tear the next
+    first = json.loads(entries[1])
+    first['rows'][0][1] = -1
+    with open(journal, 'w') as handle:
+        handle.write(entries[0] + '\n' + json.dumps(first) + '\n' + entries[2][:20])
+    resumed = list(design_primers(parse_args(inputs + ['--journal', journal, '--resume'])))
+
+    assert resumed[1].split(' ')[1] == '-1'
+    assert resumed[2:] == full[2:]
+    assert len(open(journal).read().splitlines()) == len(entries)
+
+    ## a journal is only resumed by a run with the same settings, inputs and targets
+    with pytest.raises(JournalError):
+        list(design_primers(parse_args(inputs + ['-n', '3', '--journal', journal, '--resume'])))
+    targets = str(tmpdir.join('targets'))
+    with open(targets, 'w') as handle:
+        handle.writelines(open(inputs[-1]).readlines()[1:])
+    with pytest.raises(JournalError):
+        list(design_primers(parse_args(inputs[:-1] + [targets, '--journal', journal, '--resume'])))
+    assert list(design_primers(parse_args(inputs + ['-j', '2', '--journal', journal, '--resume']))) == resumed
+
+def test_design_primers_cluster(tmpdir):
+    """
+    Clustered targets share a design window: each keeps only pairs that
+    cover it, and the report lists pairs covering both SNPs of a cluster.
+    """
+    test_directory = os.path.dirname(os.path.abspath(__file__))
+    inputs = ['-i', os.path.join(test_directory, 'test-data/targets.fasta'),
+              '-g', os.path.join(test_directory, 'test-data/targets.gff'),
+              '-T', os.path.join(test_directory, 'test-data/targets')]
+    report = str(tmpdir.join('report.tsv'))
+    single = list(design_primers(parse_args(inputs)))
+    clustered = list(design_primers(parse_args(inputs + ['--cluster', '300', '--cluster-report', report])))
+
+    assert set(clustered) <= set(single)
+    assert set(X.split(' ')[0] for X in clustered) == set(X.split(' ')[0] for X in single)
+    covered = [X.rstrip('\n').split('\t')[4] for X in open(report).readlines()[1:]]
+    assert 'k69_98089:SAMTOOLS:SNP:550,k69_98089:SAMTOOLS:SNP:625' in covered
+
 # def test_design_primers_umelt():
 #     """
 #     Test for function design_primers with umelt functionality.
@@ -64,4 +183,56 @@ k69_98089:SAMTOOLS:SNP:625 625 A G 228 GGAGAAGGTCGAGGTCAGC AACGGCCGAATATACATACAA
 # k69_98089:SAMTOOLS:SNP:625 625 A G 292 GGGAGACCGATCAGTGTTGG CGGCCGAATATACATACAACGTC 85.5789844852 86.2799717913 0.700987306065
 # k69_98089:SAMTOOLS:SNP:625 625 A G 228 GGAGAAGGTCGAGGTCAGC AACGGCCGAATATACATACAACG 85.7792665726 86.2799717913 0.500705218618"""
 #
-#     assert result == expected
\ No newline at end of file
+#     assert result == expected
+
+def test_design_primers_hrm_top():
+    """
+    --hrm-top keeps the best discriminating pairs of each target, best
+    first, the head of the target's full ranking.
+    """
+    test_directory = os.path.dirname(os.path.abspath(__file__))
+    inputs = ['-i', os.path.join(test_directory, 'test-data/targets.fasta'),
+              '-g', os.path.join(test_directory, 'test-data/targets.gff'),
+              '-T', os.path.join(test_directory, 'test-data/targets'), '-u', '--melt-backend', 'local']
+    melted = list(design_primer_rows(parse_args(inputs)))
+    ranked = list(design_primer_rows(parse_args(inputs + ['--hrm-top', '2'])))
+
+    assert set(ranked) <= set(melted)
+    targets = [X[0] for X in ranked]
+    assert set(targets) == set(X[0] for X in melted)
+    assert max(targets.count(X) for X in targets) == 2
+    everything = list(design_primer_rows(parse_args(inputs + ['--hrm-top', '100'])))
+    assert sorted(everything) == sorted(melted)
+    for target in set(targets):
+        assert [X for X in ranked if X[0] == target] == [X for X in everything if X[0] == target][:2]
+
+
+def test_design_primers_pipeline(tmpdir):
+    """
+    Designing and melting as pipeline stages gives the rows of a serial run,
+    in target order unless asked otherwise, and journals every target.
+    """
+    test_directory = os.path.dirname(os.path.abspath(__file__))
+    inputs = ['-i', os.path.join(test_directory, 'test-data/targets.fasta'),
+              '-g', os.path.join(test_directory, 'test-data/targets.gff'),
+              '-T', os.path.join(test_directory, 'test-data/targets'), '-u', '--melt-backend', 'local',
+              '--cluster', '250']
+    journal = str(tmpdir.join('journal'))
+    serial = list(design_primer_rows(parse_args(inputs)))
+    pipelined = list(design_primer_rows(parse_args(inputs + ['--pipeline', '-j', '2', '--melt-targets', '2',
+                                                             '--journal', journal])))
+    unordered = list(design_primer_rows(parse_args(inputs + ['--pipeline', '--unordered'])))
+
+    assert pipelined == serial
+    assert sorted(unordered) == sorted(serial)
+    resumed = list(design_primer_rows(parse_args(inputs + ['--pipeline', '--journal', journal, '--resume'])))
+    assert resumed == serial
+
+
+def test_melt_backend_choices():
+    """
+    --melt-backend offers the backends umelt_service provides, named without importing it.
+    """
+    from pcr_marker_design import umelt_service as um
+    for backend in um.MELT_BACKENDS:
+        assert parse_args(['-i', os.devnull, '-g', os.devnull, '--melt-backend', backend]).melt_backend == backend
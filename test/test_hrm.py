@@ -0,0 +1,58 @@
+# Test HRM discrimination scoring
+
+import numpy as np
+import pytest
+from pcr_marker_design import hrm
+from pcr_marker_design import umelt_service as um
+
+
+def sigmoid(tm, width=1.0):
+    """A helicity curve (%) melting at tm over the uMelt grid"""
+    return 100 / (1 + np.exp((um.TEMPERATURE_RANGE - tm) / width))
+
+
+def test_score_pairs():
+    """Identical alleles score nothing; a shift scores as a Tm difference,
+    a broader melt as a shape difference
+    """
+    ref = np.array([sigmoid(80), sigmoid(80), sigmoid(80)])
+    var = np.array([sigmoid(80), sigmoid(82), sigmoid(80, width=2.0)])
+    scores = hrm.score_pairs(ref, var)
+
+    assert np.allclose(scores.ref_tm, um.melting_temps(ref).melting_temps)
+    assert scores.delta_tm[0] == 0 and scores.curve_difference[0] == 0 and scores.width_difference[0] == 0
+    assert scores.delta_tm[1] == pytest.approx(2, abs=0.1)
+    assert scores.width_difference[1] == pytest.approx(0, abs=0.1)
+    assert scores.delta_tm[2] == pytest.approx(0, abs=0.1)
+    assert scores.width_difference[2] == pytest.approx(3.5, abs=0.5)
+    assert scores.curve_difference[2] > 0.1
+    assert len(hrm.score_pairs(np.zeros((0, 71)), np.zeros((0, 71))).delta_tm) == 0
+    with pytest.raises(ValueError):
+        hrm.score_pairs(ref, var[:2])
+
+
+def test_top_pairs():
+    """Best pairs per target, in target order, by the metrics together
+    and pairs without scores last
+    """
+    scores = hrm.HrmScores(*[np.zeros(6)] * 2, delta_tm=np.array([0.5, 1.0, 0.5, 0.2, np.nan, 0.5]),
+                           curve_difference=np.array([0.1, 0.1, 0.3, 0.1, 0.1, 0.1]),
+                           width_difference=np.zeros(6))
+    targets = ['b', 'b', 'b', 'a', 'a', 'b']
+
+    assert hrm.rank_pairs(scores).tolist() == [2, 1, 0, 5, 3, 4]
+    assert hrm.top_pairs(scores, targets).tolist() == [2, 1, 0, 5, 3, 4]
+    assert hrm.top_pairs(scores, targets, 2).tolist() == [2, 1, 3, 4]
+    assert hrm.rank_pairs(scores, by=('delta_tm',)).tolist() == [1, 0, 2, 5, 3, 4]
+
+
+def test_rank_by_curve_shape():
+    """A pair that separates the melt curves well outranks one with a
+    larger Tm difference but curves that barely differ
+    """
+    ref = np.array([sigmoid(80), sigmoid(80)])
+    var = np.array([sigmoid(80.5), sigmoid(80.2, width=2.5)])
+    scores = hrm.score_pairs(ref, var)
+    assert scores.delta_tm[0] > scores.delta_tm[1]
+    assert scores.curve_difference[0] < scores.curve_difference[1]
+    assert hrm.rank_pairs(scores).tolist() == [1, 0]
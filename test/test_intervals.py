@@ -0,0 +1,42 @@
+# Test the in-memory interval index
+
+import numpy as np
+import pytest
+from pcr_marker_design import intervals as iv
+
+
+class TestIntervals:
+    def test_overlapping_in_input_order(self):
+        index = iv.IntervalIndex([('a', 50, 60), ('a', 0, 100), ('b', 10, 20),
+                                  ('a', 95, 96), ('a', 100, 110)])
+        starts, ends, rows = index.overlapping('a', 55, 100)
+        assert list(rows) == [0, 1, 3]
+        assert list(zip(starts, ends)) == [(50, 60), (0, 100), (95, 96)]
+        assert len(index.overlapping('c', 0, 100)[0]) == 0
+
+    def test_sweep_matches_index(self):
+        """A sorted sweep finds what the index does, long deletions included"""
+        rows = [('a', 0, 400), ('a', 50, 60), ('a', 95, 96), ('a', 100, 110), ('a', 300, 301),
+                ('b', 10, 20), ('c', 5, 6)]
+        windows = dict(a=(np.array([250, 55, 100, 500]), np.array([320, 100, 101, 600])),
+                       b=(np.array([0]), np.array([15])), d=(np.array([0]), np.array([10])))
+        index = iv.IntervalIndex(rows)
+        found = dict(((X[0], X[1]), list(zip(X[2], X[3]))) for X in iv.sweep_overlaps(rows, windows))
+        assert len(found) == 6
+        for chrom, (starts, ends) in windows.items():
+            for i, hits in enumerate(index.overlapping_many(chrom, starts, ends)):
+                assert found[chrom, i] == list(zip(hits[0], hits[1]))
+        assert found['a', 0] == [(0, 400), (300, 301)]
+        with pytest.raises(ValueError):
+            list(iv.sweep_overlaps(rows + [('a', 700, 701)], windows))
+        with pytest.raises(ValueError):
+            list(iv.sweep_overlaps([('a', 60, 61), ('a', 50, 51)], windows))
+
+    def test_subtract_like_bedtools(self):
+        """Trim overlaps, split spanning intervals and drop covered ones"""
+        starts, ends = iv.subtract(np.array([0, 8, 12, 5, 30]), np.array([4, 12, 15, 25, 40]), 10, 20)
+        assert list(zip(starts, ends)) == [(0, 4), (8, 10), (5, 10), (20, 25), (30, 40)]
+
+    def test_slop_clamps(self):
+        assert iv.slop(100, 101, 250, 1000) == (0, 351)
+        assert iv.slop(900, 901, 250, 1000) == (650, 1000)
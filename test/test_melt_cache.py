@@ -0,0 +1,109 @@
+# Test the persistent melt cache
+
+import multiprocessing
+
+import numpy as np
+from pcr_marker_design import melt_cache as mc
+from pcr_marker_design import umelt_service as um
+
+test_seq = "TATAACCTGACTAACCATGAACCTGGGTAGAATTCCACTCCTCCACCAAATTTTTTAACTTAACCAAG"
+
+
+class CountingService:
+    """A stand-in melt service that counts calls"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def melt(self, sequence):
+        self.calls += 1
+        return um.HelicityInfo(np.linspace(100, 0, 71, dtype=np.float32), um.TEMPERATURE_RANGE)
+
+    def melt_many(self, sequences):
+        return [um.MeltResult(X, self.melt(X), None) for X in sequences]
+
+
+def _fill(path, offset):
+    cache = mc.MeltCache(path)
+    for i in range(50):
+        cache.put(mc.melt_key(um.MeltSeq(test_seq[:i + 1]), str(offset)), np.full(71, offset, np.float32))
+
+
+class TestMeltCache:
+    def test_repeat_run_makes_no_calls(self, tmpdir):
+        path = str(tmpdir.join('melt.db'))
+        first = CountingService()
+        melted = [mc.CachedMeltService(first, mc.MeltCache(path)).melt(um.MeltSeq(X)) for X in (test_seq, test_seq[:40])]
+        assert first.calls == 2
+
+        second = CountingService()
+        service = mc.CachedMeltService(second, mc.MeltCache(path))
+        again = [service.melt(um.MeltSeq(X)) for X in (test_seq, test_seq[:40])]
+        assert second.calls == 0
+        assert service.hits == 2
+        for old, new in zip(melted, again):
+            assert np.array_equal(old.helicity_data, new.helicity_data)
+            assert np.array_equal(old.temperature_range, new.temperature_range)
+
+    def test_key_covers_conditions(self):
+        base = mc.melt_key(um.MeltSeq(test_seq))
+        assert base == mc.melt_key(um.MeltSeq(test_seq.lower()))
+        assert base != mc.melt_key(um.MeltSeq(test_seq, dmso_percent=5))
+        assert base != mc.melt_key(um.MeltSeq(test_seq, free_mg=3))
+        assert base != mc.melt_key(um.MeltSeq(test_seq), namespace='local')
+        assert base == mc.melt_key(um.MeltSeq(test_seq, cations=20.0, free_mg=2.0))
+
+    def test_eviction(self, tmpdir):
+        cache = mc.MeltCache(str(tmpdir.join('melt.db')), max_bytes=284 * 10, check_every=1)
+        for i in range(30):
+            cache.put(str(i), np.zeros(71, np.float32))
+        assert cache.size() <= 284 * 10
+        assert cache.get('29') is not None
+        assert cache.get('0') is None
+
+    def test_hits_update_recency_in_batches(self, tmpdir):
+        cache = mc.MeltCache(str(tmpdir.join('melt.db')), max_bytes=284 * 10, touch_every=4)
+        for i in range(10):
+            cache.put(str(i), np.zeros(71, np.float32))
+        ## held until touch_every hits, then written together; eviction sees held ones too
+        assert cache.get('0') is not None and cache.get('1') is not None
+        assert len(cache._touched) == 2
+        cache.evict(284 * 8)
+        assert cache.get('0') is not None and cache.get('1') is not None
+        assert cache.get('2') is None and cache.get('3') is None
+
+    def test_concurrent_writers(self, tmpdir):
+        path = str(tmpdir.join('melt.db'))
+        mc.MeltCache(path)
+        workers = [multiprocessing.Process(target=_fill, args=(path, X)) for X in range(4)]
+        for X in workers:
+            X.start()
+        for X in workers:
+            X.join()
+        assert all(X.exitcode == 0 for X in workers)
+        assert len(mc.MeltCache(path)) == 200
+
+    def test_shared_between_threads(self, tmpdir):
+        """One cache is used from many threads, each with its own connection"""
+        from concurrent.futures import ThreadPoolExecutor
+        cache = mc.MeltCache(str(tmpdir.join('melt.db')))
+        keys = [mc.melt_key(um.MeltSeq(test_seq[:i + 1])) for i in range(20)]
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(lambda X: cache.put(X, np.full(71, len(X), np.float32)), keys))
+            assert all(X is not None for X in pool.map(cache.get, keys))
+        assert len(cache) == 20 and cache._writes == 20
+
+    def test_melt_many_melts_repeats_once(self, tmpdir):
+        service = mc.CachedMeltService(CountingService(), mc.MeltCache(str(tmpdir.join('melt.db'))))
+        sequences = [um.MeltSeq(X) for X in (test_seq, test_seq[:40], test_seq, test_seq.lower())]
+        results = service.melt_many(sequences)
+        assert service.service.calls == 2
+        assert [X.sequence for X in results] == sequences and all(X.ok for X in results)
+        assert service.melt_many(sequences[:1])[0].ok and service.service.calls == 2
+
+    def test_melt_service_with_local_backend(self, tmpdir):
+        service = um.melt_service('local', cache=str(tmpdir.join('melt.db')))
+        first = service.melt(um.MeltSeq(test_seq)).get_melting_temp()
+        assert service.cache.get(mc.melt_key(um.MeltSeq(test_seq), 'local')) is not None
+        assert service.melt(um.MeltSeq(test_seq)).get_melting_temp() == first
+        assert (service.hits, service.misses) == (1, 1)
@@ -0,0 +1,53 @@
+# Test the local melt prediction backend
+
+import numpy as np
+import pytest
+from pcr_marker_design import melt_model as mm
+from pcr_marker_design import umelt_service as um
+
+test_seq = "TATAACCTGACTAACCATGAACCTGGGTAGAATTCCACTCCTCCACCAAATTTTTTAACTTAACCAAG"
+
+
+class TestLocalMeltService:
+    def test_drop_in_for_umelt(self):
+        """Local responses convert to HelicityInfo over the uMelt temperature grid"""
+        service = um.melt_service('local')
+        sequence = um.MeltSeq(test_seq)
+        helicity = service.get_helicity_info(service.get_response(sequence))
+
+        assert isinstance(helicity, um.HelicityInfo)
+        assert np.array_equal(helicity.temperature_range, um.TEMPERATURE_RANGE)
+        assert helicity.helicity_data.shape == um.TEMPERATURE_RANGE.shape
+        assert np.all(np.diff(helicity.helicity_data) <= 1e-3)
+        assert helicity.helicity_data[0] > 90
+        assert helicity.helicity_data[-1] < 1
+
+    def test_close_to_umelt(self):
+        """uMelt puts the melting temperature of the test sequence at 82.75 C"""
+        melting_temp = um.melt_service('local').melt(um.MeltSeq(test_seq)).get_melting_temp()
+
+        assert abs(melting_temp - 82.75) < 3
+
+    def test_conditions(self):
+        """GC content, cations and Mg stabilise, DMSO destabilises"""
+        def tm(seq, **conditions):
+            return um.melt_service('local').melt(um.MeltSeq(seq, **conditions)).get_melting_temp()
+
+        base = tm(test_seq)
+        assert tm(test_seq.replace('A', 'G')) > base
+        assert tm(test_seq, cations=100) > base
+        assert tm(test_seq, free_mg=4) > base
+        assert tm(test_seq, dmso_percent=5) == pytest.approx(base - 3, abs=0.2)
+
+    def test_batch_matches_single(self):
+        """Batched, padded predictions equal one-at-a-time predictions"""
+        seqs = [test_seq, test_seq[:40], "GCGGCCGCTAGC" * 12, "ACGTNACGT" * 10]
+        batch = mm.predict_helicity(seqs, batch_size=2)
+        single = np.vstack([mm.predict_helicity([X]) for X in seqs])
+
+        assert batch.shape == (4, um.TEMPERATURE_RANGE.size)
+        assert np.allclose(batch, single, atol=1e-4)
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            um.melt_service('nope')
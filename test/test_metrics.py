@@ -0,0 +1,65 @@
+# Test run metrics collection
+
+import io
+import json
+import os
+
+from design_primers import parse_args, design_primers
+from pcr_marker_design import metrics
+
+
+class TestMetrics:
+    def test_disabled_records_nothing(self):
+        registry = metrics.Metrics()
+        with registry.timer('stage'):
+            pass
+        registry.count('hits')
+        registry.observe('latency', 0.1)
+        assert registry.snapshot() == dict(timers={}, counters={}, histograms={})
+
+    def test_summary_and_merge(self):
+        registry = metrics.Metrics()
+        registry.enabled = True
+        with registry.timer('stage'):
+            pass
+        registry.count('hits', 2)
+        for seconds in (0.001, 0.002, 0.003, 1.5):
+            registry.observe('latency', seconds)
+        other = metrics.Metrics()
+        other.enabled = True
+        other.add_time('stage', 2.0)
+        other.count('hits')
+        registry.merge(other.snapshot())
+
+        summary = registry.summary()
+        assert summary['stages']['stage']['calls'] == 2
+        assert summary['stages']['stage']['max_seconds'] == 2.0
+        assert summary['counters'] == {'hits': 3}
+        assert summary['histograms']['latency']['count'] == 4
+        assert summary['histograms']['latency']['p50'] == 2.0 ** -8
+        assert summary['histograms']['latency']['p99'] == 2.0
+
+    def test_progress(self):
+        stream = io.StringIO()
+        progress = metrics.Progress(total=4, interval=0, stream=stream)
+        progress.update(2)
+        assert stream.getvalue().startswith('2/4 targets')
+        assert 'ETA' in stream.getvalue()
+
+
+def test_design_primers_metrics(tmpdir):
+    """Stages, counters and per-target latencies from a run, including primer3 workers"""
+    test_directory = os.path.dirname(os.path.abspath(__file__))
+    path = str(tmpdir.join('metrics.json'))
+    args = parse_args(['-i', os.path.join(test_directory, 'test-data/targets.fasta'),
+                       '-g', os.path.join(test_directory, 'test-data/targets.gff'),
+                       '-T', os.path.join(test_directory, 'test-data/targets'),
+                       '-j', '2', '--metrics', path])
+    rows = list(design_primers(args))
+    summary = json.load(open(path))
+
+    assert not metrics.enabled()
+    assert summary['counters']['primer_pairs'] == len(rows) - 1
+    assert summary['stages']['primer3']['calls'] == summary['counters']['p3_designs']
+    assert summary['histograms']['target_seconds']['count'] == summary['counters']['targets']
+    assert {'gff_index', 'windows'} <= set(summary['stages'])
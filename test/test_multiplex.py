@@ -0,0 +1,125 @@
+# Test multiplex dimer screening and pool assignment
+
+import os
+import random
+
+import primer3
+
+from pcr_marker_design import multiplex
+from pcr_marker_design.multiplex import Pair, reverse_complement
+
+
+def random_primers(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+def test_candidate_dimers():
+    """
+    Test that the prefilter keeps pairs with a complementary 3' end and
+    drops most of the rest.
+    """
+    primers = random_primers(200)
+    ## primer 1 ends in the reverse complement of bases 5 to 15 of primer 0
+    primers[1] = primers[1][:10] + reverse_complement(primers[0][5:15])
+    candidates = multiplex.candidate_dimers(primers, 5).tolist()
+    assert [0, 1] in candidates
+    assert candidates == sorted(candidates) and all(i < j for i, j in candidates)
+    assert len(candidates) < 200 * 199 // 2 // 10
+    ## the same as checking every pair
+    assert candidates == [[i, j] for i in range(200) for j in range(i + 1, 200)
+                          if reverse_complement(primers[i][-5:]) in primers[j]
+                          or reverse_complement(primers[j][-5:]) in primers[i]]
+    for i, j in candidates:
+        assert reverse_complement(primers[i][-5:]) in primers[j] or reverse_complement(primers[j][-5:]) in primers[i]
+
+
+def test_dimer_dgs_pool():
+    """
+    Test that dG checks over a process pool match serial ones, in order.
+    """
+    primers = random_primers(20)
+    candidates = [(i, i + 10) for i in range(10)]
+    serial = multiplex.dimer_dgs(primers, candidates)
+    assert serial[0] == primer3.calc_heterodimer(primers[0], primers[10]).dg
+    assert multiplex.dimer_dgs(primers, candidates, jobs=2, chunk_size=3).tolist() == serial.tolist()
+
+
+def test_conflicts_and_pools():
+    """
+    Test that a strong cross-pair dimer is a conflict, and that conflicting
+    pairs go to different pools unless another of their pairs fits.
+    """
+    primers = random_primers(8, seed=1)
+    primers[0] = 'TTAGGCGCCGCGGCCAGTCA'
+    primers[3] = primers[3][:8] + reverse_complement(primers[0][4:16])
+    pairs = [Pair('t{0}#0'.format(i), 't{0}'.format(i), 0, primers[2 * i], primers[2 * i + 1]) for i in range(4)]
+    conflicts = multiplex.conflict_graph(pairs)
+    assert 't1#0' in conflicts['t0#0'] and conflicts['t0#0']['t1#0'] == conflicts['t1#0']['t0#0'] <= -9000
+    pools = multiplex.assign_pools(pairs, conflicts)
+    assert len(pools) == 2
+    assert not any(X.pair_id in conflicts[Y.pair_id] for pool in pools for X in pool for Y in pool)
+    assert sorted(X.target_id for pool in pools for X in pool) == ['t0', 't1', 't2', 't3']
+    assert [len(X) for X in multiplex.assign_pools(pairs, conflicts, pool_size=1)] == [1, 1, 1, 1]
+
+    ## with an alternative pair for t1 that does not conflict, one pool holds all
+    alternative = Pair('t1#1', 't1', 1, *random_primers(2, seed=2))
+    with_alternative = pairs[:2] + [alternative] + pairs[2:]
+    pools = multiplex.assign_pools(with_alternative, multiplex.conflict_graph(with_alternative))
+    assert len(pools) == 1 and 't1#1' in [X.pair_id for X in pools[0]]
+
+
+def test_multiplex_primers(tmpdir):
+    """
+    Test pooling design output: the overlapping amplicons of the two
+    k69_93535 targets, one pair's right primer the other's left, conflict.
+    """
+    from design_primers import main as design_main
+    from multiplex_primers import main as multiplex_main
+    test_directory = os.path.dirname(os.path.abspath(__file__))
+    design = str(tmpdir.join('design.tsv'))
+    design_main(['-i', os.path.join(test_directory, 'test-data/targets.fasta'),
+                 '-g', os.path.join(test_directory, 'test-data/targets.gff'),
+                 '-T', os.path.join(test_directory, 'test-data/targets'), '-o', design])
+    pools, conflicts = str(tmpdir.join('pools.tsv')), str(tmpdir.join('conflicts.tsv'))
+    multiplex_main([design, '--pairs-per-target', '3', '--conflicts', conflicts, '-o', pools])
+    edges = [X.split('\t') for X in open(conflicts).read().splitlines()[1:]]
+    assert ['k69_93535:SAMTOOLS:SNP:1147#0', 'k69_93535:SAMTOOLS:SNP:1336#0', '-21.63'] in edges
+    rows = [X.split('\t') for X in open(pools).read().splitlines()[1:]]
+    ## every target with primers is pooled once; SNP:30 has none
+    assert sorted(X[1] for X in rows) == ['k69_93535:SAMTOOLS:SNP:1147', 'k69_93535:SAMTOOLS:SNP:1336',
+                                          'k69_98089:SAMTOOLS:SNP:550', 'k69_98089:SAMTOOLS:SNP:625']
+    chosen = dict((X[1], X[1] + '#' + X[2]) for X in rows)
+    assert chosen['k69_93535:SAMTOOLS:SNP:1336'] not in [X[1] for X in edges if X[0] == chosen['k69_93535:SAMTOOLS:SNP:1147']]
+
+
+def test_multiplex_conditions():
+    """
+    Test that the dimer conditions default to primer3's design conditions.
+    """
+    from multiplex_primers import parse_args
+    from pcr_marker_design import run_p3 as P3
+    arguments = parse_args(['design.tsv'])
+    assert arguments.salt == P3.p3_globals['PRIMER_SALT_MONOVALENT']
+    assert arguments.dna_conc == P3.p3_globals['PRIMER_DNA_CONC']
+    arguments = parse_args(['design.tsv', '--salt', '20', '--dna-conc', '250'])
+    assert (arguments.salt, arguments.dna_conc) == (20.0, 250.0)
+
+
+def test_shared_primer_conflicts():
+    """
+    Test that a self-complementary primer shared by two targets' pairs is
+    a conflict, and that pairs for one target never conflict, as they never
+    share a pool.
+    """
+    palindrome = 'GCGGCCGCATGCGGCCGC'
+    assert reverse_complement(palindrome) == palindrome
+    a, b, d, e = random_primers(4, seed=3)
+    ## t1's alternative pairs also dimerise, through b and its reverse complement
+    pairs = [Pair('t0#0', 't0', 0, palindrome, a), Pair('t1#0', 't1', 0, b, palindrome),
+             Pair('t1#1', 't1', 1, palindrome, reverse_complement(b)), Pair('t2#0', 't2', 0, d, e)]
+    conflicts = multiplex.conflict_graph(pairs)
+    assert conflicts['t0#0']['t1#0'] == primer3.calc_homodimer(palindrome).dg
+    assert 't1#1' in conflicts['t0#0']
+    assert 't1#1' not in conflicts['t1#0'] and 't1#0' not in conflicts['t1#1']
+    assert not conflicts['t2#0']
@@ -0,0 +1,65 @@
+# Test the streaming result writers
+
+import json
+
+import numpy as np
+import pytest
+from pcr_marker_design import output
+
+rows = [("k69_93535:SAMTOOLS:SNP:1147", 1147, "C", "G", 285, "CTCTTCAGTTGCTTCCTGCC",
+         "CTTCACTCCTTCTCGCGTTC", 86.25, 86.5, 0.25),
+        ("k69_98089:SAMTOOLS:SNP:550", 550, "G", "A", 227, "GGAGAAGGTCGAGGTCAGC",
+         "ACGGCCGAATATACATACAACG", "NA", "NA", "NA")]
+
+
+class TestOutput:
+    def test_text_streams(self, tmpdir):
+        path = str(tmpdir.join('out.txt'))
+        writer = output.open_writer(path, flush_every=1)
+        writer.write(rows[0])
+        ## written before the writer is closed
+        assert open(path).read().splitlines()[1].split(' ')[0] == rows[0][0]
+        writer.write(rows[1])
+        writer.close()
+        lines = open(path).read().splitlines()
+        assert lines[0] == ' '.join(output.COLUMNS)
+        assert lines[2] == ' '.join(str(X) for X in rows[1])
+
+    def test_tsv_and_jsonl(self, tmpdir):
+        for name in ('out.tsv', 'out.jsonl'):
+            with output.open_writer(str(tmpdir.join(name))) as writer:
+                for row in rows:
+                    writer.write(row)
+        assert open(str(tmpdir.join('out.tsv'))).readline().rstrip('\n').split('\t') == list(output.COLUMNS)
+        records = [json.loads(X) for X in open(str(tmpdir.join('out.jsonl')))]
+        assert records[0]['Position'] == 1147 and records[0]['Tm_difference'] == 0.25
+        assert records[1]['ref_melt_Tm'] is None
+
+    def test_npz(self, tmpdir):
+        path = str(tmpdir.join('out.npz'))
+        with output.open_writer(path, flush_every=1) as writer:
+            for row in rows:
+                writer.write(row)
+        columns = np.load(path)
+        assert list(columns['Amplicon_bp']) == [285, 227]
+        assert columns['ref_melt_Tm'][0] == 86.25 and np.isnan(columns['ref_melt_Tm'][1])
+
+    def test_parquet(self, tmpdir):
+        parquet = pytest.importorskip('pyarrow.parquet')
+        path = str(tmpdir.join('out.parquet'))
+        with output.open_writer(path, flush_every=1) as writer:
+            for row in rows:
+                writer.write(row)
+        table = parquet.read_table(path)
+        assert table.column_names == list(output.COLUMNS)
+        assert table.column('SNP_Target_ID').to_pylist() == [rows[0][0], rows[1][0]]
+        assert table.column('var_melt_Tm').to_pylist() == [86.5, None]
+
+    def test_read_rows(self, tmpdir):
+        expected = [tuple(output._typed(X)) for X in rows]
+        for name in ('out.txt', 'out.tsv', 'out.jsonl', 'out.npz'):
+            path = str(tmpdir.join(name))
+            with output.open_writer(path) as writer:
+                for row in rows:
+                    writer.write(row)
+            assert list(output.read_rows(path)) == expected
@@ -0,0 +1,40 @@
+import pickle
+
+import numpy as np
+from pcr_marker_design import run_p3 as P3
+from pcr_marker_design.pairs import FIELDS, PrimerPair, PrimerPairTable
+from test.test_run_p3 import p3_test_globals, p3_test_out, p3_test_seq
+
+
+def test_primer_pair_reads_as_dict():
+    """A pair copies, compares and pickles as the dict it stands for"""
+    pair = P3.run_P3(p3_test_seq, p3_test_globals)[0]
+    assert isinstance(pair, PrimerPair)
+    assert dict(pair) == p3_test_out[0]
+    assert pair.get('TARGET_IDS') is None and 'PRIMER_LEFT' in pair
+    assert dict(pair, TARGET_IDS=['a'])['TARGET_IDS'] == ['a']
+    assert pickle.loads(pickle.dumps(pair)) == pair
+    assert not hasattr(pair, '__dict__')
+
+
+def test_primer_pair_table():
+    """A session's pairs, in one table, come back as they went in"""
+    session = P3.DesignSession(p3_test_globals)
+    moved = dict(p3_test_seq, REF_OFFSET=1000, TARGET_ID=None)
+    results = list(session.design_many([p3_test_seq, moved]))
+    table = session.design_table([p3_test_seq, moved])
+    assert len(table) == 8
+    assert list(table) == [X for Y in results for X in Y]
+    assert table[5]['TARGET_ID'] is None
+    assert np.array_equal(table['left_start'][4:], table['left_start'][:4] + 1000)
+    assert list(table[:4]) == results[0]
+    assert list(PrimerPairTable.from_pairs(X for Y in results for X in Y)) == list(table)
+
+
+def test_primer_pair_table_without_ids():
+    """Pairs read back from a table built without IDs still read as dicts"""
+    pair = P3.run_P3(p3_test_seq, p3_test_globals)[0]
+    anonymous = PrimerPair(*[None if X in ('target_id', 'seq_id') else getattr(pair, X) for X in FIELDS])
+    read = PrimerPairTable.from_pairs([anonymous])[0]
+    assert read.seq_id is None and read['AMPLICON_REGION'] is None
+    assert dict(read)['PRIMER_LEFT'] == pair['PRIMER_LEFT']
@@ -0,0 +1,54 @@
+# Test staged pipelines
+
+import asyncio
+import time
+
+import pytest
+from pcr_marker_design.pipeline import Stage, run_pipeline
+
+
+def double(x):
+    ## later items finish first, so that any reordering shows
+    time.sleep(0.001 * (x % 3))
+    return 2 * x
+
+
+async def increment(x):
+    await asyncio.sleep(0.001 * (x % 5))
+    return x + 1
+
+
+def test_run_pipeline():
+    """Thread and coroutine stages give results in order, or all of them
+    as they are ready
+    """
+    stages = [Stage('double', double, workers=3), Stage('increment', increment, workers=4)]
+    assert list(run_pipeline(range(50), stages)) == [2 * X + 1 for X in range(50)]
+    assert sorted(run_pipeline(range(50), stages, ordered=False)) == [2 * X + 1 for X in range(50)]
+    assert list(run_pipeline(iter([]), stages)) == []
+    with pytest.raises(ValueError):
+        Stage('none', double, workers=0)
+
+
+def test_backpressure_and_errors():
+    """A consumer that stops reading holds up the source, and a stage's
+    exception is raised by the generator
+    """
+    read = []
+
+    def source():
+        for i in range(1000):
+            read.append(i)
+            yield i
+    results = run_pipeline(source(), [Stage('double', double, workers=2)], queue_size=2, max_pending=5)
+    assert next(results) == 0
+    time.sleep(0.1)
+    assert len(read) <= 6
+    results.close()
+
+    def fail(x):
+        if x == 7:
+            raise KeyError(x)
+        return x
+    with pytest.raises(KeyError):
+        list(run_pipeline(range(20), [Stage('fail', fail, workers=2)]))
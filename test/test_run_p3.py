@@ -4,30 +4,62 @@ from pcr_marker_design import run_p3 as P3
 
 p3_test_out = [{'AMPLICON_REGION': 'MH1000:47-133',
   'PRIMER_LEFT': (46, 21),
+  'PRIMER_LEFT_GC_PERCENT': 52.38095238095238,
+  'PRIMER_LEFT_PENALTY': 1.3299057711502655,
   'PRIMER_LEFT_SEQUENCE': 'GCATCAGTGAGTACAGCATGC',
+  'PRIMER_LEFT_TM': 59.670094228849734,
+  'PRIMER_PAIR_PENALTY': 1.373239688566116,
+  'PRIMER_PAIR_PRODUCT_SIZE': 87,
   'PRIMER_RIGHT': (132, 20),
+  'PRIMER_RIGHT_GC_PERCENT': 55.0,
+  'PRIMER_RIGHT_PENALTY': 0.043333917415850465,
   'PRIMER_RIGHT_SEQUENCE': 'TCTCCTCCTTAGCCTGCCTT',
+  'PRIMER_RIGHT_TM': 59.95666608258415,
   'SEQUENCE_ID': 'MH1000',
   'TARGET_ID': 'MH1000:'},
  {'AMPLICON_REGION': 'MH1000:47-140',
   'PRIMER_LEFT': (46, 21),
+  'PRIMER_LEFT_GC_PERCENT': 52.38095238095238,
+  'PRIMER_LEFT_PENALTY': 1.3299057711502655,
   'PRIMER_LEFT_SEQUENCE': 'GCATCAGTGAGTACAGCATGC',
+  'PRIMER_LEFT_TM': 59.670094228849734,
+  'PRIMER_PAIR_PENALTY': 1.5090296435631672,
+  'PRIMER_PAIR_PRODUCT_SIZE': 94,
   'PRIMER_RIGHT': (139, 20),
+  'PRIMER_RIGHT_GC_PERCENT': 60.0,
+  'PRIMER_RIGHT_PENALTY': 0.17912387241290162,
   'PRIMER_RIGHT_SEQUENCE': 'CAGTGCGTCTCCTCCTTAGC',
+  'PRIMER_RIGHT_TM': 60.1791238724129,
   'SEQUENCE_ID': 'MH1000',
   'TARGET_ID': 'MH1000:'},
  {'AMPLICON_REGION': 'MH1000:47-144',
   'PRIMER_LEFT': (46, 21),
+  'PRIMER_LEFT_GC_PERCENT': 52.38095238095238,
+  'PRIMER_LEFT_PENALTY': 1.3299057711502655,
   'PRIMER_LEFT_SEQUENCE': 'GCATCAGTGAGTACAGCATGC',
+  'PRIMER_LEFT_TM': 59.670094228849734,
+  'PRIMER_PAIR_PENALTY': 1.8643178301738885,
+  'PRIMER_PAIR_PRODUCT_SIZE': 98,
   'PRIMER_RIGHT': (143, 20),
+  'PRIMER_RIGHT_GC_PERCENT': 55.0,
+  'PRIMER_RIGHT_PENALTY': 0.534412059023623,
   'PRIMER_RIGHT_SEQUENCE': 'CATTCAGTGCGTCTCCTCCT',
+  'PRIMER_RIGHT_TM': 59.46558794097638,
   'SEQUENCE_ID': 'MH1000',
   'TARGET_ID': 'MH1000:'},
  {'AMPLICON_REGION': 'MH1000:47-131',
   'PRIMER_LEFT': (46, 21),
+  'PRIMER_LEFT_GC_PERCENT': 52.38095238095238,
+  'PRIMER_LEFT_PENALTY': 1.3299057711502655,
   'PRIMER_LEFT_SEQUENCE': 'GCATCAGTGAGTACAGCATGC',
+  'PRIMER_LEFT_TM': 59.670094228849734,
+  'PRIMER_PAIR_PENALTY': 1.9504613679555973,
+  'PRIMER_PAIR_PRODUCT_SIZE': 85,
   'PRIMER_RIGHT': (130, 20),
+  'PRIMER_RIGHT_GC_PERCENT': 55.0,
+  'PRIMER_RIGHT_PENALTY': 0.6205555968053318,
   'PRIMER_RIGHT_SEQUENCE': 'TCCTCCTTAGCCTGCCTTTG',
+  'PRIMER_RIGHT_TM': 59.37944440319467,
   'SEQUENCE_ID': 'MH1000',
   'TARGET_ID': 'MH1000:'}]
 
@@ -71,5 +103,95 @@ p3_test_globals = {
 def test_run_P3():
     assert(P3.run_P3(p3_test_seq, p3_test_globals) == p3_test_out)
 
+
+def test_run_P3_many():
+    """Pooled designs come back in input order and match the serial path"""
+    targets = [dict(p3_test_seq, SEQUENCE_INCLUDED_REGION=[36, 342 - i]) for i in range(0, 60, 10)]
+    serial = [P3.run_P3(X, p3_test_globals) for X in targets]
+    assert list(P3.run_P3_many(iter(targets), p3_test_globals)) == serial
+    assert list(P3.run_P3_many(iter(targets), p3_test_globals, jobs=2)) == serial
+
+def test_design_cache(tmpdir):
+    """Cached designs are reused at any offset and persist between caches"""
+    path = str(tmpdir.join('p3.db'))
+    cache = P3.DesignCache(path=path)
+    assert P3.run_P3(p3_test_seq, p3_test_globals, cache) == p3_test_out
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    moved = dict(p3_test_seq, REF_OFFSET=1000, SEQUENCE_ID='MH1000:1001-1399', TARGET_ID='T2')
+    moved_out = P3.run_P3(moved, p3_test_globals, cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert moved_out == P3.run_P3(moved, p3_test_globals)
+    assert moved_out[0]['PRIMER_LEFT'] == (1046, 21)
+
+    reopened = P3.DesignCache(path=path)
+    assert P3.run_P3(p3_test_seq, p3_test_globals, reopened) == p3_test_out
+    assert (reopened.hits, reopened.misses) == (1, 0)
+
+    other_globals = dict(p3_test_globals, PRIMER_OPT_TM=61.0)
+    assert P3.design_key(p3_test_seq, other_globals) != P3.design_key(p3_test_seq, p3_test_globals)
+
+
+def test_design_cache_lru():
+    cache = P3.DesignCache(maxsize=2)
+    for key in 'abc':
+        cache.put(key, [])
+    assert cache.get('a') is None
+    assert cache.get('c') == []
+
+
+def test_design_session(tmpdir):
+    """A session designs as run_P3 does, caches under the same keys and
+    leaves the settings it was given alone
+    """
+    settings = dict(p3_test_globals)
+    session = P3.DesignSession(settings)
+    assert session.design(p3_test_seq) == p3_test_out
+    moved = dict(p3_test_seq, REF_OFFSET=1000, SEQUENCE_ID='MH1000:1001-1399')
+    assert list(session.design_many([p3_test_seq, moved], jobs=2)) == [p3_test_out, P3.run_P3(moved, p3_test_globals)]
+    assert settings == p3_test_globals
+
+    narrower = P3.DesignSession(settings, PRIMER_PRODUCT_SIZE_RANGE=[[75, 100]])
+    assert settings == p3_test_globals and P3.p3_globals['PRIMER_PRODUCT_SIZE_RANGE'] == [[60, 200]]
+    assert all(int(X['AMPLICON_REGION'].split('-')[1]) - int(X['AMPLICON_REGION'].split(':')[1].split('-')[0]) < 100
+               for X in narrower.design(p3_test_seq))
+
+    cache = P3.DesignCache(path=str(tmpdir.join('p3.db')))
+    P3.DesignSession(settings, cache).design(p3_test_seq)
+    assert P3.DesignCache(path=str(tmpdir.join('p3.db'))).get(P3.design_key(p3_test_seq, p3_test_globals)) is not None
+
+    with pytest.raises(ValueError):
+        P3.DesignSession(settings, PRIMER_OPT_SIZE=10, PRIMER_MIN_SIZE=18)
+
+
+def test_design_session_threads(tmpdir):
+    """One session per thread, sharing a cache, designs as serially"""
+    from concurrent.futures import ThreadPoolExecutor
+    targets = [dict(p3_test_seq, SEQUENCE_INCLUDED_REGION=[36, 342 - i]) for i in range(0, 60, 10)]
+    serial = [P3.run_P3(X, p3_test_globals) for X in targets]
+    cache = P3.DesignCache(path=str(tmpdir.join('p3.db')))
+
+    def design(target):
+        return P3.DesignSession(p3_test_globals, cache).design(target)
+    with ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(design, targets + targets)) == serial + serial
+
+
+def test_design_in_pool():
+    """Designs in a session's process pool match those made in process,
+    whichever thread asks
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    targets = [dict(p3_test_seq, SEQUENCE_INCLUDED_REGION=[36, 342 - i]) for i in range(0, 60, 10)]
+    session = P3.DesignSession(p3_test_globals)
+    pool = session.pool(2)
+    try:
+        with ThreadPoolExecutor(3) as threads:
+            assert list(threads.map(lambda X: session.design_in(pool, X), targets)) == \
+                [session.design(X) for X in targets]
+    finally:
+        pool.shutdown()
+
+
 if __name__ == '__main__':
     pytest.main()
@@ -0,0 +1,76 @@
+import os
+import pytest
+from design_primers import main as design_main
+from shard_primers import main as shard_main
+from pcr_marker_design.shard import ShardError, assign_shards
+
+
+test_directory = os.path.dirname(os.path.abspath(__file__))
+targets_fasta = os.path.join(test_directory, 'test-data/targets.fasta')
+targets_gff = os.path.join(test_directory, 'test-data/targets.gff')
+targets = os.path.join(test_directory, 'test-data/targets')
+
+
+def test_assign_shards():
+    """
+    Test that count shards are contiguous and near-equal, and chrom shards
+    keep each sequence together, balanced by target count.
+    """
+    ids = ['a:1', 'a:2', 'a:3', 'b:1', 'c:1', 'c:2']
+    assert assign_shards(ids, 3, 'count') == [0, 0, 1, 1, 2, 2]
+    assert assign_shards(ids, 2, 'chrom') == [0, 0, 0, 1, 1, 1]
+    with pytest.raises(ValueError):
+        assign_shards(ids, 2, 'random')
+
+
+@pytest.mark.parametrize('by', ['count', 'chrom'])
+def test_split_design_merge(tmpdir, by):
+    """
+    Test that designing shards separately and merging them gives exactly
+    the output of a single run, and that merge refuses an unfinished shard.
+    """
+    single = str(tmpdir.join('single.txt'))
+    design_main(['-i', targets_fasta, '-g', targets_gff, '-T', targets, '-o', single])
+
+    shard_dir = str(tmpdir.join('shards'))
+    shard_main(['split', '-i', targets_fasta, '-T', targets, '-n', '2', '--by', by, '--out-dir', shard_dir])
+    manifest = os.path.join(shard_dir, 'manifest.json')
+    outputs = [str(tmpdir.join('shard{0}.txt'.format(i))) for i in range(2)]
+    for i, path in enumerate(outputs):
+        design_main(['-i', targets_fasta, '-g', targets_gff, '--shard-manifest', manifest,
+                     '--shard-index', str(i), '-o', path])
+        assert os.path.exists(path + '.done')
+
+    merged = str(tmpdir.join('merged.txt'))
+    shard_main(['merge', manifest] + outputs + ['-o', merged])
+    assert open(merged).read() == open(single).read()
+
+    ## reversed shard order, a missing marker and a truncated output are all refused
+    with pytest.raises(ShardError):
+        shard_main(['merge', manifest] + outputs[::-1] + ['-o', merged])
+    lines = open(outputs[1]).readlines()
+    with open(outputs[1], 'w') as handle:
+        handle.writelines(lines[:-1])
+    with pytest.raises(ShardError):
+        shard_main(['merge', manifest] + outputs + ['-o', merged])
+    assert not os.path.exists(merged)
+    os.remove(outputs[0] + '.done')
+    with pytest.raises(ShardError):
+        shard_main(['merge', manifest] + outputs + ['-o', merged])
+
+
+def test_shard_target_delimiter(tmpdir):
+    """
+    Test that a shard run takes the target delimiter from the manifest and
+    refuses a different one given with -d.
+    """
+    shard_dir = str(tmpdir.join('shards'))
+    shard_main(['split', '-i', targets_fasta, '-T', targets, '-n', '2', '--out-dir', shard_dir])
+    manifest = os.path.join(shard_dir, 'manifest.json')
+    output = str(tmpdir.join('shard0.txt'))
+    with pytest.raises(ValueError):
+        design_main(['-i', targets_fasta, '-g', targets_gff, '--shard-manifest', manifest,
+                     '--shard-index', '0', '-d', '|', '-o', output])
+    design_main(['-i', targets_fasta, '-g', targets_gff, '--shard-manifest', manifest,
+                 '--shard-index', '0', '-d', ':', '-o', output])
+    assert os.path.exists(output + '.done')
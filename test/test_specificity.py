@@ -0,0 +1,106 @@
+# Test the reference k-mer index and off-target screening
+
+import os
+import re
+
+import pytest
+
+from pyfaidx import Fasta
+from design_primers import parse_args, design_primers
+from pcr_marker_design.specificity import KmerIndex, reverse_complement, screen_pairs
+
+test_directory = os.path.dirname(os.path.abspath(__file__))
+targets_fasta = os.path.join(test_directory, 'test-data/targets.fasta')
+
+
+def duplicated_reference(tmpdir):
+    """targets.fasta plus a copy of k69_93535 900-1500"""
+    path = str(tmpdir.join('dup.fasta'))
+    reference = Fasta(targets_fasta, as_raw=True)
+    with open(path, 'w') as handle:
+        for name in reference.keys():
+            handle.write('>{0}\n{1}\n'.format(name, reference[name][:]))
+        handle.write('>dup\n{0}\n'.format(reference['k69_93535'][900:1500]))
+    return path
+
+
+def test_index_hits(tmpdir):
+    """
+    Test that k-mer lookups, built in several chunks, find every position
+    a scan of the reference does, and that the index reopens from disk.
+    """
+    reference = Fasta(targets_fasta, as_raw=True)
+    index = KmerIndex.build(reference, str(tmpdir.join('index')), k=8, chunk_size=500)
+    sequence = ''.join(str(reference[X][:]).upper() for X in reference.keys())
+    for kmer in [sequence[i:i + 8] for i in range(0, len(sequence) - 8, 97)] + ['ACGTACGT', 'ACGTNCGT']:
+        assert index.hits(kmer).tolist() == [X.start() for X in re.finditer('(?={0})'.format(kmer), sequence)]
+    reopened = KmerIndex(str(tmpdir.join('index')))
+    assert reopened.k == 8 and reopened.names == list(reference.keys())
+    assert reopened.hits(sequence[100:108]).tolist() == index.hits(sequence[100:108]).tolist()
+
+
+def test_screen_pairs(tmpdir):
+    """
+    Test that a pair is unique in the reference, and has an off-target
+    product once its amplicon is duplicated elsewhere.
+    """
+    reference = Fasta(targets_fasta, as_raw=True)
+    seq = reference['k69_93535'][:]
+    pair = dict(PRIMER_LEFT=[1000, 20], PRIMER_RIGHT=[1199, 20], PRIMER_LEFT_SEQUENCE=seq[1000:1020],
+                PRIMER_RIGHT_SEQUENCE=reverse_complement(seq[1180:1200]))
+    unique = KmerIndex.build(reference, str(tmpdir.join('unique')), k=10)
+    assert unique.locate(unique.products(pair['PRIMER_LEFT_SEQUENCE'], pair['PRIMER_RIGHT_SEQUENCE'])[:, 0]) == \
+        [('k69_93535', 1000)]
+    assert screen_pairs(unique, 'k69_93535', 0, [pair])[0]['OFF_TARGET_PRODUCTS'] == 0
+
+    duplicated = KmerIndex.build(duplicated_reference(tmpdir), str(tmpdir.join('duplicated')), k=10)
+    products = duplicated.products(pair['PRIMER_LEFT_SEQUENCE'], pair['PRIMER_RIGHT_SEQUENCE'])
+    assert duplicated.locate(products[:, 0]) == [('k69_93535', 1000), ('dup', 100)]
+    ## the template can start part way along the sequence
+    flagged = screen_pairs(duplicated, 'k69_93535', 500, [dict(pair, PRIMER_LEFT=[500, 20], PRIMER_RIGHT=[699, 20])],
+                           reject=False)
+    assert flagged[0]['OFF_TARGET_PRODUCTS'] == 1 and flagged[0]['PRIMER_LEFT_SITES'] == 2
+    assert screen_pairs(duplicated, 'k69_93535', 0, [pair]) == []
+    assert len(screen_pairs(duplicated, 'k69_93535', 0, [pair], max_off_target=1)) == 1
+
+
+def test_design_primers_specificity(tmpdir):
+    """
+    Test that design_primers drops the pairs amplifying the duplicated
+    region, and only those.
+    """
+    dup = duplicated_reference(tmpdir)
+    inputs = ['-i', dup, '-g', os.path.join(test_directory, 'test-data/targets.gff'),
+              '-T', os.path.join(test_directory, 'test-data/targets')]
+    plain = list(design_primers(parse_args(inputs)))
+    screened = list(design_primers(parse_args(inputs + ['--specificity-index', str(tmpdir.join('index')),
+                                                        '--specificity-k', '10'])))
+    assert set(screened) < set(plain)
+    assert all(X.startswith('k69_93535') for X in set(plain) - set(screened))
+    assert [X for X in plain if X.startswith('k69_98089')] == [X for X in screened if X.startswith('k69_98089')]
+
+    ## a new index cannot be built from standard input, but one built already can be used
+    piped = ['-i', '-'] + inputs[2:]
+    with pytest.raises(SystemExit):
+        parse_args(piped + ['--specificity-index', str(tmpdir.join('new'))])
+    assert parse_args(piped + ['--specificity-index', str(tmpdir.join('index'))]).specificity_index
+
+
+def test_sites_at_sequence_ends(tmpdir):
+    """
+    Test that a primer whose 3' end binds at the very start of a sequence,
+    or its reverse complement at the very end, primes a product on that
+    sequence rather than running into the neighbouring one.
+    """
+    reference = Fasta(duplicated_reference(tmpdir), as_raw=True)
+    index = KmerIndex.build(reference, str(tmpdir.join('index')), k=10)
+    dup = reference['dup'][:]
+    ## only the last 12 bases of each primer lie on dup
+    left = 'ACGTACGT' + dup[:12]
+    right = 'ACGTACGT' + reverse_complement(dup[-12:])
+    forward, _ = index.primer_sites(left)
+    _, reverse = index.primer_sites(right)
+    start = index.global_position('dup', 0)
+    assert start in forward.tolist() and start + len(dup) in reverse.tolist()
+    ## dup copies k69_93535 from 900, so the primers also prime there, with the 5' ends on the sequence
+    assert index.locate(index.products(left, right)[:, 0]) == [('k69_93535', 892), ('dup', 0)]
@@ -6,6 +6,8 @@
 
 # mocks to allow routine testing, assuming it is working
 
+import time
+
 import numpy as np
 import pytest
 from scipy import interpolate
@@ -13,9 +15,11 @@ from pcr_marker_design import umelt_service as um
 
 
 class TestUmeltService:
+    test_seq = "TATAACCTGACTAACCATGAACCTGGGTAGAATTCCACTCCTCCACCAAATTTTTTAACTTAACCAAG"
+
     @pytest.mark.umelt
     def test_overall_usage(self):
-        test_seq = "TATAACCTGACTAACCATGAACCTGGGTAGAATTCCACTCCTCCACCAAATTTTTTAACTTAACCAAG"
+        test_seq = self.test_seq
 
         test_seq_hels = np.array([9.73479996e+01, 9.72409973e+01, 9.71320038e+01,
                                   9.70189972e+01, 9.69020004e+01, 9.67819977e+01,
@@ -102,3 +106,84 @@ class TestHelicityInfo:
         melt_point = make_spline(spline_x, spline_y)
 
         assert approximately_equal(melt_point, 63.265306, 3)
+
+    def test_batch_melting_temps(self):
+        """Batched melting temperatures match get_melting_temp curve by curve,
+        and the -dH/dT curves peak there.
+        """
+
+        steps = np.array([85, 72.3, 90.1, 66])
+        helicity = 100 / (1 + np.exp((um.TEMPERATURE_RANGE[None, :] - steps[:, None]) / 0.8))
+        curves = um.melting_temps(helicity)
+        single = [um.HelicityInfo(X, um.TEMPERATURE_RANGE).get_melting_temp() for X in helicity]
+
+        assert np.allclose(curves.melting_temps, single, atol=0.05)
+        assert np.allclose(curves.melting_temps, steps, atol=0.3)
+        assert curves.derivatives.shape == (4, curves.temperatures.size)
+        assert np.array_equal(curves.temperatures[curves.derivatives.argmax(axis=1)], curves.melting_temps)
+        assert um.melting_temps([]).melting_temps.size == 0
+
+
+class TestUmeltClient:
+    """Batch uMelt client against the local stand-in server"""
+
+    def test_melt_many(self, umelt_stub):
+        umelt_stub.delay = 0.05
+        umelt = um.UmeltService(url=umelt_stub.url, max_workers=4, backoff=0.01)
+        seqs = [um.MeltSeq(TestUmeltService.test_seq[:30 + i]) for i in range(16)]
+        results = umelt.melt_many(seqs)
+
+        assert [X.sequence for X in results] == seqs
+        assert all(X.ok for X in results)
+        assert umelt_stub.requests == 16
+        assert 1 < umelt_stub.max_active <= 4
+        # connections are kept alive and reused
+        assert len(umelt_stub.connections) <= 4
+        local = um.melt_service('local').melt(seqs[-1])
+        assert np.allclose(results[-1].helicity_info.helicity_data, local.helicity_data, atol=1e-3)
+        # later batches run on the same threads, until the service is closed
+        executor = umelt.executor
+        assert all(X.ok for X in umelt.melt_many(seqs[:4])) and umelt.executor is executor
+        umelt.close()
+        with pytest.raises(RuntimeError):
+            umelt.melt_many(seqs[:1])
+
+    def test_transient_failures_are_retried(self, umelt_stub):
+        umelt_stub.fail_first = 2
+        umelt = um.UmeltService(url=umelt_stub.url, retries=3, backoff=0.01)
+        helicity = umelt.melt(um.MeltSeq(TestUmeltService.test_seq))
+
+        assert umelt_stub.requests == 3
+        assert helicity.helicity_data.shape == um.TEMPERATURE_RANGE.shape
+
+    def test_failures_are_reported(self, umelt_stub):
+        umelt_stub.fail_every = 1
+        umelt = um.UmeltService(url=umelt_stub.url, retries=2, backoff=0.01)
+        result, = umelt.melt_many([um.MeltSeq(TestUmeltService.test_seq)])
+
+        assert not result.ok
+        assert result.helicity_info is None
+        assert (result.error.status, result.error.attempts) == (503, 3)
+        with pytest.raises(um.MeltError):
+            umelt.melt(um.MeltSeq(TestUmeltService.test_seq))
+
+    def test_unreadable_responses_are_failures(self, umelt_stub):
+        from pcr_marker_design import metrics
+        umelt_stub.melt_xml = lambda *args: 'not xml'
+        umelt = um.UmeltService(url=umelt_stub.url, backoff=0.01)
+        metrics.reset()
+        metrics.enable()
+        try:
+            result, = umelt.melt_many([um.MeltSeq(TestUmeltService.test_seq)])
+            assert not result.ok and 'Unreadable' in str(result.error)
+            assert metrics.METRICS.counters['melt_failures'] == 1
+        finally:
+            metrics.disable()
+            metrics.reset()
+
+    def test_rate_limit(self, umelt_stub):
+        umelt = um.UmeltService(url=umelt_stub.url, max_workers=4, rate_limit=50)
+        start = time.time()
+        umelt.melt_many([um.MeltSeq(TestUmeltService.test_seq)] * 10)
+
+        assert time.time() - start >= 9 / 50.0
@@ -0,0 +1,36 @@
+# Test the variant application engine
+
+from Bio.Seq import MutableSeq
+from pcr_marker_design.variants import VariantWindow, apply_variants
+
+template = "AAAACCCCGGGGTTTTAAAACCCCGGGGTTTT"
+
+
+class TestVariants:
+    def test_snps_match_slice_assignment(self):
+        variants = [(20, 21, 'G'), (3, 4, 'T'), (10, 11, 'A')]
+        expected = MutableSeq(template)
+        for start, end, alt in variants:
+            expected[start:end] = alt
+        assert apply_variants(template, variants) == str(expected)
+
+    def test_indels_shift_later_positions(self):
+        ## insert 3 bases after position 4, delete positions 9 and 10, then a SNP at 20
+        window = VariantWindow(template, [(20, 21, 'G'), (4, 5, 'CTTT'), (8, 11, 'G')])
+        assert window.alt == "AAAACTTTCCCGGTTTTAAAAGCCCGGGGTTTT"
+        assert len(window.alt) == len(template) + 3 - 2
+        assert list(window.to_alt([0, 4, 5, 8, 11, 20, 21, 32])) == [0, 4, 8, 11, 12, 21, 22, 33]
+        (ref, alt), = window.amplicons([2], [22])
+        assert ref == template[2:22]
+        assert alt == "AACTTTCCCGGTTTTAAAAGC"
+
+    def test_overlapping_and_outside_variants_are_skipped(self):
+        window = VariantWindow(template, [(4, 6, 'A'), (5, 6, 'G'), (30, 40, 'A')])
+        assert window.variants == [(4, 6, 'A')]
+        assert window.alt == template[:4] + 'A' + template[6:]
+
+    def test_no_variants(self):
+        window = VariantWindow(template)
+        assert window.alt == template
+        assert window.amplicons([1, 5], [10, 20]) == [(template[1:10], template[1:10]),
+                                                      (template[5:20], template[5:20])]
@@ -0,0 +1,108 @@
+"""
+A local stand-in for the uMelt web service
+------------------------------------------
+
+Answers uMelt-style GET requests with uMelt-style XML, so clients can be
+tested and benchmarked offline. Helicity curves come from the local melt
+model. Failures and latency can be injected, and request counts and peak
+concurrency are recorded.
+"""
+
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+from pcr_marker_design import melt_model as mm
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server.stub
+        with stub.lock:
+            stub.requests += 1
+            count = stub.requests
+            stub.active += 1
+            stub.max_active = max(stub.max_active, stub.active)
+            stub.connections.add(self.client_address)
+        try:
+            if stub.delay:
+                time.sleep(stub.delay)
+            status = stub.status_for(count)
+            if status == 200:
+                query = parse_qs(urlparse(self.path).query)
+                body = stub.melt_xml(query['seq'][0], float(query.get('cation', [20])[0]),
+                                     float(query.get('mg', [2])[0]), float(query.get('dmso', [0])[0]))
+            else:
+                body = 'Service unavailable'
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with stub.lock:
+                stub.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UmeltStub:
+    """A uMelt stand-in listening on localhost.
+
+    fail_first makes the first requests answer HTTP 503, fail_every
+    makes every nth request do so, and delay adds latency (seconds)
+    to every request.
+    """
+
+    def __init__(self, fail_first=0, fail_every=0, delay=0):
+        self.fail_first = fail_first
+        self.fail_every = fail_every
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        self.connections = set()
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:{0}/udesign.cgi'.format(self.server.server_address[1])
+        self._thread = None
+
+    def status_for(self, count):
+        if count <= self.fail_first or (self.fail_every and count % self.fail_every == 0):
+            return 503
+        return 200
+
+    def melt_xml(self, seq, cations, free_mg, dmso_percent):
+        helicity = mm.predict_helicity([seq], cations, free_mg, dmso_percent)[0]
+        values = ' '.join('{0:.3f}'.format(X) for X in helicity)
+        return ('<seqMelt><amplicon><sequence>{0}</sequence>'
+                '<helicity>{1}</helicity></amplicon></seqMelt>').format(seq, values)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()